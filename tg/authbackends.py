@@ -1,24 +1,116 @@
 # coding=utf-8
 from __future__ import (unicode_literals, absolute_import, print_function)
+
+import hashlib
+import re
+
+from django.conf import settings
 from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from django.core.validators import validate_email
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from typing import Iterable, Optional
+
 from .models import UserInfo
 
 """
 自定义用户认证的backend
 """
 
+ID_MOBILE, ID_EMAIL, ID_USERNAME = 'mobile', 'email', 'username'
+DEFAULT_AUTH_LOOKUP = {
+    # 不存在的账号在缓存中记录的时间(秒), 这段时间内用这个账号登录不再查询数据库
+    'MISS_TTL': 300,
+}
+
+_mobile_re = re.compile(r'^\+?\d{5,16}$')
+
+
+def auth_lookup_settings():
+    conf = dict(DEFAULT_AUTH_LOOKUP)
+    conf.update(getattr(settings, 'AUTH_LOOKUP', {}))
+    return conf
+
+
+def identifier_kind(identifier):
+    # type: (unicode) -> str
+    """
+    登录时输入的账号的类别: 手机号, email 或用户名
+    """
+    if _mobile_re.match(identifier):
+        return ID_MOBILE
+    if '@' in identifier:
+        try:
+            validate_email(identifier)
+        except ValidationError:
+            pass
+        else:
+            return ID_EMAIL
+    return ID_USERNAME
+
+
+def _miss_key(identifier, with_username):
+    """
+    是否同时按用户名匹配, 查询条件不同, 分开记录
+    """
+    return 'authmiss_{}_{}'.format(int(with_username), hashlib.md5(identifier.encode('utf-8')).hexdigest())
 
-class MobileBackend(ModelBackend):
+
+def find_users(identifier, kinds=(ID_MOBILE, ID_EMAIL, ID_USERNAME)):
+    # type: (unicode, Iterable[str]) -> list
+    """
+    按账号查找用户, 只查询一次, 用到的字段都有索引.
+    用户名也可以是纯数字或 email 的形式, 所以手机号/email 同时按用户名匹配, 用户名匹配的排在前面.
+    kinds 为允许的类别, 类别不符时返回空列表. 没有找到的账号在缓存中记录 MISS_TTL 秒
     """
-    按手机号认证
+    identifier = (identifier or '').strip()
+    kind = identifier_kind(identifier) if identifier else None
+    if kind not in kinds:
+        return []
+    key = _miss_key(identifier, ID_USERNAME in kinds)
+    if cache.get(key):
+        return []
+
+    if kind == ID_USERNAME:
+        cond = Q(username=identifier)
+    else:
+        cond = Q(**{kind: identifier})
+        if ID_USERNAME in kinds:
+            cond |= Q(username=identifier)
+    users = sorted(UserInfo.objects.filter(cond), key=lambda u: (u.username != identifier, u.pk))
+    if not users:
+        cache.set(key, 1, auth_lookup_settings()['MISS_TTL'])
+    return users
+
+
+def forget_misses(identifiers):
+    # type: (Iterable[unicode]) -> None
+    """
+    用户的用户名/手机号/email 有修改时调用, 删除这些账号不存在的记录
+    """
+    cache.delete_many([_miss_key(identifier.strip(), with_username)
+                       for identifier in identifiers if identifier for with_username in (False, True)])
+
+
+class IdentifierBackend(ModelBackend):
+    """
+    按用户名, 手机号或 email 认证. 先判断输入的是哪一种, 只查询一次数据库.
+    与原来的 MobileBackend 一样, 不检查用户是否有效, 由调用方(如登录接口)提示
     """
     def authenticate(self, username=None, password=None, **kwargs):
+        # type: (unicode, unicode) -> Optional[UserInfo]
         if not username:
             return None
 
-        rs = UserInfo.objects.filter(mobile=username)[:1]
-        if rs:
-            user = rs[0]
-            return user if user.check_password(password) else None
-        else:
+        users = find_users(username)
+        if not users:
+            # 与 ModelBackend 相同, 账号不存在时也计算一次密码 hash, 减少两种情况的时间差
+            UserInfo().set_password(password)
             return None
+        # 用户名匹配的优先, 其次为第一个手机号/email 匹配的, 与原来 ModelBackend + MobileBackend 的顺序一致
+        candidates = users[:2] if users[0].get_username() == username.strip() else users[:1]
+        for user in candidates:
+            if user.check_password(password):
+                return user
+        return None
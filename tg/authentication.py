@@ -1,9 +1,19 @@
 # coding=utf-8
 from __future__ import (unicode_literals, absolute_import)
 
+import jwt
+from django.utils.translation import ugettext as _
+from rest_framework import exceptions
 from rest_framework.request import Request
 from rest_framework.authentication import SessionAuthentication
 from rest_framework_jwt.authentication import JSONWebTokenAuthentication
+from rest_framework_jwt.settings import api_settings as jwt_api_settings
+
+from . import usercache
+
+jwt_decode_handler = jwt_api_settings.JWT_DECODE_HANDLER
+jwt_get_user_id_from_payload = jwt_api_settings.JWT_PAYLOAD_GET_USER_ID_HANDLER
+jwt_get_username_from_payload = jwt_api_settings.JWT_PAYLOAD_GET_USERNAME_HANDLER
 
 class UnsafeSessionAuthentication(SessionAuthentication):
     """
@@ -46,3 +56,40 @@ class JSONWebTokenAuthenticationUri(JSONWebTokenAuthentication):
                 return None
 
         return jwt_value
+
+    def authenticate(self, request):
+        """
+        与原实现相同, 但验证过的 token 及用户从 usercache 中读取, 不再每个请求都查询数据库
+        """
+        jwt_value = self.get_jwt_value(request)
+        if jwt_value is None:
+            return None
+
+        payload = usercache.get_token_payload(jwt_value)
+        if payload is None:
+            try:
+                payload = jwt_decode_handler(jwt_value)
+            except jwt.ExpiredSignature:
+                msg = _('Signature has expired.')
+                raise exceptions.AuthenticationFailed(msg)
+            except jwt.DecodeError:
+                msg = _('Error decoding signature.')
+                raise exceptions.AuthenticationFailed(msg)
+            except jwt.InvalidTokenError:
+                raise exceptions.AuthenticationFailed()
+            usercache.remember_token(jwt_value, payload)
+
+        return self.authenticate_credentials(payload), jwt_value
+
+    def authenticate_credentials(self, payload):
+        user_id = jwt_get_user_id_from_payload(payload)
+        if not user_id:
+            return super(JSONWebTokenAuthenticationUri, self).authenticate_credentials(payload)
+
+        user = usercache.get_user(user_id)
+        # 改过用户名后, 之前签发的 token 失效, 与按用户名查询时一致
+        if user is None or user.get_username() != jwt_get_username_from_payload(payload):
+            raise exceptions.AuthenticationFailed(_('Invalid signature.'))
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User account is disabled.'))
+        return user
@@ -0,0 +1,239 @@
+# coding=utf-8
+"""
+UserStatistic 计数的写缓冲
+
+关注/订阅等操作不在用户的事务中 UPDATE data_user_stat, 而是在事务提交后把增量 HINCRBY 到 redis 的一个哈希中
+(字段为 "<user_id>:<计数字段>"), 由 manage.py flush_user_counters 定期合并写入数据库, 热门投顾的行不再被频繁加锁.
+读取时用 pending() 取得还没有写入的增量, 加到数据库中的值上.
+flush 和 reconcile 用同一个锁(cache.add), 同一时间只有一个进程在写入.
+每批增量在同一个事务中 UPDATE 数据库并从 redis 中 HDEL, 提交失败时再加回 redis, 同一批增量不会被写入两次;
+进程恰好在 HDEL 之后, 提交之前退出时这批增量会丢失, 由 reconcile 修正.
+
+redis 不可用时在事务提交后直接更新数据库. 计数最小为 0, 减到负数的按 0 计(见 UserStatisticManager.add_counts).
+
+reconcile() 按关注/订阅等原始数据重新统计全部计数, 修正偏差, 由 manage.py reconcile_user_stats 调用
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import logging
+import os
+import time
+from collections import OrderedDict, defaultdict
+
+from django.apps import apps
+from django.core.cache import cache
+from django.db.models import Count
+from django.db import transaction
+from redis import RedisError
+from typing import Dict, Iterable, List, Tuple
+
+from . import dbutils, redis_utils
+
+logger = logging.getLogger('wh')
+
+PENDING_KEY = redis_utils.make_key('user_counters', 'pending')
+# 正在写入数据库的增量. 写入失败时保留, 下次 flush 先处理
+FLUSHING_KEY = redis_utils.make_key('user_counters', 'flushing')
+LOCK_KEY = 'user_counters_lock'
+LOCK_TIMEOUT = 3600
+
+
+def _user_statistic():
+    return apps.get_model('tg', 'UserStatistic')
+
+
+def incr(field, deltas):
+    # type: (str, Dict[int, int]) -> None
+    """
+    deltas 为 {user_id: 增量}. 当前事务提交后才记入缓冲, 回滚的不计
+    """
+    deltas = {int(user_id): int(delta) for user_id, delta in deltas.items() if delta}
+    if deltas:
+        transaction.on_commit(lambda: _push(field, deltas))
+
+
+def _push(field, deltas):
+    r = redis_utils.get_redis()
+    if r is not None:
+        try:
+            pipe = r.pipeline(transaction=True)
+            for user_id, delta in deltas.items():
+                pipe.hincrby(PENDING_KEY, '{}:{}'.format(user_id, field), delta)
+            pipe.execute()
+            return
+        except RedisError as e:
+            redis_utils.mark_down(e)
+    _user_statistic().objects.add_counts(field, deltas)
+
+
+def pending(user_ids, fields):
+    # type: (Iterable[int], Iterable[str]) -> Dict[Tuple[int, str], int]
+    """
+    还没有写入数据库的增量 {(user_id, 计数字段): 增量}, 没有增量的不返回
+    """
+    names = ['{}:{}'.format(user_id, field) for user_id in set(user_ids) for field in fields]
+    r = redis_utils.get_redis()
+    if not names or r is None:
+        return {}
+    try:
+        pipe = r.pipeline(transaction=False)
+        pipe.hmget(PENDING_KEY, names)
+        pipe.hmget(FLUSHING_KEY, names)
+        waiting, flushing = pipe.execute()
+    except RedisError as e:
+        redis_utils.mark_down(e)
+        return {}
+    result = {}
+    for name, a, b in zip(names, waiting, flushing):
+        delta = int(a or 0) + int(b or 0)
+        if delta:
+            user_id, field = name.split(':', 1)
+            result[(int(user_id), field)] = delta
+    return result
+
+
+def _acquire_lock():
+    return cache.add(LOCK_KEY, os.getpid(), LOCK_TIMEOUT)
+
+
+def flush(batch_size=1000):
+    # type: (int) -> Dict[str, object]
+    """
+    把缓冲的增量合并写入数据库. 先 RENAME 到 FLUSHING_KEY, 之后的增量写到新的 PENDING_KEY, 互不影响.
+    其他进程正在 flush/reconcile 时不处理, 返回的 skipped 为 True
+    """
+    stats = OrderedDict([('users', 0), ('fields', 0), ('seconds', 0.0), ('skipped', False)])
+    r = redis_utils.get_redis()
+    if r is None:
+        return stats
+    if not _acquire_lock():
+        stats['skipped'] = True
+        return stats
+    try:
+        _flush(r, batch_size, stats)
+    finally:
+        cache.delete(LOCK_KEY)
+    return stats
+
+
+def _flush(r, batch_size, stats):
+    t = time.time()
+    if not r.exists(FLUSHING_KEY):
+        if not r.exists(PENDING_KEY):
+            return
+        r.rename(PENDING_KEY, FLUSHING_KEY)
+
+    items = []
+    for name, delta in r.hgetall(FLUSHING_KEY).items():
+        if isinstance(name, bytes):
+            name = name.decode('utf-8')
+        items.append((name, int(delta)))
+    items.sort()
+    users, fields = set(), set()
+    for batch in dbutils.chunked(items, batch_size):
+        _flush_batch(r, batch)
+        for name, _delta in batch:
+            user_id, field = name.split(':', 1)
+            users.add(user_id)
+            fields.add(field)
+
+    stats['users'] = len(users)
+    stats['fields'] = len(fields)
+    stats['seconds'] = time.time() - t
+
+
+def _flush_batch(r, batch):
+    # type: (object, List[Tuple[str, int]]) -> None
+    """
+    一批增量 [("<user_id>:<计数字段>", 增量)] 写入数据库, 在同一个事务中从 FLUSHING_KEY 删除
+    """
+    by_field = defaultdict(dict)
+    for name, delta in batch:
+        user_id, field = name.split(':', 1)
+        by_field[field][int(user_id)] = delta
+    names = [name for name, _delta in batch]
+    deleted = False
+    try:
+        with transaction.atomic():
+            for field, deltas in by_field.items():
+                _user_statistic().objects.add_counts(field, deltas)
+            r.hdel(FLUSHING_KEY, *names)
+            deleted = True
+    except Exception:
+        if deleted:  # 已经从 redis 删除但事务没有提交, 加回去下次再写入
+            pipe = r.pipeline(transaction=True)
+            for name, delta in batch:
+                pipe.hincrby(FLUSHING_KEY, name, delta)
+            pipe.execute()
+        raise
+
+
+# 计数字段: (模型名, 按哪个字段分组统计)
+SOURCES = OrderedDict([
+    ('fans_count', ('SnsFollow', 'followee_id')),
+    ('followings_count', ('SnsFollow', 'user_id')),
+    ('sign_contract_count', ('SignContract', 'adviser_id')),
+    ('recommend_secs_count', ('InvestRecommendSecurity', 'owner_id')),
+    ('portfolios_count', ('PortfolioBaseInfo', 'owner_id')),
+    ('portfolios_bysubscribe_count', ('SubscribePortfolio', 'portfolio__owner_id')),
+    ('viewpoints_count', ('InvestViewpoint', 'owner_id')),
+])
+
+
+def _actual_counts(field, lo, hi):
+    # type: (str, int, int) -> Dict[int, int]
+    """
+    user_id 在 [lo, hi] 之间的用户的实际计数, 一条 GROUP BY 查询
+    """
+    model_name, group_by = SOURCES[field]
+    qs = apps.get_model('tg', model_name).objects.filter(**{
+        group_by + '__gte': lo, group_by + '__lte': hi,
+    }).order_by().values_list(group_by).annotate(n=Count('pk'))
+    return dict(qs)
+
+
+def reconcile(chunk_size=10000, batch_size=500, dry_run=False):
+    # type: (int, int, bool) -> Dict[str, object]
+    """
+    按 user_id 分段, 每段对每个计数做一次 GROUP BY, 与存储的值(加上还没有写入的增量)比较, 只批量写回不一致的行.
+    与 flush 用同一个锁, 修正期间缓冲的增量不会写入数据库, 保证存储的值与还没有写入的增量一致
+    """
+    if not _acquire_lock():
+        raise RuntimeError('另一个进程正在写入用户计数')
+    try:
+        return _reconcile(chunk_size, batch_size, dry_run)
+    finally:
+        cache.delete(LOCK_KEY)
+
+
+def _reconcile(chunk_size, batch_size, dry_run):
+    UserStatistic = _user_statistic()
+    fields = list(SOURCES)
+    stats = OrderedDict([('users', 0), ('mismatched', 0)] + [(f, 0) for f in fields])
+    t = time.time()
+    r = redis_utils.get_redis()
+    if r is not None and not dry_run:
+        _flush(r, batch_size, OrderedDict())
+
+    for chunk in dbutils.iter_values_chunks(UserStatistic.objects.all(), fields, chunk_size):
+        stats['users'] += len(chunk)
+        lo, hi = chunk[0][0], chunk[-1][0]
+        actual = {field: _actual_counts(field, lo, hi) for field in fields}
+        waiting = pending([row[0] for row in chunk], fields)
+
+        rows = []
+        for row in chunk:
+            user_id, stored = row[0], list(row[1:])
+            # 缓冲的减量可能比实际的计数多(如关注后马上取消), 存储的值最小为 0
+            expected = [max(0, actual[f].get(user_id, 0) - waiting.get((user_id, f), 0)) for f in fields]
+            if expected != stored:
+                rows.append((user_id, expected))
+                for f, a, b in zip(fields, stored, expected):
+                    if a != b:
+                        stats[f] += 1
+        stats['mismatched'] += len(rows)
+        if rows and not dry_run:
+            dbutils.bulk_update_rows(UserStatistic, fields, rows, batch_size)
+
+    stats['seconds'] = time.time() - t
+    return stats
@@ -0,0 +1,119 @@
+# coding=utf-8
+"""
+分页时的总数(COUNT(*))缓存
+
+按 queryset 的 SQL 缓存 count, 缓存键中带有查询涉及的每个表的版本号,
+表中有数据新增/修改/删除时(signals 中的回调)在事务提交后更新版本号, 旧的缓存就不会再被用到.
+修改也要更新, 修改后的行可能进入或离开带过滤条件的查询.
+bulk_create, queryset.update() 和 dbutils.bulk_update_rows 不触发 signals, 需要调用 bump_model
+(bulk_update_rows 中已经调用). 直接执行 SQL 等没有调用的, 最多在 COUNTING['TTL'] 秒内读到旧的总数.
+没有过滤条件的大表(MySQL)直接用 information_schema 中的估计行数, 超过 ESTIMATE_THRESHOLD 时不再 COUNT(*)
+
+    from tg import counting
+    n = counting.cached_count(queryset)
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections, transaction
+from django.db.models.query import QuerySet
+from django.utils.functional import cached_property
+from typing import List
+
+logger = logging.getLogger('wh')
+
+DEFAULT_COUNTING = {
+    'TTL': 60,
+    # 不带过滤条件时, 估计行数超过这个值就用估计值
+    'ESTIMATE_THRESHOLD': 100000,
+}
+
+
+def counting_settings():
+    conf = dict(DEFAULT_COUNTING)
+    conf.update(getattr(settings, 'COUNTING', {}))
+    return conf
+
+
+def _version_key(table):
+    return 'count_version_{}'.format(table)
+
+
+def bump_table(table):
+    """
+    表中的数据有增删时调用, 这个表相关的 count 缓存全部失效
+    """
+    cache.set(_version_key(table), '{:.6f}'.format(time.time()), None)
+
+
+def bump_model(model):
+    """
+    model 的表有批量写入后调用. 在事务中时提交后才更新版本号, 避免提交前其他请求又缓存了旧的总数
+    """
+    table = model._meta.db_table
+    transaction.on_commit(lambda: bump_table(table))
+
+
+def _tables(queryset):
+    # type: (QuerySet) -> List[str]
+    query = queryset.query
+    tables = {join.table_name for join in query.alias_map.values()}
+    tables.add(queryset.model._meta.db_table)
+    return sorted(tables)
+
+
+def _estimate_rows(queryset):
+    """
+    没有过滤条件时, MySQL 统计信息中的行数(InnoDB 为估计值). 不能估计时返回 None
+    """
+    query = queryset.query
+    if query.where or query.distinct or query.low_mark or query.high_mark is not None or len(query.alias_map) > 1:
+        return None
+    connection = connections[queryset.db]
+    if connection.vendor != 'mysql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s',
+            [queryset.model._meta.db_table]
+        )
+        row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+
+def cached_count(queryset):
+    # type: (QuerySet) -> int
+    conf = counting_settings()
+    tables = _tables(queryset)
+    versions = cache.get_many([_version_key(t) for t in tables])
+    sql, params = queryset.query.sql_with_params()
+    signature = '{}|{}|{}|{}'.format(
+        queryset.db, sql, params, ','.join('{}={}'.format(t, versions.get(_version_key(t))) for t in tables)
+    )
+    key = 'count_{}'.format(hashlib.md5(signature.encode('utf-8')).hexdigest())
+    count = cache.get(key)
+    if count is not None:
+        return count
+
+    count = _estimate_rows(queryset)
+    if count is None or count < conf['ESTIMATE_THRESHOLD']:
+        count = queryset.count()
+    cache.set(key, count, conf['TTL'])
+    return count
+
+
+class CachedCountPaginator(Paginator):
+    """
+    object_list 为 QuerySet 时总数用 cached_count
+    """
+    @cached_property
+    def count(self):
+        if isinstance(self.object_list, QuerySet):
+            return cached_count(self.object_list)
+        return super(CachedCountPaginator, self).count
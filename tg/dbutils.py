@@ -0,0 +1,79 @@
+# coding=utf-8
+"""
+数据库批量操作的工具函数
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+from django.db import connections, models, router
+from typing import Any, List, Iterable, Tuple
+
+from . import counting
+
+
+def chunked(items, size):
+    # type: (list, int) -> Iterable[list]
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def iter_values_chunks(queryset, fields, chunk_size=5000):
+    # type: (models.QuerySet, List[str], int) -> Iterable[List[tuple]]
+    """
+    按主键分段(WHERE id > 上一段最后的id ORDER BY id LIMIT n)遍历 queryset, 每次返回一段 values_list.
+    每段是一个独立的小查询, 不会一次把整张表读入内存, 也不会因为 OFFSET 越翻越慢.
+    返回的每行第一个值为主键
+    """
+    pk_name = queryset.model._meta.pk.name
+    qs = queryset.order_by(pk_name).values_list(pk_name, *fields)
+    last_pk = None
+    while True:
+        chunk = list((qs if last_pk is None else qs.filter(**{pk_name + '__gt': last_pk}))[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last_pk = chunk[-1][0]
+
+
+def bulk_update(model, objs, fields, batch_size=500):
+    # type: (type, List[models.Model], Iterable[str], int) -> int
+    """
+    按主键批量更新 objs 的 fields 字段. 返回更新的行数
+    """
+    fields = list(fields)
+    attnames = [model._meta.get_field(name).attname for name in fields]
+    rows = [(obj.pk, [getattr(obj, attname) for attname in attnames]) for obj in objs]
+    return bulk_update_rows(model, fields, rows, batch_size)
+
+
+def bulk_update_rows(model, fields, rows, batch_size=500):
+    # type: (type, List[str], List[Tuple[Any, list]], int) -> int
+    """
+    rows 为 (主键, [各字段的值]) 列表. 每批生成一条
+    UPDATE t SET f1 = CASE id WHEN .. THEN .. END, f2 = ... WHERE id IN (..)
+    直接拼 SQL, 避免为每个值构造 Case/When 表达式. 不触发 post_save, 这里让分页总数缓存失效. 返回更新的行数
+    """
+    fields = [model._meta.get_field(name) for name in fields]
+    connection = connections[router.db_for_write(model)]
+    qn = connection.ops.quote_name
+    pk_column = qn(model._meta.pk.column)
+    updated = 0
+    for batch in chunked(list(rows), batch_size):
+        sets, params = [], []
+        for i, field in enumerate(fields):
+            sets.append('{} = CASE {} {} END'.format(
+                qn(field.column), pk_column, ' '.join(['WHEN %s THEN %s'] * len(batch))
+            ))
+            for pk, row in batch:
+                params.extend((pk, field.get_db_prep_save(row[i], connection)))
+        params.extend(pk for pk, _row in batch)
+        sql = 'UPDATE {} SET {} WHERE {} IN ({})'.format(
+            qn(model._meta.db_table), ', '.join(sets), pk_column, ', '.join(['%s'] * len(batch))
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            updated += cursor.rowcount
+    if updated:
+        counting.bump_model(model)
+    return updated
@@ -0,0 +1,241 @@
+# coding=utf-8
+"""
+关注的投顾的投资观点时间线(推拉结合)
+
+推: 投资观点发布后, 把 (发布时间, 观点id) 写入该投顾每个粉丝的时间线. 时间线为 redis 有序集合(按发布时间),
+    只保留最新的 TIMELINE_SIZE 条. redis 不可用时存在缓存中.
+拉: 粉丝数超过 PULL_FANS_THRESHOLD 的投顾不推, 读取时从数据库取其最新观点.
+读取时合并自己的时间线和关注的大V的观点, 按 (发布时间, id) 倒序取一页, 与关注的投顾数无关.
+
+关注时把投顾最近的观点补到时间线中, 取消关注时删除.
+只有 pub_daytime 不为空的观点才算发布: 创建时已设置或之后从空变为有值时推送, 在后台线程中进行,
+不占用保存观点的请求(粉丝数最多 PULL_FANS_THRESHOLD, 每 FANOUT_BATCH 个一次 pipeline)
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import calendar
+import logging
+import threading
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.utils import timezone
+from django.utils.six.moves import queue
+from redis import RedisError
+from typing import Iterable, List, Tuple
+
+from . import dbutils, redis_utils, relcache
+from .models import InvestViewpoint, SnsFollow, UserInfo, UserStatistic
+
+logger = logging.getLogger('wh')
+
+DEFAULT_FEED = {
+    'TIMELINE_SIZE': 500,
+    # 粉丝数超过这个值的投顾, 观点在读取时拉取
+    'PULL_FANS_THRESHOLD': 10000,
+    # 大V名单的缓存时间(秒)
+    'PULL_ADVISERS_TTL': 300,
+}
+FANOUT_BATCH = 1000
+CACHE_TIMEOUT = 7 * 24 * 3600
+PULL_ADVISERS_KEY = 'feed_pull_advisers'
+
+_queue = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def feed_settings():
+    conf = dict(DEFAULT_FEED)
+    conf.update(getattr(settings, 'FEED', {}))
+    return conf
+
+
+def _timeline_key(user_id):
+    return redis_utils.make_key('feed', user_id)
+
+
+def _cache_key(user_id):
+    return 'feed_timeline_{}'.format(user_id)
+
+
+def viewpoint_ts(viewpoint):
+    # type: (InvestViewpoint) -> int
+    """
+    时间线中的分数, 发布时间的 unix 时间戳. 只用于已发布(pub_daytime 不为空)的观点
+    """
+    dt = viewpoint.pub_daytime
+    if timezone.is_aware(dt):
+        dt = timezone.make_naive(dt, timezone.utc)
+    return calendar.timegm(dt.timetuple())
+
+
+# ---------- 时间线存储 ----------
+def push(user_ids, items):
+    # type: (Iterable[int], List[Tuple[int, int]]) -> None
+    """
+    把 items((时间戳, 观点id)) 写入这些用户的时间线
+    """
+    user_ids = list(user_ids)
+    if not user_ids or not items:
+        return
+    size = feed_settings()['TIMELINE_SIZE']
+    r = redis_utils.get_redis()
+    if r is not None:
+        try:
+            args = [v for ts, vid in items for v in (ts, vid)]
+            for batch in dbutils.chunked(user_ids, FANOUT_BATCH):
+                pipe = r.pipeline(transaction=False)
+                for user_id in batch:
+                    key = _timeline_key(user_id)
+                    pipe.zadd(key, *args)
+                    pipe.zremrangebyrank(key, 0, -size - 1)
+                pipe.execute()
+            return
+        except RedisError as e:
+            redis_utils.mark_down(e)
+    for user_id in user_ids:
+        merged = set(map(tuple, cache.get(_cache_key(user_id)) or [])) | set(items)
+        cache.set(_cache_key(user_id), sorted(merged, reverse=True)[:size], CACHE_TIMEOUT)
+
+
+def remove(user_id, viewpoint_ids):
+    # type: (int, Iterable[int]) -> None
+    viewpoint_ids = set(viewpoint_ids)
+    if not viewpoint_ids:
+        return
+    r = redis_utils.get_redis()
+    if r is not None:
+        try:
+            r.zrem(_timeline_key(user_id), *viewpoint_ids)
+            return
+        except RedisError as e:
+            redis_utils.mark_down(e)
+    items = cache.get(_cache_key(user_id))
+    if items:
+        cache.set(_cache_key(user_id), [item for item in items if item[1] not in viewpoint_ids], CACHE_TIMEOUT)
+
+
+def timeline(user_id, before, count):
+    # type: (int, Tuple[int, int], int) -> List[Tuple[int, int]]
+    """
+    时间线中排在 before((时间戳, 观点id), 不含)之后的最多 count 条, 按时间倒序
+    """
+    r = redis_utils.get_redis()
+    if r is not None:
+        try:
+            # 同一秒发布的多条需要按 id 再排, 多取一些
+            rows = r.zrevrangebyscore(_timeline_key(user_id), before[0] if before else '+inf', '-inf',
+                                      start=0, num=count + 50, withscores=True)
+            items = [(int(score), int(member)) for member, score in rows]
+        except RedisError as e:
+            redis_utils.mark_down(e)
+            items = [tuple(item) for item in cache.get(_cache_key(user_id)) or []]
+    else:
+        items = [tuple(item) for item in cache.get(_cache_key(user_id)) or []]
+    items = sorted((item for item in items if before is None or item < before), reverse=True)
+    return items[:count]
+
+
+# ---------- 推 ----------
+def pull_advisers():
+    """
+    粉丝数超过 PULL_FANS_THRESHOLD 的投顾, 观点不推送
+    """
+    ids = cache.get(PULL_ADVISERS_KEY)
+    if ids is None:
+        conf = feed_settings()
+        ids = frozenset(UserStatistic.objects.filter(
+            fans_count__gte=conf['PULL_FANS_THRESHOLD'], user__user_class=UserInfo.T_ADVISER
+        ).values_list('user_id', flat=True))
+        cache.set(PULL_ADVISERS_KEY, ids, conf['PULL_ADVISERS_TTL'])
+    return ids
+
+
+def fanout(viewpoint):
+    # type: (InvestViewpoint) -> int
+    """
+    新发布的观点写入投顾粉丝的时间线, 返回写入的粉丝数. 大V和未发布的不推
+    """
+    if viewpoint.pub_daytime is None or viewpoint.owner_id in pull_advisers():
+        return 0
+    followers = SnsFollow.objects.filter(followee_id=viewpoint.owner_id).order_by()
+    pushed = 0
+    for chunk in dbutils.iter_values_chunks(followers, ['user_id'], FANOUT_BATCH):
+        push([user_id for _pk, user_id in chunk], [(viewpoint_ts(viewpoint), viewpoint.pk)])
+        pushed += len(chunk)
+    return pushed
+
+
+def schedule_fanout(viewpoint_id):
+    """
+    排队在后台推送观点, 推送时重新读取, 已删除或又取消发布的不推
+    """
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_work, name='feed_fanout')
+            _worker.daemon = True
+            _worker.start()
+    _queue.put(viewpoint_id)
+
+
+def _work():
+    while True:
+        viewpoint_id = _queue.get()
+        close_old_connections()
+        try:
+            viewpoint = InvestViewpoint.objects.only('id', 'owner_id', 'pub_daytime').filter(pk=viewpoint_id).first()
+            if viewpoint is not None:
+                fanout(viewpoint)
+        except Exception:
+            logger.exception('feed fanout %s failed', viewpoint_id)
+        finally:
+            close_old_connections()
+
+
+def _recent(adviser_ids, before=None, count=None):
+    """
+    这些投顾最新的观点 [(时间戳, 观点id)], 按时间倒序. before 不为空时只取不晚于 before 所在那一秒的
+    """
+    qs = InvestViewpoint.objects.filter(owner_id__in=list(adviser_ids), pub_daytime__isnull=False)
+    qs = qs.order_by('-pub_daytime', '-id')
+    if before is not None:
+        until = datetime.utcfromtimestamp(before[0] + 1)
+        if settings.USE_TZ:
+            until = timezone.make_aware(until, timezone.utc)
+        qs = qs.filter(pub_daytime__lt=until)
+    count = count or feed_settings()['TIMELINE_SIZE']
+    return [(viewpoint_ts(vp), vp.pk) for vp in qs.only('id', 'pub_daytime')[:count]]
+
+
+def on_follow(user_id, adviser_ids):
+    # type: (int, Iterable[int]) -> None
+    """
+    关注后把这些投顾最近的观点补进时间线
+    """
+    adviser_ids = set(adviser_ids) - pull_advisers()
+    if adviser_ids:
+        push([user_id], _recent(adviser_ids))
+
+
+def on_unfollow(user_id, adviser_ids):
+    # type: (int, Iterable[int]) -> None
+    adviser_ids = set(adviser_ids)
+    if adviser_ids:
+        remove(user_id, [vid for _ts, vid in _recent(adviser_ids)])
+
+
+# ---------- 读 ----------
+def read(user_id, before=None, count=10):
+    # type: (int, Tuple[int, int], int) -> List[Tuple[int, int]]
+    """
+    用户关注的投顾的观点, 排在 before 之后的 count 条 (时间戳, 观点id), 按时间倒序
+    """
+    items = timeline(user_id, before, count)
+    pulled = relcache.get_ids('followees', user_id) & pull_advisers()
+    if pulled:
+        items += [item for item in _recent(pulled, before, count + 50) if before is None or item < before]
+    return sorted(set(items), reverse=True)[:count]
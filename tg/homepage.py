@@ -0,0 +1,129 @@
+# coding=utf-8
+"""
+首页聚合接口(/api/index/)的各部分组装
+
+各部分(广告, 推荐牛投, 指数行情, 推荐牛股, 推荐资讯)互不依赖, 在线程池中并行取数据和序列化.
+与用户无关的结果序列化后整体缓存 INDEX['TTL'] 秒, 解析后的结果在进程内也保留到同一时刻,
+每个请求只需要按当前用户改写投顾的 is_follow/is_sign_contract.
+某一部分出错时记录日志, 返回中没有这一部分, 这次的结果也不缓存
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import json
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from rest_framework.utils.encoders import JSONEncoder
+from typing import Callable, Dict, List, Tuple
+
+from . import relcache
+
+logger = logging.getLogger('wh')
+
+DEFAULT_INDEX = {
+    'TTL': 15,
+    'THREADS': 5,
+}
+# 各部分中与用户相关的字段: 部分名: [(字段, 关系名)], 见 relcache.py
+USER_FIELDS = {
+    'invest_advisers': [('is_follow', 'followees'), ('is_sign_contract', 'signed_advisers')],
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+# 进程内的解析结果: 缓存键: (过期时间, 数据), 数据只读, 改写前先复制
+_shared = {}
+
+
+def index_settings():
+    conf = dict(DEFAULT_INDEX)
+    conf.update(getattr(settings, 'INDEX', {}))
+    return conf
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPool(index_settings()['THREADS'])
+    return _pool
+
+
+def _run(args):
+    name, func, request = args
+    # 线程池中的线程不经过 request_started/request_finished, 自己关闭过期或出错的数据库连接
+    close_old_connections()
+    try:
+        return name, func(request)
+    except Exception:
+        logger.exception('index section %s failed', name)
+        return name, None
+    finally:
+        close_old_connections()
+
+
+def build(request, sections):
+    # type: (object, List[Tuple[str, Callable]]) -> Tuple[Dict[str, object], bool]
+    """
+    并行执行各部分, sections 为 [(部分名, func(request) -> dict)], 各部分返回的 dict 合并在一起.
+    返回 (数据, 是否全部成功)
+    """
+    results = get_pool().map(_run, [(name, func, request) for name, func in sections])
+    data, complete = {}, True
+    for name, section in results:
+        if section is None:
+            complete = False
+        else:
+            data.update(section)
+    return data, complete
+
+
+def _cache_key(request):
+    return 'index_shared_v2_{}'.format(request.get_host())
+
+
+def shared_data(request, sections):
+    # type: (object, List[Tuple[str, Callable]]) -> Dict[str, object]
+    """
+    与用户无关的部分, 以 (生成时间, JSON 字符串) 缓存, 各进程解析一次后保留到生成后 TTL 秒.
+    图片等地址带有域名, 按 host 分开缓存
+    """
+    key = _cache_key(request)
+    ttl = index_settings()['TTL']
+    now = time.time()
+    expires, data = _shared.get(key, (0, None))
+    if expires > now:
+        return data
+    entry = cache.get(key)
+    if entry is None:
+        data, complete = build(request, sections)
+        blob = json.dumps(data, cls=JSONEncoder)
+        if not complete:
+            return json.loads(blob)
+        entry = (now, blob)
+        cache.set(key, entry, ttl)
+    built_at, blob = entry
+    data = json.loads(blob)
+    _shared[key] = (built_at + ttl, data)
+    return data
+
+
+def overlay_user(request, data):
+    # type: (object, Dict[str, object]) -> Dict[str, object]
+    """
+    按当前用户改写与用户相关的字段, 返回新的 dict, 不改动 shared_data 共用的数据
+    """
+    data = dict(data)
+    for section, fields in USER_FIELDS.items():
+        if data.get(section):
+            data[section] = [
+                dict(item, **{field: item['id'] in relcache.request_ids(request, relation) for field, relation in fields})
+                for item in data[section]
+            ]
+    return data
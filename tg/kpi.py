@@ -0,0 +1,225 @@
+# coding=utf-8
+"""
+投顾kpi指标(InvestAdviserKpi)批量计算
+
+按主键分段流式读取 InvestRecommendSecurity, 用 numpy 按 owner 分组归约:
+    success_ratio            已卖出的推荐中卖出价高于买入价的比例(百分比)
+    accumulate_profit_ratio  已卖出推荐的收益率连乘得到的复合收益率(百分比)
+结果与已有的 kpi 行比较, 有变化的批量 update, 没有的 bulk_create.
+增量模式只计算上次运行以来有新推荐或新卖出的投顾.
+
+之后对全部投顾计算综合得分(composite_score, 0~100), 为以下各项的加权平均, 权重见 settings.ADVISER_COMPOSITE_SCORE:
+    success_ratio            荐股成功率在全部投顾中的百分位
+    accumulate_profit_ratio  累计收益率的百分位
+    fans                     粉丝数的百分位
+    recency                  活跃度, 按最近一次推荐股票的时间衰减: 0.5 ** (距今天数 / 半衰期)
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+from typing import Dict, List
+
+from . import counting, dbutils, leaderboard
+from .models import InvestAdviserKpi, InvestRecommendSecurity, UserInfo, UserStatistic
+
+logger = logging.getLogger('wh')
+
+KPI_FIELDS = ('success_ratio', 'accumulate_profit_ratio')
+LAST_RUN_KEY = 'adviser_kpi_last_run'
+DECIMALS = 3
+# 字段 max_digits=12, decimal_places=3 能存的最大值. 复合收益率超出的按最大值存
+MAX_RATIO = 10 ** 9 - 10 ** -DECIMALS
+
+DEFAULT_COMPOSITE_SCORE = {
+    'WEIGHTS': {
+        'success_ratio': 0.35,
+        'accumulate_profit_ratio': 0.35,
+        'fans': 0.2,
+        'recency': 0.1,
+    },
+    'RECENCY_HALF_LIFE_DAYS': 30,
+}
+
+
+def composite_settings():
+    conf = dict(DEFAULT_COMPOSITE_SCORE)
+    conf.update(getattr(settings, 'ADVISER_COMPOSITE_SCORE', {}))
+    return conf
+
+
+def reduce_by_owner(owners, buy_price, sell_price):
+    # type: (np.ndarray, np.ndarray, np.ndarray) -> Dict[int, List[float]]
+    """
+    sell_price 为 nan 的是还没卖出的推荐, 不参与计算. 返回 {owner: [成功率, 复合收益率]}
+    """
+    closed = ~np.isnan(sell_price) & (buy_price > 0)
+    owners, buy_price, sell_price = owners[closed], buy_price[closed], sell_price[closed]
+    if not len(owners):
+        return {}
+    ids, inv = np.unique(owners, return_inverse=True)
+    count = np.bincount(inv)
+    wins = np.bincount(inv, weights=(sell_price > buy_price).astype(np.float64))
+    with np.errstate(divide='ignore'):
+        log_growth = np.bincount(inv, weights=np.log(np.maximum(sell_price, 0) / buy_price))
+    success = np.round(wins / count * 100, DECIMALS)
+    with np.errstate(over='ignore'):
+        profit = np.round(np.minimum(np.expm1(log_growth) * 100, MAX_RATIO), DECIMALS)
+    return {int(i): [float(s), float(p)] for i, s, p in zip(ids.tolist(), success, profit)}
+
+
+def percentile_rank(values):
+    # type: (np.ndarray) -> np.ndarray
+    """
+    每个值在 values 中的百分位(0~1). 相同的值取相同的百分位
+    """
+    if len(values) < 2:
+        return np.full(len(values), 0.5)
+    ordered = np.sort(values)
+    lo = np.searchsorted(ordered, values, 'left')
+    hi = np.searchsorted(ordered, values, 'right')
+    return (lo + hi - 1) / 2.0 / (len(values) - 1)
+
+
+def _changed(old, new):
+    return any(abs(a - b) >= 0.5 * 10 ** -DECIMALS for a, b in zip(old, new))
+
+
+def changed_owners(since):
+    # type: (datetime) -> List[int]
+    """
+    since 之后有新推荐或有卖出的投顾
+    """
+    return list(InvestRecommendSecurity.objects.filter(
+        Q(ctime__gte=since) | Q(sell_daytime__gte=since)
+    ).order_by().values_list('owner_id', flat=True).distinct())
+
+
+def compute_adviser_kpi(incremental=False, chunk_size=5000, batch_size=500, dry_run=False):
+    # type: (bool, int, int, bool) -> Dict[str, object]
+    """
+    重新计算投顾kpi. incremental 时只处理上次运行以来有变化的投顾, 没有上次运行的记录时全量计算
+    """
+    started = timezone.now()
+    stats = OrderedDict([('mode', 'full'), ('advisers', 0), ('recommends', 0), ('created', 0), ('updated', 0)])
+    timings = OrderedDict()
+
+    t = time.time()
+    since = cache.get(LAST_RUN_KEY) if incremental else None
+    if since is not None:
+        stats['mode'] = 'incremental'
+        owner_ids = changed_owners(since)
+        owner_chunks = list(dbutils.chunked(owner_ids, batch_size))
+    else:
+        owner_ids = list(UserInfo.objects.adviser().order_by('id').values_list('id', flat=True))
+        owner_chunks = [None]
+    timings['select'] = time.time() - t
+
+    t = time.time()
+    owners, buy_price, sell_price = [], [], []
+    for ids in owner_chunks:
+        qs = InvestRecommendSecurity.objects.all()
+        if ids is not None:
+            qs = qs.filter(owner_id__in=ids)
+        for chunk in dbutils.iter_values_chunks(qs, ['owner_id', 'buy_price', 'sell_price'], chunk_size):
+            cols = list(zip(*chunk))
+            owners.append(np.array(cols[1], np.int64))
+            buy_price.append(np.array(cols[2], np.float64))
+            sell_price.append(np.array([np.nan if v is None else float(v) for v in cols[3]]))
+    owners = np.concatenate(owners) if owners else np.empty(0, np.int64)
+    stats['recommends'] = len(owners)
+    timings['load'] = time.time() - t
+
+    t = time.time()
+    kpis = reduce_by_owner(
+        owners,
+        np.concatenate(buy_price) if buy_price else np.empty(0),
+        np.concatenate(sell_price) if sell_price else np.empty(0),
+    )
+    # 推荐过股票的投顾也要有 kpi 行, 还没有卖出的为 0
+    for owner in set(owner_ids).union(owners.tolist()):
+        kpis.setdefault(owner, [0.0, 0.0])
+    stats['advisers'] = len(kpis)
+
+    existing = {}
+    for ids in dbutils.chunked(sorted(kpis), batch_size):
+        for user_id, success, profit in InvestAdviserKpi.objects.filter(user_id__in=ids).values_list(
+                'user_id', *KPI_FIELDS):
+            existing[user_id] = [float(success), float(profit)]
+    to_update = [(user_id, values) for user_id, values in sorted(kpis.items())
+                 if user_id in existing and _changed(existing[user_id], values)]
+    to_create = [InvestAdviserKpi(user_id=user_id, **dict(zip(KPI_FIELDS, values)))
+                 for user_id, values in sorted(kpis.items()) if user_id not in existing]
+    stats['created'], stats['updated'] = len(to_create), len(to_update)
+    timings['compute'] = time.time() - t
+
+    if not dry_run:
+        t = time.time()
+        with transaction.atomic():
+            dbutils.bulk_update_rows(InvestAdviserKpi, KPI_FIELDS, to_update, batch_size)
+            InvestAdviserKpi.objects.bulk_create(to_create, batch_size=batch_size)
+            if to_create:
+                counting.bump_model(InvestAdviserKpi)
+        leaderboard.update_rows(InvestAdviserKpi, KPI_FIELDS, to_update + [
+            (obj.user_id, [getattr(obj, f) for f in KPI_FIELDS]) for obj in to_create
+        ])
+        cache.set(LAST_RUN_KEY, started, None)
+        timings['write'] = time.time() - t
+
+    t = time.time()
+    stats['composite_updated'] = compute_composite_scores(batch_size=batch_size, dry_run=dry_run)
+    timings['composite'] = time.time() - t
+
+    stats['timings'] = timings
+    return stats
+
+
+def compute_composite_scores(now=None, batch_size=500, dry_run=False):
+    # type: (datetime, int, bool) -> int
+    """
+    计算全部投顾的综合得分, 只写回有变化的行. 百分位是在全部投顾中排, 所以增量模式下也要全部计算.
+    返回有变化的行数
+    """
+    conf = composite_settings()
+    weights = conf['WEIGHTS']
+    now = now or timezone.now()
+
+    rows = list(InvestAdviserKpi.objects.order_by('user_id').values_list('user_id', 'composite_score', *KPI_FIELDS))
+    if not rows:
+        return 0
+    cols = list(zip(*rows))
+    pks = np.array(cols[0], np.int64)
+    old = np.array(cols[1], np.float64)
+    fans = dict(UserStatistic.objects.filter(user_id__in=InvestAdviserKpi.objects.values('user_id')).values_list(
+        'user_id', 'fans_count'))
+    last_active = dict(InvestRecommendSecurity.objects.order_by().values('owner_id').annotate(
+        last=Max('ctime')).values_list('owner_id', 'last'))
+
+    half_life = float(conf['RECENCY_HALF_LIFE_DAYS'])
+    days = np.array([(now - last_active[pk]).total_seconds() / 86400.0 if pk in last_active else np.inf
+                     for pk in pks.tolist()])
+    components = {
+        'success_ratio': percentile_rank(np.array(cols[2], np.float64)),
+        'accumulate_profit_ratio': percentile_rank(np.array(cols[3], np.float64)),
+        'fans': percentile_rank(np.array([fans.get(pk, 0) for pk in pks.tolist()], np.float64)),
+        'recency': np.power(0.5, np.maximum(days, 0) / half_life),
+    }
+    total_weight = float(sum(weights.values())) or 1.0
+    score = sum(components[name] * w for name, w in weights.items()) / total_weight * 100
+    score = np.round(score, DECIMALS)
+
+    changed = np.abs(score - old) >= 0.5 * 10 ** -DECIMALS
+    updates = [(pk, [v]) for pk, v in zip(pks[changed].tolist(), score[changed].tolist())]
+    if not dry_run:
+        dbutils.bulk_update_rows(InvestAdviserKpi, ['composite_score'], updates, batch_size)
+        leaderboard.update_rows(InvestAdviserKpi, ['composite_score'], updates)
+    return len(updates)
@@ -0,0 +1,399 @@
+# coding=utf-8
+"""
+牛组合/牛投顾排行榜
+
+每个排序字段一个榜单, 成员为主键, 分数为字段值. 优先存在 redis 有序集合中(ZADD/ZRANGE/ZCARD),
+分页读取为 O(log n + 每页条数), 不需要对整张表 ORDER BY 和 COUNT(*).
+redis 不可用时使用进程内的有序列表. 分数有变化时把变化的 {主键: 分数} 按序号记在缓存中,
+各进程每 CHECK_INTERVAL 秒按序号取出新的变化应用到自己的列表上, 不查询数据库;
+变化太多, 已经过期或者全量重建之后才从数据库重新加载.
+两种实现中分数相同的都按主键从小到大排: redis 中从大到小的榜单存负的分数, 成员为补齐到 10 位的主键, 一律用 ZRANGE.
+
+投顾榜单的成员为 InvestAdviserInfo(与分页返回的对象一致), 分数取自 InvestAdviserKpi, 没有 kpi 的投顾分数为 0.
+
+收益率/kpi 批量计算后调用 update_rows 增量更新, 单条保存/删除由 signals 中的回调更新.
+manage.py rebuild_leaderboards 从数据库全量重建
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import bisect
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from redis import RedisError
+from typing import Dict, Iterable, List, Tuple
+
+from . import dbutils, redis_utils
+from .models import InvestAdviserInfo, InvestAdviserKpi, PortfolioBaseInfo
+
+logger = logging.getLogger('wh')
+
+# 进程内榜单检查版本号的间隔(秒)
+CHECK_INTERVAL = getattr(settings, 'LEADERBOARD_CHECK_INTERVAL', 10)
+# redis 中的榜单为空时, 两次从数据库重建之间的最小间隔(秒)
+REBUILD_INTERVAL = 60
+# 缓存中每次变化的保存时间(秒), 落后超过 MAX_CHANGES 次或者行数超过 MAX_CHANGE_ROWS 的变化时从数据库重新加载
+CHANGE_TTL = 3600
+MAX_CHANGES = 1000
+MAX_CHANGE_ROWS = 10000
+RELOAD = 'reload'
+
+
+class LocalBoard(object):
+    """
+    进程内的榜单. 按 (排序键, 主键) 有序的列表, 用二分查找插入删除
+    """
+    def __init__(self, scores, reverse):
+        # type: (Dict[int, float], bool) -> None
+        self.reverse = reverse
+        self.scores = dict(scores)
+        self.items = sorted(self._item(pk, score) for pk, score in self.scores.items())
+
+    def _item(self, pk, score):
+        return (-score, pk) if self.reverse else (score, pk)
+
+    def __len__(self):
+        return len(self.items)
+
+    def ids(self, start, stop):
+        return [pk for _key, pk in self.items[start:stop]]
+
+    def set(self, pk, score):
+        self.remove(pk)
+        self.scores[pk] = score
+        bisect.insort(self.items, self._item(pk, score))
+
+    def remove(self, pk):
+        if pk in self.scores:
+            item = self._item(pk, self.scores.pop(pk))
+            del self.items[bisect.bisect_left(self.items, item)]
+
+
+def _member(pk):
+    return '{:010d}'.format(pk)
+
+
+class Board(object):
+    """
+    按 model.field 排序的榜单. reverse 为 True 时从大到小.
+    members 为榜单成员的模型(默认为 model), 与 model 的主键相同, score_path 为从 members 取分数的字段路径
+    """
+    def __init__(self, name, model, field, reverse=True, members=None, score_path=None):
+        self.name, self.model, self.field, self.reverse = name, model, field, reverse
+        self.members = members or model
+        self.score_path = score_path or field
+        # v3: 成员补齐位数, 从大到小的存负分数, 全部榜单从大到小. 旧格式的键不再读取, 第一次读取时从数据库重建
+        self.key = redis_utils.make_key('leaderboard', 'v3', name)
+        self.seq_key = 'leaderboard_seq_{}'.format(name)
+        self._lock = threading.Lock()
+        self._local = None  # type: LocalBoard
+        self._seq = None
+        self._checked_at = 0
+        self._rebuilt_at = 0
+
+    def load_scores(self, pks=None):
+        # type: (Iterable[int]) -> Dict[int, float]
+        qs = self.members.objects.all()
+        if pks is None:
+            return {pk: float(v or 0) for pk, v in qs.values_list('pk', self.score_path)}
+        scores = {}
+        for batch in dbutils.chunked(list(pks), 1000):
+            scores.update((pk, float(v or 0)) for pk, v in qs.filter(pk__in=batch).values_list('pk', self.score_path))
+        return scores
+
+    def _redis_score(self, score):
+        return -score if self.reverse else score
+
+    def _only_members(self, pks):
+        # type: (Iterable[int]) -> set
+        """
+        pks 中是榜单成员的
+        """
+        pks = set(pks)
+        if self.members is self.model:
+            return pks
+        found = set()
+        for batch in dbutils.chunked(list(pks), 1000):
+            found.update(self.members.objects.filter(pk__in=batch).values_list('pk', flat=True))
+        return found
+
+    # ---------- 读取 ----------
+    def count(self):
+        # type: () -> int
+        r = redis_utils.get_redis()
+        if r is not None:
+            try:
+                n = r.zcard(self.key)
+                if n == 0 and self._rebuild_redis(r):
+                    n = r.zcard(self.key)
+                return n
+            except RedisError as e:
+                redis_utils.mark_down(e)
+        return len(self.local())
+
+    def ids(self, start, stop):
+        # type: (int, int) -> List[int]
+        """
+        第 start 到 stop-1 名的主键
+        """
+        if stop <= start:
+            return []
+        r = redis_utils.get_redis()
+        if r is not None:
+            try:
+                return [int(m) for m in r.zrange(self.key, start, stop - 1)]
+            except RedisError as e:
+                redis_utils.mark_down(e)
+        return self.local().ids(start, stop)
+
+    def local(self):
+        # type: () -> LocalBoard
+        now = time.time()
+        if self._local is not None and now - self._checked_at < CHECK_INTERVAL:
+            return self._local
+        with self._lock:
+            self._checked_at = now
+            seq = self._current_seq()
+            if self._local is None or seq is None or not self._apply_changes(seq):
+                self._local, self._seq = LocalBoard(self.load_scores(), self.reverse), seq
+        return self._local
+
+    def _current_seq(self):
+        """
+        最新一次变化的序号. 序号从当前毫秒数开始, 键被淘汰后重新开始的序号比各进程记住的大, 不会误用旧的变化
+        """
+        seq = cache.get(self.seq_key)
+        if seq is None:
+            cache.add(self.seq_key, int(time.time() * 1000), None)
+            seq = cache.get(self.seq_key)
+        return seq
+
+    def _change_key(self, seq):
+        return 'leaderboard_change_{}_{}'.format(self.name, seq)
+
+    def _apply_changes(self, seq):
+        # type: (int) -> bool
+        """
+        把其他进程记下的第 self._seq + 1 到 seq 次变化应用到进程内的榜单. 不能增量应用时返回 False
+        """
+        if seq == self._seq:
+            return True
+        if self._seq is None or not 0 < seq - self._seq <= MAX_CHANGES:
+            return False
+        keys = [self._change_key(i) for i in range(self._seq + 1, seq + 1)]
+        changes = cache.get_many(keys)
+        if len(changes) < len(keys) or RELOAD in changes.values():
+            return False
+        for key in keys:
+            for pk, score in changes[key].items():
+                if score is None:
+                    self._local.remove(pk)
+                else:
+                    self._local.set(pk, score)
+        self._seq = seq
+        return True
+
+    def _publish(self, changes):
+        # type: (object) -> None
+        """
+        记下一次变化 {主键: 分数, 删除的为 None}, 或者 RELOAD 让各进程从数据库重新加载
+        """
+        if changes != RELOAD and len(changes) > MAX_CHANGE_ROWS:
+            changes = RELOAD
+        self._current_seq()
+        try:
+            seq = cache.incr(self.seq_key)
+        except ValueError:  # 刚好被淘汰, 各进程读不到序号时从数据库重新加载
+            return
+        cache.set(self._change_key(seq), changes, CHANGE_TTL)
+
+    # ---------- 更新 ----------
+    def update(self, scores):
+        # type: (Dict[int, float]) -> None
+        """
+        更新成员的分数, 不是成员的忽略
+        """
+        members = self._only_members(scores)
+        scores = {pk: score for pk, score in scores.items() if pk in members}
+        if not scores:
+            return
+        r = redis_utils.get_redis()
+        if r is not None:
+            try:
+                # 还没有建立的榜单不做增量更新, 读取时会从数据库全量建立
+                if r.exists(self.key):
+                    pipe = r.pipeline(transaction=False)
+                    items = list(scores.items())
+                    for i in range(0, len(items), 1000):
+                        pipe.zadd(self.key, *[v for pk, score in items[i:i + 1000]
+                                              for v in (self._redis_score(score), _member(pk))])
+                    pipe.execute()
+            except RedisError as e:
+                redis_utils.mark_down(e)
+        with self._lock:
+            if self._local is not None:
+                for pk, score in scores.items():
+                    self._local.set(pk, score)
+        self._publish(scores)
+
+    def remove(self, pks):
+        # type: (Iterable[int]) -> None
+        pks = list(pks)
+        if not pks:
+            return
+        r = redis_utils.get_redis()
+        if r is not None:
+            try:
+                r.zrem(self.key, *[_member(pk) for pk in pks])
+            except RedisError as e:
+                redis_utils.mark_down(e)
+        with self._lock:
+            if self._local is not None:
+                for pk in pks:
+                    self._local.remove(pk)
+        self._publish({pk: None for pk in pks})
+
+    def rebuild(self):
+        # type: () -> int
+        """
+        从数据库全量重建, 返回成员数
+        """
+        scores = self.load_scores()
+        r = redis_utils.get_redis()
+        if r is not None:
+            try:
+                self._write_redis(r, scores)
+            except RedisError as e:
+                redis_utils.mark_down(e)
+        with self._lock:
+            self._local = LocalBoard(scores, self.reverse)
+        self._publish(RELOAD)
+        return len(scores)
+
+    def _rebuild_redis(self, r):
+        """
+        redis 中没有榜单(redis 重启等)时从数据库重建, 每个进程 REBUILD_INTERVAL 秒内最多一次
+        """
+        now = time.time()
+        if now - self._rebuilt_at < REBUILD_INTERVAL:
+            return False
+        self._rebuilt_at = now
+        scores = self.load_scores()
+        if scores:
+            self._write_redis(r, scores)
+            logger.info('leaderboard %s rebuilt in redis, %s members', self.name, len(scores))
+        return bool(scores)
+
+    def _write_redis(self, r, scores):
+        """
+        写到临时键后 RENAME, 读取方不会看到重建了一半的榜单
+        """
+        tmp_key = '{}:tmp'.format(self.key)
+        items = list(scores.items())
+        pipe = r.pipeline(transaction=False)
+        pipe.delete(tmp_key)
+        for i in range(0, len(items), 1000):
+            pipe.zadd(tmp_key, *[v for pk, score in items[i:i + 1000] for v in (self._redis_score(score), _member(pk))])
+        if items:
+            pipe.rename(tmp_key, self.key)
+        else:
+            pipe.delete(self.key)
+        pipe.execute()
+
+
+BOARDS = OrderedDict((b.name, b) for b in (
+    Board('portfolio_curdate', PortfolioBaseInfo, 'curdate_ratio'),
+    Board('portfolio_week', PortfolioBaseInfo, 'week_ratio'),
+    Board('portfolio_month', PortfolioBaseInfo, 'month_ratio'),
+    Board('portfolio_accumulate', PortfolioBaseInfo, 'accumulate_ratio'),
+    Board('adviser_success', InvestAdviserKpi, 'success_ratio',
+          members=InvestAdviserInfo, score_path='user__investadviserkpi__success_ratio'),
+    Board('adviser_profit', InvestAdviserKpi, 'accumulate_profit_ratio',
+          members=InvestAdviserInfo, score_path='user__investadviserkpi__accumulate_profit_ratio'),
+    # 综合排名, 得分由 manage.py compute_adviser_kpi 计算, 见 kpi.py
+    Board('adviser_composite', InvestAdviserKpi, 'composite_score',
+          members=InvestAdviserInfo, score_path='user__investadviserkpi__composite_score'),
+))
+
+
+def get_board(name):
+    # type: (str) -> Board
+    return BOARDS[name]
+
+
+def update_rows(model, fields, rows):
+    # type: (type, Iterable[str], List[Tuple[int, list]]) -> None
+    """
+    model 的 rows((主键, [各字段的值])) 有变化后调用, 更新按这些字段排序的榜单
+    """
+    fields = list(fields)
+    for board in BOARDS.values():
+        if board.model is model and board.field in fields:
+            idx = fields.index(board.field)
+            board.update({int(pk): float(values[idx]) for pk, values in rows})
+
+
+def remove_rows(model, pks):
+    # type: (type, Iterable[int]) -> None
+    """
+    model 的行删除后调用. 成员不是 model 的榜单(投顾)中, 还是成员的分数改为 0
+    """
+    pks = list(pks)
+    for board in BOARDS.values():
+        if board.model is model:
+            if board.members is model:
+                board.remove(pks)
+            else:
+                board.update({pk: 0.0 for pk in pks})
+
+
+def add_members(members, pks):
+    # type: (type, Iterable[int]) -> None
+    """
+    新增榜单成员(如新的投顾)后调用
+    """
+    pks = list(pks)
+    for board in BOARDS.values():
+        if board.members is members and board.members is not board.model:
+            board.update(board.load_scores(pks))
+
+
+def remove_members(members, pks):
+    # type: (type, Iterable[int]) -> None
+    pks = list(pks)
+    for board in BOARDS.values():
+        if board.members is members and board.members is not board.model:
+            board.remove(pks)
+
+
+class BoardList(object):
+    """
+    把榜单包装成可分页的序列: count() 取榜单长度, 切片时按名次取主键, 再从 queryset 按主键取对象.
+    用法与 queryset 一样传给 paginate_queryset
+    """
+    def __init__(self, board, queryset):
+        self.board = board
+        self.queryset = queryset
+
+    def count(self):
+        return self.board.count()
+
+    def select_related(self, *fields):
+        return BoardList(self.board, self.queryset.select_related(*fields))
+
+    def prefetch_related(self, *lookups):
+        return BoardList(self.board, self.queryset.prefetch_related(*lookups))
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, k):
+        if not isinstance(k, slice):
+            return self[k:k + 1][0]
+        ids = self.board.ids(k.start or 0, k.stop if k.stop is not None else self.count())
+        objs = self.queryset.in_bulk(ids)
+        return [objs[pk] for pk in ids if pk in objs]
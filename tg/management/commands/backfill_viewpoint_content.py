@@ -0,0 +1,22 @@
+# coding=utf-8
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+from django.core.management.base import BaseCommand
+
+from ... import sanitize
+
+
+class Command(BaseCommand):
+    help = '为投资观点生成清理后的内容(content_clean/content_text/content_hash), 默认只处理还没有生成的'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='每段读取的行数')
+        parser.add_argument('--batch-size', type=int, default=200, help='每批写入的行数')
+        parser.add_argument('--recheck', action='store_true', default=False,
+                            help='检查全部行, 重新生成内容有变化的')
+
+    def handle(self, *args, **options):
+        stats = sanitize.backfill(
+            chunk_size=options['chunk_size'], batch_size=options['batch_size'], recheck=options['recheck'],
+        )
+        self.stdout.write(' '.join('{}={}'.format(k, v) for k, v in stats.items()))
@@ -0,0 +1,19 @@
+# coding=utf-8
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+from django.core.management.base import BaseCommand
+
+from ... import search
+
+
+class Command(BaseCommand):
+    help = '全量建立资讯/投资观点的搜索索引, 用于首次部署或修改了分词/权重之后, 见 tg/search'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kinds', nargs='*', help='文档类别, 默认全部: {}'.format(', '.join(search.KINDS)))
+        parser.add_argument('--chunk-size', type=int, default=1000, help='每次从数据库读取的行数')
+
+    def handle(self, *args, **options):
+        for kind in options['kinds'] or search.KINDS:
+            stats = search.build(kind, options['chunk_size'])
+            self.stdout.write(' '.join('{}={}'.format(k, v) for k, v in stats.items()))
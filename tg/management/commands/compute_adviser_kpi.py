@@ -0,0 +1,26 @@
+# coding=utf-8
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+from django.core.management.base import BaseCommand
+
+from ... import kpi
+
+
+class Command(BaseCommand):
+    help = '根据推荐股票记录重新计算投顾kpi(荐股成功率, 累计收益率)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true', default=False,
+                            help='只计算上次运行以来有新推荐或新卖出的投顾')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='每次读取的推荐记录数')
+        parser.add_argument('--batch-size', type=int, default=500, help='每批写入的行数')
+        parser.add_argument('--dry-run', action='store_true', default=False, help='只计算不写入')
+
+    def handle(self, *args, **options):
+        stats = kpi.compute_adviser_kpi(
+            incremental=options['incremental'], chunk_size=options['chunk_size'],
+            batch_size=options['batch_size'], dry_run=options['dry_run'],
+        )
+        timings = stats.pop('timings')
+        self.stdout.write(' '.join('{}={}'.format(k, v) for k, v in stats.items()))
+        self.stdout.write(' '.join('{}={:.3f}s'.format(k, v) for k, v in timings.items()))
@@ -0,0 +1,35 @@
+# coding=utf-8
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import arrow
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import ratios
+
+
+class Command(BaseCommand):
+    help = '批量计算推荐股票及投资组合的当日/周/月/累计收益率, 收盘后运行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', default=None, help='计算日期, 如 2016-11-21. 默认为今天')
+        parser.add_argument('--only', choices=('recommend', 'portfolio'), default=None, help='只计算其中一类')
+        parser.add_argument('--batch-size', type=int, default=1000, help='每批写入的行数')
+        parser.add_argument('--dry-run', action='store_true', default=False, help='只计算不写入')
+
+    def handle(self, *args, **options):
+        try:
+            day = arrow.get(options['date'], 'YYYY-MM-DD') if options['date'] else None
+        except (arrow.parser.ParserError, ValueError):
+            raise CommandError('日期格式不对: {}'.format(options['date']))
+
+        jobs = (
+            ('recommend', ratios.compute_recommend_ratios),
+            ('portfolio', ratios.compute_portfolio_ratios),
+        )
+        for name, func in jobs:
+            if options['only'] and options['only'] != name:
+                continue
+            stats = func(day, batch_size=options['batch_size'], dry_run=options['dry_run'])
+            timings = stats.pop('timings')
+            self.stdout.write('{}: {}'.format(name, ' '.join('{}={}'.format(k, v) for k, v in stats.items())))
+            self.stdout.write('{}: {}'.format(name, ' '.join('{}={:.3f}s'.format(k, v) for k, v in timings.items())))
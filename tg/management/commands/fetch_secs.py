@@ -1,15 +1,44 @@
 # coding=utf-8
 from __future__ import (unicode_literals, absolute_import, print_function)
 
+import time
+
 from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
 
-# from ... import md
+from ... import secmaster
 
 
 class Command(BaseCommand):
-    help = '获取股票代码表'
+    help = '获取股票代码表, 增量同步到 SecModel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default=None, help='代码表数据源类, 默认为 settings.SECMASTER 的 SOURCE')
+        parser.add_argument('--path', default=None, help='代码表文件(.csv/.jsonl/.json), 用于 FileSecSource')
+        parser.add_argument('--batch-size', type=int, default=500, help='每批写入的行数')
+        parser.add_argument('--no-deactivate', action='store_true', default=False,
+                            help='数据源中没有的代码不置为无效')
+        parser.add_argument('--dry-run', action='store_true', default=False, help='只比较不写入')
 
     def handle(self, *args, **options):
-        # md.get_secmodels()
+        started = time.time()
+        source_options = {'path': options['path']} if options['path'] else None
+        try:
+            source = secmaster.get_source(options['source'], source_options)
+            records = list(source.get_secmodels())
+        except (IOError, OSError, KeyError, ValueError) as e:
+            raise CommandError('读取代码表失败: {}'.format(e))
 
-        self.stdout.write('成功获取股票代码表')
+        try:
+            stats = secmaster.sync_secmodels(
+                records,
+                batch_size=options['batch_size'],
+                deactivate=not options['no_deactivate'],
+                dry_run=options['dry_run'],
+            )
+        except (ValueError, DatabaseError) as e:
+            raise CommandError('同步代码表失败, 没有写入任何修改: {}'.format(e))
+        timings = stats.pop('timings')
+        self.stdout.write(' '.join('{}={}'.format(k, v) for k, v in stats.items()))
+        self.stdout.write(' '.join('{}={:.3f}s'.format(k, v) for k, v in timings.items()))
+        self.stdout.write('成功获取股票代码表, 用时 {:.3f}s'.format(time.time() - started))
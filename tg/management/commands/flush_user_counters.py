@@ -0,0 +1,37 @@
+# coding=utf-8
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from ... import counters
+
+logger = logging.getLogger('wh')
+
+
+class Command(BaseCommand):
+    help = '把 redis 中缓冲的用户计数增量(粉丝数等)合并写入 data_user_stat, 见 tg/counters.py'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=5, help='写入间隔秒数')
+        parser.add_argument('--once', action='store_true', default=False, help='只写入一次就退出')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.time()
+            close_old_connections()
+            try:
+                stats = counters.flush()
+            except Exception:
+                logger.exception('flush user counters failed')
+            else:
+                if stats['users']:
+                    logger.info('user counters flushed: %s', dict(stats))
+                if options['once']:
+                    self.stdout.write(' '.join('{}={}'.format(k, v) for k, v in stats.items()))
+            if options['once']:
+                return
+            time.sleep(max(0, options['interval'] - (time.time() - started)))
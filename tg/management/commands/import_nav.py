@@ -0,0 +1,29 @@
+# coding=utf-8
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+from collections import defaultdict
+
+import arrow
+from django.core.management.base import BaseCommand, CommandError
+
+from ... import navstore, utils
+
+
+class Command(BaseCommand):
+    help = '导入组合收益走势到 navstore. 文件(.csv/.jsonl/.json)每行包括 portfolio_id, trade_time, nav, bench'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='数据文件')
+
+    def handle(self, *args, **options):
+        rows = defaultdict(list)
+        try:
+            for rec in utils.iter_records(options['path']):
+                rows[int(rec['portfolio_id'])].append(
+                    (arrow.get(rec['trade_time']).timestamp, float(rec['nav']), float(rec.get('bench') or 0))
+                )
+        except (IOError, OSError, KeyError, ValueError) as e:
+            raise CommandError('读取文件失败: {}'.format(e))
+
+        appended = sum(navstore.append(pid, items) for pid, items in rows.items())
+        self.stdout.write('导入 {} 个组合, 追加 {} 条'.format(len(rows), appended))
@@ -0,0 +1,25 @@
+# coding=utf-8
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from ... import prerender
+
+
+class Command(BaseCommand):
+    help = '全量预渲染资讯/投资观点详情页, 用于首次部署或清空了预渲染目录之后'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kinds', nargs='*', help='页面类别, 默认全部: {}'.format(', '.join(prerender.PAGES)))
+
+    def handle(self, *args, **options):
+        for kind in options['kinds'] or prerender.PAGES:
+            t = time.time()
+            model = prerender.PAGES[kind][0]
+            n = 0
+            for pk in model.objects.order_by('pk').values_list('pk', flat=True).iterator():
+                prerender.render(kind, pk)
+                n += 1
+            self.stdout.write('{}: {} 页, 用时 {:.3f}s'.format(kind, n, time.time() - t))
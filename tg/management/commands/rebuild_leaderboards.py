@@ -0,0 +1,21 @@
+# coding=utf-8
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from ... import leaderboard
+
+
+class Command(BaseCommand):
+    help = '从数据库全量重建牛组合/牛投顾排行榜'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='榜单名, 默认全部: {}'.format(', '.join(leaderboard.BOARDS)))
+
+    def handle(self, *args, **options):
+        for name in options['names'] or leaderboard.BOARDS:
+            t = time.time()
+            n = leaderboard.get_board(name).rebuild()
+            self.stdout.write('{}: {} 条, 用时 {:.3f}s'.format(name, n, time.time() - t))
@@ -0,0 +1,21 @@
+# coding=utf-8
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+from django.core.management.base import BaseCommand
+
+from ... import counters
+
+
+class Command(BaseCommand):
+    help = '按关注/订阅/签约/观点/荐股/组合记录重新统计用户计数(data_user_stat), 只修正不一致的行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000, help='每段处理的用户数')
+        parser.add_argument('--batch-size', type=int, default=500, help='每批写入的行数')
+        parser.add_argument('--dry-run', action='store_true', default=False, help='只比较不写入')
+
+    def handle(self, *args, **options):
+        stats = counters.reconcile(
+            chunk_size=options['chunk_size'], batch_size=options['batch_size'], dry_run=options['dry_run'],
+        )
+        self.stdout.write(' '.join('{}={}'.format(k, v) for k, v in stats.items()))
@@ -0,0 +1,82 @@
+# coding=utf-8
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import logging
+import time
+
+import arrow
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from ...dbutils import chunked
+from ...quotes import service
+from ...quotes.snapshot import SnapshotTable, assign_quote_slots, load_slot_map
+
+logger = logging.getLogger('wh')
+
+
+class Command(BaseCommand):
+    help = '行情快照更新进程. 定时从行情源批量取行情写入共享内存表, 全部 gunicorn worker 共用'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=None, help='刷新间隔秒数')
+        parser.add_argument('--once', action='store_true', default=False, help='只刷新一次就退出')
+
+    def handle(self, *args, **options):
+        conf = service.quotes_settings()
+        interval = options['interval'] or conf['UPDATER_INTERVAL']
+        feed = service.create_feed(conf['UPDATER_FEED'], conf['UPDATER_FEED_OPTIONS'])
+        table = SnapshotTable.create(conf['SNAPSHOT_PATH'], conf['SNAPSHOT_CAPACITY'])
+        self.stdout.write('行情快照: {} 容量: {}'.format(table.path, table.capacity))
+
+        slotmap, loaded_at = None, 0
+        while True:
+            started = time.time()
+            if slotmap is None or started - loaded_at > conf['UPDATER_RELOAD_SECS']:
+                close_old_connections()
+                assign_quote_slots()
+                slotmap = self.load_slots(table)
+                loaded_at = started
+            written = self.refresh(feed, table, slotmap, conf['UPDATER_BATCH_SIZE'])
+            logger.debug('quote snapshot refreshed %s/%s in %.3fs', written, len(slotmap), time.time() - started)
+            if options['once']:
+                self.stdout.write('写入行情 {} 条'.format(written))
+                return
+            time.sleep(max(0, interval - (time.time() - started)))
+
+    def load_slots(self, table):
+        """
+        有效代码的 symbol -> 行号. 行号超出容量的记录错误日志, 已经无效或者换了行号的代码的行清空
+        """
+        slots = load_slot_map()
+        overflow = sorted(s for s, slot in slots.items() if slot >= table.capacity)
+        if overflow:
+            logger.error('quote snapshot capacity %s is too small, %s symbols skipped: %s',
+                         table.capacity, len(overflow), ', '.join(overflow[:10]))
+        slotmap = {s: slot for s, slot in slots.items() if slot < table.capacity}
+        for slot, symbol in table.occupied().items():
+            if slotmap.get(symbol) != slot:
+                table.clear(slot)
+        return slotmap
+
+    def refresh(self, feed, table, slotmap, batch_size):
+        written = 0
+        for symbols in chunked(sorted(slotmap), batch_size):
+            try:
+                ticks = feed.get_last_ticks(symbols)
+            except Exception:
+                logger.exception('quote updater get_last_ticks failed')
+                continue
+            for symbol, tick in ticks.items():
+                if tick.get('last_price') is None:
+                    continue
+                # 单条行情格式不对时跳过, 不影响其他代码的刷新
+                try:
+                    trade_ts = arrow.get(tick['trade_time']).timestamp if tick.get('trade_time') else 0
+                    table.write(slotmap[symbol], symbol, tick['last_price'], tick.get('change') or 0.0,
+                                tick.get('volume') or 0, trade_ts)
+                except Exception:
+                    logger.warning('quote updater skip bad tick %s: %r', symbol, tick, exc_info=True)
+                    continue
+                written += 1
+        return written
@@ -0,0 +1,25 @@
+# coding=utf-8
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+from django.core.management.base import BaseCommand
+
+from ... import throttling, urls
+
+
+class Command(BaseCommand):
+    help = '查看各接口各个限流范围拒绝的请求数, 见 tg/throttling.py'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', default=False, help='显示后清零')
+
+    def handle(self, *args, **options):
+        names = []
+        for view in urls.view_collect:
+            urlname, buckets = throttling.view_buckets(view)
+            for bucket in buckets:
+                self.stdout.write('{} {}: {} 次/{}s'.format(urlname, bucket.scope, bucket.capacity, bucket.period))
+                names.append((urlname, bucket.scope))
+        for (urlname, scope), count in throttling.shed_counts(names).items():
+            self.stdout.write('shed {}:{}={}'.format(urlname, scope, count))
+        if options['reset']:
+            throttling.reset_shed_counts(names)
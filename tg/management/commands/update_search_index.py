@@ -0,0 +1,38 @@
+# coding=utf-8
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from ... import search
+
+logger = logging.getLogger('wh')
+
+
+class Command(BaseCommand):
+    help = '把 SearchChange 中记录的资讯/投资观点修改写入搜索索引, 见 tg/search'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=5, help='更新间隔秒数')
+        parser.add_argument('--once', action='store_true', default=False, help='只更新一次就退出')
+        parser.add_argument('--batch-size', type=int, default=5000, help='每次最多处理的修改记录数')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.time()
+            close_old_connections()
+            try:
+                stats = search.update(options['batch_size'])
+            except Exception:
+                logger.exception('update search index failed')
+            else:
+                if stats['changes']:
+                    logger.info('search index updated: %s', dict(stats))
+                if options['once']:
+                    self.stdout.write(' '.join('{}={}'.format(k, v) for k, v in stats.items()))
+            if options['once']:
+                return
+            time.sleep(max(0, options['interval'] - (time.time() - started)))
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 16:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tg', '0006_auto_20161121_1059'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='secmodel',
+            name='quote_slot',
+            field=models.IntegerField(blank=True, null=True, unique=True, verbose_name='\u884c\u60c5\u5feb\u7167\u884c\u53f7'),
+        ),
+    ]
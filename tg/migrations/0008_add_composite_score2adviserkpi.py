@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 16:25
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tg', '0007_add_quote_slot2secmodel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='investadviserkpi',
+            name='composite_score',
+            field=models.DecimalField(db_index=True, decimal_places=3, default=0, max_digits=7, verbose_name='\u7efc\u5408\u5f97\u5206'),
+        ),
+    ]
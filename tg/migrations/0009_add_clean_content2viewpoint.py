@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 16:39
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tg', '0008_add_composite_score2adviserkpi'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='investviewpoint',
+            name='content_clean',
+            field=models.TextField(blank=True, editable=False, verbose_name='\u6e05\u7406\u540e\u7684\u5185\u5bb9'),
+        ),
+        migrations.AddField(
+            model_name='investviewpoint',
+            name='content_hash',
+            field=models.CharField(blank=True, editable=False, max_length=40, verbose_name='\u5185\u5bb9\u7684sha1'),
+        ),
+        migrations.AddField(
+            model_name='investviewpoint',
+            name='content_text',
+            field=models.CharField(blank=True, editable=False, max_length=400, verbose_name='\u7eaf\u6587\u672c\u6458\u8981'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 16:42
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tg', '0009_add_clean_content2viewpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=20, verbose_name='\u7c7b\u522b')),
+                ('object_id', models.IntegerField(verbose_name='\u6587\u6863id')),
+                ('ctime', models.DateTimeField(auto_now_add=True, verbose_name='\u8bb0\u5f55\u65f6\u95f4')),
+            ],
+            options={
+                'db_table': 'data_search_change',
+                'verbose_name': '\u641c\u7d22\u7d22\u5f15\u5f85\u5904\u7406\u7684\u4fee\u6539',
+                'verbose_name_plural': '\u641c\u7d22\u7d22\u5f15\u5f85\u5904\u7406\u7684\u4fee\u6539',
+            },
+        ),
+    ]
@@ -0,0 +1,55 @@
+# coding=utf-8
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+from rest_framework import serializers
+from typing import List, Tuple
+
+
+def serializer_relations(serializer, prefix=''):
+    # type: (serializers.BaseSerializer, str) -> Tuple[List[str], List[str]]
+    """
+    收集 serializer 需要预先取出的关联. 各 serializer 在 Meta 中声明自身用到的关联:
+        class Meta:
+            select_related = ('user__userstatistic', )   # 外键/一对一
+            prefetch_related = ('topics', )               # 多对多/反向外键
+    嵌套的 serializer 按其 source 加上前缀, many=True 的嵌套及其下的关联都用 prefetch_related.
+    嵌套 serializer 的 source 必须是关联字段
+    """
+    meta = getattr(serializer, 'Meta', None)
+    select = [prefix + path for path in getattr(meta, 'select_related', ())]
+    prefetch = [prefix + path for path in getattr(meta, 'prefetch_related', ())]
+    for field in serializer.fields.values():
+        if isinstance(field, serializers.ListSerializer):
+            child, many = field.child, True
+        elif isinstance(field, serializers.BaseSerializer):
+            child, many = field, False
+        else:
+            continue
+        if field.source == '*':
+            child_select, child_prefetch = serializer_relations(child, prefix)
+            select += child_select
+            prefetch += child_prefetch
+            continue
+        path = prefix + field.source.replace('.', '__')
+        child_select, child_prefetch = serializer_relations(child, path + '__')
+        if many:
+            prefetch += [path] + child_select + child_prefetch
+        else:
+            select += [path] + child_select
+            prefetch += child_prefetch
+    return select, prefetch
+
+
+class RelatedFieldsMixin(object):
+    """
+    用于 GenericAPIView. filter_queryset 时按 serializer 声明的关联加上 select_related/prefetch_related,
+    列表每页的查询数不随条数增加
+    """
+    def filter_queryset(self, queryset):
+        queryset = super(RelatedFieldsMixin, self).filter_queryset(queryset)
+        select, prefetch = serializer_relations(self.get_serializer())
+        if select:
+            queryset = queryset.select_related(*sorted(set(select)))
+        if prefetch:
+            queryset = queryset.prefetch_related(*sorted(set(prefetch)))
+        return queryset
@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 
 import logging
 import uuid
+from collections import Counter
 
 import arrow
 from django.contrib.auth.base_user import AbstractBaseUser
@@ -10,15 +11,42 @@ from django.contrib.auth.models import UserManager, PermissionsMixin
 from django.core import validators
 from django.core.mail import send_mail
 from django.db import models, transaction
+from django.db.models.functions import Greatest
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils import timezone
 
+from . import counters, sanitize
+
 logger = logging.getLogger('wh')
 
 USER_COL_NAME = 'uid'
 OWNER_USER_COL_NAME = 'own_uid'  # 所有的者 id
 
 
+def _invalidate_relcache(name, user_id):
+    """
+    bulk_create 不触发 post_save, 需要手动让用户关系集合的缓存失效. 见 tg/relcache.py
+    """
+    from . import relcache
+    transaction.on_commit(lambda: relcache.invalidate(name, [user_id]))
+
+
+def _bump_count_version(model):
+    """
+    bulk_create 不触发 post_save, 手动让这个表相关的分页总数缓存失效. 见 tg/counting.py
+    """
+    from . import counting
+    counting.bump_model(model)
+
+
+def _feed_on_follow(user_id, followee_ids):
+    """
+    bulk_create 的关注不触发 post_save, 手动把新关注的投顾最近的观点补进时间线. 见 tg/feed.py
+    """
+    from . import feed
+    transaction.on_commit(lambda: feed.on_follow(user_id, followee_ids))
+
+
 def uuid_hex_str():
     return uuid.uuid4().get_hex()
 
@@ -34,6 +62,8 @@ class SecModel(models.Model):
     exchange = models.CharField('市场代码', max_length=8)
     symbol = models.CharField('证券标识(市场.代码)', max_length=40, db_index=True)
     is_active = models.BooleanField('是否有效', default=True)
+    # 行情共享内存表中的行号, 见 tg/quotes/snapshot.py
+    quote_slot = models.IntegerField('行情快照行号', blank=True, null=True, unique=True)
 
     class Meta:
         db_table = 'data_sec_model'
@@ -171,8 +201,9 @@ class UserInfo(AbstractBaseUser, PermissionsMixin):
         """
         按 email 或 mobile 查找用户. 如果没有找到则返回 None, 找到则返回第一个匹配的
         """
-        qs = cls.objects.filter(models.Q(email=q) | models.Q(mobile=q))
-        return qs[0] if qs else None
+        from .authbackends import ID_EMAIL, ID_MOBILE, find_users
+        users = find_users(q, kinds=(ID_EMAIL, ID_MOBILE))
+        return users[0] if users else None
 
 
 @python_2_unicode_compatible
@@ -205,6 +236,8 @@ class InvestAdviserKpi(models.Model):
 
     success_ratio = models.DecimalField('荐股成功率', max_digits=12, decimal_places=3)
     accumulate_profit_ratio = models.DecimalField('累计收益率', max_digits=12, decimal_places=3)
+    # 由 manage.py compute_adviser_kpi 计算, 用于综合排名. 见 tg/kpi.py
+    composite_score = models.DecimalField('综合得分', max_digits=7, decimal_places=3, default=0, db_index=True)
 
     class Meta:
         db_table = 'data_invest_adv_kpi'
@@ -215,11 +248,53 @@ class InvestAdviserKpi(models.Model):
         return "InvestAdviserKpi userid=".format(self.user_id)
 
 
+class UserStatisticManager(models.Manager):
+    def incr(self, field, deltas):
+        """
+        deltas 为 {user_id: 增量}. 经 counters 缓冲后由 manage.py flush_user_counters 写入, 见 tg/counters.py
+        """
+        counters.incr(field, deltas)
+
+    def add_counts(self, field, deltas, batch_size=500):
+        """
+        直接更新数据库. deltas 为 {user_id: 增量}, 增量都相同时为一条 UPDATE, 否则每批一条 CASE UPDATE.
+        计数最小为 0, 减到负数的置为 0
+        """
+        from . import counting
+        deltas = {user_id: delta for user_id, delta in deltas.items() if delta}
+        if deltas:
+            counting.bump_model(self.model)
+        if len(set(deltas.values())) == 1:
+            delta = next(iter(deltas.values()))
+            self.filter(user_id__in=list(deltas)).update(**{field: self._added(field, delta)})
+            return
+        items = sorted(deltas.items())
+        for i in range(0, len(items), batch_size):
+            batch = items[i:i + batch_size]
+            self.filter(user_id__in=[user_id for user_id, _delta in batch]).update(**{
+                field: models.Case(
+                    *[models.When(user_id=user_id, then=self._added(field, delta)) for user_id, delta in batch],
+                    default=models.F(field), output_field=models.IntegerField()
+                )
+            })
+
+    @staticmethod
+    def _added(field, delta):
+        """
+        field + delta, 不小于 0. 减少时为 GREATEST(field, -delta) + delta, 计算过程中也不出现负数(MySQL 中为无符号整数)
+        """
+        if delta > 0:
+            return models.F(field) + models.Value(delta)
+        return Greatest(models.F(field), models.Value(-delta)) + models.Value(delta)
+
+
 @python_2_unicode_compatible
 class UserStatistic(models.Model):
     """
     用户的统计信息
     """
+    objects = UserStatisticManager()
+
     user = models.OneToOneField(UserInfo, primary_key=True)
 
     fans_count = models.PositiveIntegerField('粉丝数', default=0)
@@ -245,10 +320,46 @@ class SnsFollowManager(models.Manager):
     @transaction.atomic
     def create(self, **kwargs):
         obj = super(SnsFollowManager, self).create(**kwargs)
-        UserStatistic.objects.filter(user=obj.user).update(followings_count=models.F('followings_count') + 1)
-        UserStatistic.objects.filter(user=obj.followee).update(fans_count=models.F('fans_count') + 1)
+        UserStatistic.objects.incr('followings_count', {obj.user_id: 1})
+        UserStatistic.objects.incr('fans_count', {obj.followee_id: 1})
         return obj
 
+    @transaction.atomic
+    def follow_many(self, user, followee_ids):
+        """
+        user 关注多个用户. 不存在的和已经关注的忽略, 返回新关注的 id 列表
+        """
+        followee_ids = set(int(i) for i in followee_ids)
+        if not followee_ids:
+            return []
+        existing = set(UserInfo.objects.filter(pk__in=followee_ids).values_list('pk', flat=True))
+        followed = set(self.filter(user=user, followee_id__in=existing).values_list('followee_id', flat=True))
+        new_ids = sorted(existing - followed)
+        if new_ids:
+            self.bulk_create([self.model(user=user, followee_id=i) for i in new_ids])
+            _bump_count_version(self.model)
+            UserStatistic.objects.incr('followings_count', {user.pk: len(new_ids)})
+            UserStatistic.objects.incr('fans_count', {i: 1 for i in new_ids})
+            _invalidate_relcache('followees', user.pk)
+            _feed_on_follow(user.pk, new_ids)
+        return new_ids
+
+    @transaction.atomic
+    def unfollow_many(self, user, followee_ids):
+        """
+        user 取消关注多个用户, 返回取消了的 id 列表
+        """
+        followee_ids = set(int(i) for i in followee_ids)
+        if not followee_ids:
+            return []
+        deleted_ids = sorted(self.filter(user=user, followee_id__in=followee_ids).values_list(
+            'followee_id', flat=True))
+        if deleted_ids:
+            self.filter(user=user, followee_id__in=deleted_ids).delete()
+            UserStatistic.objects.incr('followings_count', {user.pk: -len(deleted_ids)})
+            UserStatistic.objects.incr('fans_count', {i: -1 for i in deleted_ids})
+        return deleted_ids
+
 
 @python_2_unicode_compatible
 class SnsFollow(models.Model):
@@ -275,7 +386,8 @@ class PortfolioBaseInfoManager(models.Manager):
     @transaction.atomic
     def create(self, **kwargs):
         obj = super(PortfolioBaseInfoManager, self).create(**kwargs)  # type: PortfolioBaseInfo
-        UserStatistic.objects.filter(user=obj.owner).update(portfolios_count=models.F('portfolios_count') + 1)
+        UserStatistic.objects.incr('portfolios_count', {obj.owner_id: 1})
+        return obj
 
 
 @python_2_unicode_compatible
@@ -323,7 +435,8 @@ class InvestViewpointManager(models.Manager):
     @transaction.atomic
     def create(self, **kwargs):
         obj = super(InvestViewpointManager, self).create(**kwargs)  # type:InvestViewpoint
-        UserStatistic.objects.filter(user=obj.owner).update(viewpoints_count=models.F('viewpoints_count') + 1)
+        UserStatistic.objects.incr('viewpoints_count', {obj.owner_id: 1})
+        return obj
 
 
 @python_2_unicode_compatible
@@ -342,10 +455,31 @@ class InvestViewpoint(models.Model):
     pub_daytime = models.DateTimeField('发布时间', blank=True, null=True)
     sub_picture = models.ImageField('配图', upload_to=investviewpoint_subpic_uploadto, max_length=320,
                                     blank=True, null=True)
+    # 保存时由 content 生成, 见 sanitize.py
+    content_clean = models.TextField('清理后的内容', blank=True, editable=False)
+    content_text = models.CharField('纯文本摘要', max_length=sanitize.TEXT_MAX_LENGTH, blank=True, editable=False)
+    content_hash = models.CharField('内容的sha1', max_length=40, blank=True, editable=False)
 
     def __str__(self):
         return 'InvestViewpoint, title={}'.format(self.title)
 
+    def save(self, *args, **kwargs):
+        content_hash = sanitize.content_hash(self.content)
+        if content_hash != self.content_hash:
+            self.content_clean, self.content_text, self.content_hash = sanitize.sanitize(self.content)
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None and 'content' in update_fields:
+                kwargs['update_fields'] = set(update_fields) | {'content_clean', 'content_text', 'content_hash'}
+        return super(InvestViewpoint, self).save(*args, **kwargs)
+
+    def get_content_clean(self):
+        """
+        清理后的内容. 还没有回填的行按 content 清理, 结果在进程内缓存
+        """
+        if self.content_hash:
+            return self.content_clean
+        return sanitize.clean_memo(self.content)
+
     class Meta:
         db_table = 'data_invest_viewpoint'
         verbose_name = '投资观点'
@@ -375,7 +509,8 @@ class InvestRecommendSecurityManager(models.Manager):
     @transaction.atomic
     def create(self, **kwargs):
         obj = super(InvestRecommendSecurityManager, self).create(**kwargs)  # type: InvestRecommendSecurity
-        UserStatistic.objects.filter(user=obj.owner).update(recommend_secs_count=models.F('recommend_secs_count') + 1)
+        UserStatistic.objects.incr('recommend_secs_count', {obj.owner_id: 1})
+        return obj
 
 
 @python_2_unicode_compatible
@@ -418,9 +553,43 @@ class SubscribePorfolioManager(models.Manager):
     @transaction.atomic
     def create(self, **kwargs):
         obj = super(SubscribePorfolioManager, self).create(**kwargs)   # type: SubscribePortfolio
-        UserStatistic.objects.filter(user=obj.portfolio.owner).update(
-            portfolios_bysubscribe_count=models.F('portfolios_bysubscribe_count') + 1
-        )
+        UserStatistic.objects.incr('portfolios_bysubscribe_count', {obj.portfolio.owner_id: 1})
+        return obj
+
+    @transaction.atomic
+    def subscribe_many(self, user, portfolio_ids):
+        """
+        user 订阅多个组合. 不存在的和已经订阅的忽略, 返回新订阅的 id 列表
+        """
+        portfolio_ids = set(int(i) for i in portfolio_ids)
+        if not portfolio_ids:
+            return []
+        owners = dict(PortfolioBaseInfo.objects.filter(pk__in=portfolio_ids).values_list('pk', 'owner_id'))
+        subscribed = set(self.filter(user=user, portfolio_id__in=owners).values_list('portfolio_id', flat=True))
+        new_ids = sorted(set(owners) - subscribed)
+        if new_ids:
+            self.bulk_create([self.model(user=user, portfolio_id=i) for i in new_ids])
+            _bump_count_version(self.model)
+            UserStatistic.objects.incr('portfolios_bysubscribe_count', Counter(owners[i] for i in new_ids))
+            _invalidate_relcache('subscriptions', user.pk)
+        return new_ids
+
+    @transaction.atomic
+    def unsubscribe_many(self, user, portfolio_ids):
+        """
+        user 取消订阅多个组合, 返回取消了的 id 列表
+        """
+        portfolio_ids = set(int(i) for i in portfolio_ids)
+        if not portfolio_ids:
+            return []
+        rows = list(self.filter(user=user, portfolio_id__in=portfolio_ids).values_list(
+            'portfolio_id', 'portfolio__owner_id'))
+        deleted_ids = sorted(pid for pid, _owner_id in rows)
+        if deleted_ids:
+            self.filter(user=user, portfolio_id__in=deleted_ids).delete()
+            counts = Counter(owner_id for _pid, owner_id in rows)
+            UserStatistic.objects.incr('portfolios_bysubscribe_count', {k: -v for k, v in counts.items()})
+        return deleted_ids
 
 
 @python_2_unicode_compatible
@@ -457,9 +626,8 @@ class SignContractManager(models.Manager):
     @transaction.atomic
     def create(self, **kwargs):
         obj = super(SignContractManager, self).create(**kwargs)  # type: SignContract
-        UserStatistic.objects.filter(user=obj.adviser).update(
-            sign_contract_count = models.F('sign_contract_count') + 1
-        )
+        UserStatistic.objects.incr('sign_contract_count', {obj.adviser_id: 1})
+        return obj
 
 
 @python_2_unicode_compatible
@@ -516,6 +684,24 @@ class Ad(models.Model):
         return "Ad id = {}".format(self.id)
 
 
+@python_2_unicode_compatible
+class SearchChange(models.Model):
+    """
+    资讯/投资观点的修改记录, 由 manage.py update_search_index 写入搜索索引后删除, 见 tg/search
+    """
+    kind = models.CharField('类别', max_length=20)
+    object_id = models.IntegerField('文档id')
+    ctime = models.DateTimeField('记录时间', auto_now_add=True)
+
+    class Meta:
+        db_table = 'data_search_change'
+        verbose_name = '搜索索引待处理的修改'
+        verbose_name_plural = '搜索索引待处理的修改'
+
+    def __str__(self):
+        return "SearchChange kind={} object_id={}".format(self.kind, self.object_id)
+
+
 @python_2_unicode_compatible
 class ApplyAdviserJob(models.Model):
     """
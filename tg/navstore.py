@@ -0,0 +1,162 @@
+# coding=utf-8
+"""
+投资组合收益走势的列式存储
+
+每个组合三个只追加的定长数组文件, 读取时整个读入(np.fromfile), 大于 MMAP_MIN_BYTES 的才用 numpy.memmap 映射:
+    <NAVSTORE_ROOT>/<portfolio_id>.ts     int64   时间戳(秒)
+    <NAVSTORE_ROOT>/<portfolio_id>.nav    float64 组合累计收益率(百分比)
+    <NAVSTORE_ROOT>/<portfolio_id>.bench  float64 基准累计收益率(百分比)
+
+追加时先写 nav/bench 再写 ts, 读取方以三个文件中最短的长度为准, 所以不会读到写了一半的数据.
+按时间段读取用二分查找定位, 不需要逐行处理.
+py2 中每个 mmap 都占用一个文件描述符, 所以只映射大文件, 每个进程最多缓存 MAX_OPENED 个组合, 超过时淘汰最久没用的.
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+from typing import Dict, List, Tuple
+
+COLUMNS = (('ts', np.int64), ('nav', np.float64), ('bench', np.float64))
+ITEM_SIZE = 8
+MAX_OPENED = 200
+# 一列超过这个大小(约 13 万个点)才用 mmap
+MMAP_MIN_BYTES = 1024 * 1024
+
+_lock = threading.Lock()
+_opened = OrderedDict()  # portfolio_id -> (ts文件大小, NavSeries), 按最近使用排序
+
+
+class NavSeries(object):
+    """
+    一个组合的收益走势. ts/nav/bench 为等长的 numpy 数组
+    """
+    def __init__(self, ts, nav, bench):
+        self.ts, self.nav, self.bench = ts, nav, bench
+
+    def __len__(self):
+        return len(self.ts)
+
+    def slice(self, start=None, end=None):
+        # type: (int, int) -> NavSeries
+        """
+        取 start <= ts <= end 的部分(时间戳, 秒), 返回的是视图, 不复制数据
+        """
+        lo = 0 if start is None else int(np.searchsorted(self.ts, start, side='left'))
+        hi = len(self.ts) if end is None else int(np.searchsorted(self.ts, end, side='right'))
+        return NavSeries(self.ts[lo:hi], self.nav[lo:hi], self.bench[lo:hi])
+
+    def last(self):
+        # type: () -> Tuple[int, float, float]
+        return (int(self.ts[-1]), float(self.nav[-1]), float(self.bench[-1])) if len(self.ts) else None
+
+
+EMPTY = NavSeries(np.empty(0, np.int64), np.empty(0, np.float64), np.empty(0, np.float64))
+
+
+def _root():
+    return getattr(settings, 'NAVSTORE_ROOT')
+
+
+def _path(portfolio_id, column):
+    return os.path.join(_root(), '{}.{}'.format(int(portfolio_id), column))
+
+
+def load(portfolio_id):
+    # type: (int) -> NavSeries
+    """
+    映射一个组合的全部数据. 文件有追加时重新映射
+    """
+    try:
+        size = os.path.getsize(_path(portfolio_id, 'ts'))
+    except OSError:
+        return EMPTY
+    with _lock:
+        cached = _opened.pop(portfolio_id, None)
+        if cached and cached[0] == size:
+            _opened[portfolio_id] = cached
+            return cached[1]
+
+    length = size // ITEM_SIZE
+    arrays = []
+    for column, dtype in COLUMNS:
+        path = _path(portfolio_id, column)
+        length = min(length, os.path.getsize(path) // ITEM_SIZE)
+        arrays.append((path, dtype))
+    if length == 0:
+        return EMPTY
+    series = NavSeries(*[_read_column(path, dtype, length) for path, dtype in arrays])
+    with _lock:
+        _opened[portfolio_id] = (size, series)
+        while len(_opened) > MAX_OPENED:
+            _opened.popitem(last=False)
+    return series
+
+
+def _read_column(path, dtype, length):
+    if length * ITEM_SIZE < MMAP_MIN_BYTES:
+        return np.fromfile(path, dtype=dtype, count=length)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(length,))
+
+
+def read(portfolio_id, start=None, end=None):
+    # type: (int, int, int) -> NavSeries
+    return load(portfolio_id).slice(start, end)
+
+
+def read_tails(portfolio_ids, start, end=None):
+    # type: (List[int], int, int) -> Dict[int, NavSeries]
+    """
+    多个组合 start 之前(含)的最后一个点及之后到 end 的数据, 用于批量计算区间收益率, 没有数据的组合不在结果中.
+    只取每个组合末尾的一小段, 由调用方拼接后统一计算
+    """
+    result = {}
+    for portfolio_id in portfolio_ids:
+        series = load(portfolio_id)
+        if not len(series):
+            continue
+        series = series.slice(None, end)
+        lo = max(int(np.searchsorted(series.ts, start, side='right')) - 1, 0)
+        if lo < len(series):
+            result[portfolio_id] = NavSeries(series.ts[lo:], series.nav[lo:], series.bench[lo:])
+    return result
+
+
+def append(portfolio_id, rows):
+    # type: (int, List[Tuple[int, float, float]]) -> int
+    """
+    追加 (时间戳, 组合累计收益率, 基准累计收益率). 时间戳必须比已有的都大, 不满足的行被忽略.
+    返回追加的行数. 同一组合同一时间只应有一个写入方
+    """
+    rows = sorted(rows, key=lambda r: r[0])
+    last = load(portfolio_id).last()
+    if last is not None:
+        rows = [r for r in rows if r[0] > last[0]]
+    if not rows:
+        return 0
+    data = np.array(rows, dtype=np.float64)
+    if not os.path.isdir(_root()):
+        os.makedirs(_root())
+    _truncate_partial(portfolio_id)
+    for idx in (2, 1, 0):  # ts 最后写
+        column, dtype = COLUMNS[idx]
+        with open(_path(portfolio_id, column), 'ab') as f:
+            f.write(data[:, idx].astype(dtype).tobytes())
+    return len(rows)
+
+
+def _truncate_partial(portfolio_id):
+    """
+    上次追加中途失败时各列长度会不一致, 截断到最短的长度
+    """
+    paths = [_path(portfolio_id, column) for column, _dtype in COLUMNS]
+    sizes = [os.path.getsize(path) if os.path.exists(path) else 0 for path in paths]
+    length = min(sizes) // ITEM_SIZE * ITEM_SIZE
+    for path, size in zip(paths, sizes):
+        if size > length:
+            with open(path, 'r+b') as f:
+                f.truncate(length)
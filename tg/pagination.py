@@ -1,21 +1,122 @@
 # coding=utf-8
 from __future__ import (unicode_literals, absolute_import)
 
+import base64
+import json
 from collections import OrderedDict
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
+from django.utils import six
+from django.utils.encoding import force_text
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
 from rest_framework.pagination import PageNumberPagination
 
+from .counting import CachedCountPaginator
+
 
 class PageNumberPaginationWithPageSize(PageNumberPagination):
     """
     客户端可以指定每页数据的大小
+
+    视图定义了 cursor_ordering (如 ('-pub_daytime',)) 时, 请求带 cursor 参数(第一页为空值 ?cursor=)
+    就按游标分页: WHERE (排序列, id) 在上一页最后一条之后 ORDER BY 排序列, id LIMIT page_size,
+    翻到多深都只走索引取一页, 也不做 COUNT(*). 返回 {next, results}, next 为下一页的 cursor, 没有下一页时为 null.
+    不带 cursor 参数的请求仍按页码分页, 返回 {count, results}, count 有缓存, 见 counting.py
     """
+    django_paginator_class = CachedCountPaginator
     page_size_query_param = 'page_size'
     page_size = 10
     max_page_size = 300
+    cursor_query_param = 'cursor'
+
+    cursor_mode = False
+    next_cursor = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        ordering = getattr(view, 'cursor_ordering', None)
+        self.cursor_mode = bool(ordering) and self.cursor_query_param in request.query_params
+        if not self.cursor_mode:
+            return super(PageNumberPaginationWithPageSize, self).paginate_queryset(queryset, request, view)
+
+        self.request = request
+        page_size = self.get_page_size(request)
+        ordering = list(ordering)
+        tie_breaker = '-pk' if ordering[0].startswith('-') else 'pk'
+        if tie_breaker.lstrip('-') not in [o.lstrip('-') for o in ordering]:
+            ordering.append(tie_breaker)
+
+        queryset = queryset.order_by(*ordering)
+        cursor = request.query_params[self.cursor_query_param]
+        if cursor:
+            queryset = queryset.filter(self.cursor_filter(queryset.model, ordering, self.decode_cursor(cursor)))
+
+        results = list(queryset[:page_size + 1])
+        self.next_cursor = None
+        if len(results) > page_size:
+            results = results[:page_size]
+            self.next_cursor = self.encode_cursor([self.get_value(results[-1], o) for o in ordering])
+        return results
 
     def get_paginated_response(self, data):
+        if self.cursor_mode:
+            return Response(OrderedDict([
+                ('next', self.next_cursor),
+                ('results', data)
+            ]))
         return Response(OrderedDict([
             ('count', self.page.paginator.count),
             ('results', data)
         ]))
+
+    @staticmethod
+    def get_value(obj, order):
+        value = getattr(obj, order.lstrip('-'))
+        return None if value is None else force_text(value)
+
+    @staticmethod
+    def encode_cursor(values):
+        return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            cursor = cursor.encode('ascii')
+            values = json.loads(base64.urlsafe_b64decode(cursor + b'=' * (-len(cursor) % 4)).decode('utf-8'))
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound('无效的cursor')
+        # 每个值只能是 encode_cursor 生成的字符串或 null, 伪造的列表/对象等直接拒绝
+        if not isinstance(values, list) or not all(v is None or isinstance(v, six.string_types) for v in values):
+            raise NotFound('无效的cursor')
+        return values
+
+    @staticmethod
+    def cursor_filter(model, ordering, values):
+        """
+        (f1, f2, ..., id) 排在 values 之后的条件:
+            f1 在后 or (f1 = v1 and f2 在后) or ...
+        null 按 MySQL 的规则看作最小的值
+        """
+        if len(values) != len(ordering):
+            raise NotFound('无效的cursor')
+        condition, equal = Q(), Q()
+        for order, value in zip(ordering, values):
+            name = order.lstrip('-')
+            field = model._meta.pk if name == 'pk' else model._meta.get_field(name)
+            try:
+                value = None if value is None else field.to_python(value)
+            except (DjangoValidationError, TypeError, ValueError):
+                raise NotFound('无效的cursor')
+            desc = order.startswith('-')
+            if value is None:
+                after = Q(**{name + '__isnull': False}) if not desc else Q(pk__in=[])
+                same = Q(**{name + '__isnull': True})
+            else:
+                after = Q(**{name + ('__lt' if desc else '__gt'): value})
+                if desc and field.null:
+                    after |= Q(**{name + '__isnull': True})
+                same = Q(**{name: value})
+            condition |= equal & after
+            equal &= same
+        return condition
@@ -0,0 +1,223 @@
+# coding=utf-8
+"""
+资讯/投资观点详情页的预渲染
+
+详情页在数据保存后由后台线程渲染一次, gzip 压缩后写入缓存及 PRERENDER['DIR'] 下的文件,
+请求时直接返回压缩后的内容(客户端不支持 gzip 时解压), 不再每次渲染模板.
+缓存中没有时读文件, 都没有时当场渲染.
+
+渲染结果早于模板文件的修改时间时视为过期: 先返回旧的内容, 同时排队重新渲染.
+数据删除后清除缓存和文件
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import gzip
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+from django.template.loader import get_template
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.six.moves import queue
+from typing import Optional, Tuple
+
+from .models import InvestViewpoint, News
+
+logger = logging.getLogger('wh')
+
+DEFAULT_PRERENDER = {
+    'DIR': os.path.join(settings.BASE_DIR, 'var', 'prerender'),
+    'CACHE_TIMEOUT': 24 * 3600,
+    # 返回给客户端的 Cache-Control: max-age
+    'MAX_AGE': 300,
+}
+# 页面类别: (模型, 模板, 模板中的变量名, select_related)
+PAGES = {
+    'news': (News, 'tg/newsinfo.html', 'news', ()),
+    'viewpoint': (InvestViewpoint, 'tg/investviewpointinfo.html', 'vp', ('owner__investadviserinfo',)),
+}
+
+_queue = queue.Queue()
+_queued = set()
+_queued_lock = threading.Lock()
+_worker = None
+_template_paths = {}
+
+
+def prerender_settings():
+    conf = dict(DEFAULT_PRERENDER)
+    conf.update(getattr(settings, 'PRERENDER', {}))
+    return conf
+
+
+def kind_of(model):
+    for kind, (page_model, _template, _name, _related) in PAGES.items():
+        if page_model is model:
+            return kind
+    return None
+
+
+def _cache_key(kind, pk):
+    return 'prerender_{}_{}'.format(kind, pk)
+
+
+def _file_path(kind, pk):
+    return os.path.join(prerender_settings()['DIR'], kind, '{}.html.gz'.format(pk))
+
+
+def template_mtime(kind):
+    # type: (str) -> float
+    """
+    模板文件的修改时间. 模板文件的路径每个进程只查找一次
+    """
+    template_name = PAGES[kind][1]
+    path = _template_paths.get(template_name)
+    if path is None:
+        path = _template_paths[template_name] = get_template(template_name).origin.name
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
+
+
+def compress(html):
+    # type: (unicode) -> bytes
+    buf = io.BytesIO()
+    # mtime 固定, 相同的内容压缩后相同, ETag 才不会变
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(html.encode('utf-8'))
+    return buf.getvalue()
+
+
+def decompress(content):
+    # type: (bytes) -> bytes
+    with gzip.GzipFile(fileobj=io.BytesIO(content), mode='rb') as f:
+        return f.read()
+
+
+def render(kind, pk):
+    # type: (str, int) -> Optional[Tuple[float, bytes]]
+    """
+    渲染并保存, 返回 (渲染时间, gzip 后的内容). 数据不存在时清除已有的, 返回 None
+    """
+    model, template_name, name, related = PAGES[kind]
+    obj = model.objects.select_related(*related).filter(pk=pk).first()
+    if obj is None:
+        discard(kind, pk)
+        return None
+    rendered_at = time.time()
+    content = compress(get_template(template_name).render({name: obj}))
+
+    path = _file_path(kind, pk)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.rename(tmp_path, path)
+    cache.set(_cache_key(kind, pk), (rendered_at, content), prerender_settings()['CACHE_TIMEOUT'])
+    return rendered_at, content
+
+
+def discard(kind, pk):
+    cache.delete(_cache_key(kind, pk))
+    try:
+        os.remove(_file_path(kind, pk))
+    except OSError:
+        pass
+
+
+def _load(kind, pk):
+    entry = cache.get(_cache_key(kind, pk))
+    if entry is not None:
+        return entry
+    path = _file_path(kind, pk)
+    try:
+        rendered_at = os.path.getmtime(path)
+        with open(path, 'rb') as f:
+            content = f.read()
+    except (IOError, OSError):
+        return None
+    entry = (rendered_at, content)
+    cache.set(_cache_key(kind, pk), entry, prerender_settings()['CACHE_TIMEOUT'])
+    return entry
+
+
+def get_page(kind, pk):
+    # type: (str, int) -> Optional[bytes]
+    """
+    gzip 后的页面, 数据不存在时返回 None
+    """
+    entry = _load(kind, pk)
+    if entry is None:
+        entry = render(kind, pk)
+        return entry[1] if entry else None
+    rendered_at, content = entry
+    if rendered_at < template_mtime(kind):
+        schedule(kind, pk)
+    return content
+
+
+def page_response(request, kind, pk):
+    """
+    详情页的 HttpResponse. 客户端支持 gzip 时直接返回压缩的内容, 带 ETag 及 Cache-Control
+    """
+    # url 中的 pk 为字符串, 转为 int 后与保存时排队的 (kind, pk) 相同
+    content = get_page(kind, int(pk)) if '{}'.format(pk).isdigit() else None
+    if content is None:
+        raise Http404
+    use_gzip = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    etag = '"{}{}"'.format(hashlib.md5(content).hexdigest(), '-gzip' if use_gzip else '')
+    if etag in [e.strip() for e in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content if use_gzip else decompress(content), content_type='text/html; charset=utf-8')
+        if use_gzip:
+            response['Content-Encoding'] = 'gzip'
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=prerender_settings()['MAX_AGE'])
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+# ---------- 后台渲染 ----------
+def schedule(kind, pk):
+    """
+    排队重新渲染, 已经在队列中的不重复加入
+    """
+    with _queued_lock:
+        if (kind, pk) in _queued:
+            return
+        _queued.add((kind, pk))
+    _ensure_worker()
+    _queue.put((kind, pk))
+
+
+def _ensure_worker():
+    global _worker
+    with _queued_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_work, name='prerender')
+            _worker.daemon = True
+            _worker.start()
+
+
+def _work():
+    while True:
+        kind, pk = _queue.get()
+        with _queued_lock:
+            _queued.discard((kind, pk))
+        close_old_connections()
+        try:
+            render(kind, pk)
+        except Exception:
+            logger.exception('prerender %s %s failed', kind, pk)
+        finally:
+            close_old_connections()
@@ -0,0 +1,13 @@
+# coding=utf-8
+"""
+行情服务
+
+    from tg import quotes
+    sechqmap = quotes.get_last_ticks(['SHSE.600000', 'SZSE.000001'])
+
+行情源通过 settings.QUOTES 配置, 见 feeds.py.
+多个 gunicorn worker 共用的共享内存行情快照表见 snapshot.py
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+from .service import get_last_ticks, get_feed, reset
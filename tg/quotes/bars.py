@@ -0,0 +1,68 @@
+# coding=utf-8
+"""
+日线收盘价数据源, 用于批量计算收益率(tg/ratios.py)
+
+    from tg.quotes import bars
+    closes = bars.get_source().get_daily_closes(['SHSE.600000'], start_ts, end_ts)
+    # {'SHSE.600000': (交易日时间戳数组, 收盘价数组)}, 均为按时间升序的 numpy 数组
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+from collections import defaultdict
+
+import arrow
+import numpy as np
+from django.utils.module_loading import import_string
+from typing import Dict, List, Tuple
+
+from .. import utils
+from .service import quotes_settings
+
+
+class BaseBarSource(object):
+    def __init__(self, **options):
+        self.options = options
+
+    def get_daily_closes(self, symbols, start_ts, end_ts):
+        # type: (List[str], int, int) -> Dict[str, Tuple[np.ndarray, np.ndarray]]
+        """
+        返回 start_ts <= 交易日 <= end_ts 的收盘价. 交易日时间戳为当天0点(秒)
+        """
+        raise NotImplementedError
+
+
+class NullBarSource(BaseBarSource):
+    def get_daily_closes(self, symbols, start_ts, end_ts):
+        return {}
+
+
+class FileBarSource(BaseBarSource):
+    """
+    从本地文件(.csv/.jsonl/.json)读取日线, 每行包括 symbol, trade_date, close
+    """
+    def __init__(self, path, **options):
+        super(FileBarSource, self).__init__(**options)
+        rows = defaultdict(list)
+        for rec in utils.iter_records(path):
+            rows[rec['symbol']].append((arrow.get(rec['trade_date']).floor('day').timestamp, float(rec['close'])))
+        self._bars = {}
+        for symbol, items in rows.items():
+            items.sort()
+            self._bars[symbol] = (np.array([t for t, _c in items], np.int64), np.array([c for _t, c in items]))
+
+    def get_daily_closes(self, symbols, start_ts, end_ts):
+        result = {}
+        for s in symbols:
+            if s not in self._bars:
+                continue
+            ts, closes = self._bars[s]
+            lo, hi = np.searchsorted(ts, start_ts, 'left'), np.searchsorted(ts, end_ts, 'right')
+            if hi > lo:
+                result[s] = (ts[lo:hi], closes[lo:hi])
+        return result
+
+
+def get_source():
+    # type: () -> BaseBarSource
+    conf = quotes_settings()
+    return import_string(conf['BAR_SOURCE'])(**conf['BAR_SOURCE_OPTIONS'])
@@ -0,0 +1,153 @@
+# coding=utf-8
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import bisect
+import logging
+import os
+import threading
+import time
+
+import arrow
+from typing import Dict, List, Iterable
+
+from .. import utils
+
+logger = logging.getLogger('wh')
+
+
+def _to_float(v):
+    try:
+        return float(v) if v not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+
+def make_tick(record):
+    # type: (dict) -> dict
+    """
+    把行情源的一条记录规整为统一的 tick 格式.
+    change 为涨跌额, change_ratio 为涨跌幅(百分比), 行情源没有给出时按 pre_close 计算
+    """
+    last_price = _to_float(record.get('last_price', record.get('price')))
+    pre_close = _to_float(record.get('pre_close'))
+    change = _to_float(record.get('change'))
+    change_ratio = _to_float(record.get('change_ratio'))
+    if change is None and last_price is not None and pre_close:
+        change = last_price - pre_close
+    if change_ratio is None and change is not None and pre_close:
+        change_ratio = change / pre_close * 100
+    return {
+        'symbol': record['symbol'],
+        'last_price': last_price,
+        'pre_close': pre_close,
+        'change': round(change, 4) if change is not None else None,
+        'change_ratio': round(change_ratio, 4) if change_ratio is not None else None,
+        'volume': int(_to_float(record.get('volume')) or 0),
+        'amount': _to_float(record.get('amount')) or 0.0,
+        'trade_time': record.get('trade_time', ''),
+    }
+
+
+class BaseFeed(object):
+    """
+    行情源. 子类实现 get_last_ticks, 一次取回一批代码的最新 tick
+    """
+    def __init__(self, **options):
+        self.options = options
+
+    def get_last_ticks(self, symbols):
+        # type: (List[str]) -> Dict[str, dict]
+        """
+        symbols 为 SecModel.symbol 格式, 如 SZSE.000001.
+        返回 {symbol: tick}, 行情源没有的代码不出现在结果中
+        """
+        raise NotImplementedError
+
+
+class NullFeed(BaseFeed):
+    """
+    没有行情源时使用, 什么都不返回
+    """
+    def get_last_ticks(self, symbols):
+        return {}
+
+
+class FileFeed(BaseFeed):
+    """
+    从本地快照文件读取行情(.jsonl/.csv/.json), 每条记录一个代码的最新行情.
+    文件修改后自动重新加载, 用于开发测试或由外部程序定时写入快照
+    """
+    def __init__(self, path, check_interval=1, **options):
+        super(FileFeed, self).__init__(**options)
+        self.path = path
+        self.check_interval = check_interval
+        self._ticks = {}
+        self._mtime = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def _maybe_reload(self):
+        now = time.time()
+        if now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            self._checked_at = now
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                logger.warning('quote file not found: %s', self.path)
+                return
+            if mtime == self._mtime:
+                return
+            self._ticks = {rec['symbol']: make_tick(rec) for rec in utils.iter_records(self.path)}
+            self._mtime = mtime
+
+    def get_last_ticks(self, symbols):
+        self._maybe_reload()
+        ticks = self._ticks
+        return {s: ticks[s] for s in symbols if s in ticks}
+
+
+class ReplayFeed(BaseFeed):
+    """
+    回放历史 tick 文件. 文件中每条记录要有 trade_time, 回放时钟从第一条记录的时间开始,
+    按 speed 倍速前进, 返回每个代码在回放时钟之前的最后一条 tick
+    """
+    def __init__(self, path, speed=1.0, loop=True, **options):
+        super(ReplayFeed, self).__init__(**options)
+        self.speed = float(speed)
+        self.loop = loop
+        self._times = {}   # symbol -> [timestamp, ...] 升序
+        self._ticks = {}   # symbol -> [tick, ...]
+        self._load(utils.iter_records(path))
+        self._started_at = time.time()
+
+    def _load(self, records):
+        # type: (Iterable[dict]) -> None
+        rows = sorted(
+            ((arrow.get(rec['trade_time']).timestamp, make_tick(rec)) for rec in records),
+            key=lambda x: x[0]
+        )
+        for ts, tick in rows:
+            self._times.setdefault(tick['symbol'], []).append(ts)
+            self._ticks.setdefault(tick['symbol'], []).append(tick)
+        self._begin = rows[0][0] if rows else 0
+        self._span = (rows[-1][0] - self._begin) if rows else 0
+
+    def replay_clock(self, now=None):
+        elapsed = ((time.time() if now is None else now) - self._started_at) * self.speed
+        if self.loop and self._span > 0:
+            elapsed %= self._span + 1
+        return self._begin + elapsed
+
+    def get_last_ticks(self, symbols):
+        clock = self.replay_clock()
+        result = {}
+        for s in symbols:
+            times = self._times.get(s)
+            if not times:
+                continue
+            idx = bisect.bisect_right(times, clock) - 1
+            if idx >= 0:
+                result[s] = self._ticks[s][idx]
+        return result
@@ -0,0 +1,98 @@
+# coding=utf-8
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import logging
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from typing import Dict, List, Tuple
+
+from .feeds import BaseFeed
+from .ttlcache import TTLCache
+
+logger = logging.getLogger('wh')
+
+DEFAULT_QUOTES = {
+    'FEED': 'tg.quotes.feeds.NullFeed',
+    'FEED_OPTIONS': {},
+    'TTL': 3,
+    # 以下用于行情快照更新进程(manage.py run_quote_updater)
+    'SNAPSHOT_PATH': '',
+    'SNAPSHOT_CAPACITY': 16384,
+    'UPDATER_FEED': 'tg.quotes.feeds.NullFeed',
+    'UPDATER_FEED_OPTIONS': {},
+    'UPDATER_INTERVAL': 3,
+    'UPDATER_BATCH_SIZE': 500,
+    'UPDATER_RELOAD_SECS': 300,
+    # 日线收盘价数据源, 见 bars.py
+    'BAR_SOURCE': 'tg.quotes.bars.NullBarSource',
+    'BAR_SOURCE_OPTIONS': {},
+}
+
+_lock = threading.Lock()
+# (行情源, 缓存), 一起创建/丢弃. 只整体替换, 读取时先取到局部变量, 与 reset() 并发时也不会取到 None
+_state = None  # type: Tuple[BaseFeed, TTLCache]
+
+
+def quotes_settings():
+    conf = dict(DEFAULT_QUOTES)
+    conf.update(getattr(settings, 'QUOTES', {}))
+    return conf
+
+
+def create_feed(path, options):
+    # type: (str, dict) -> BaseFeed
+    return import_string(path)(**options)
+
+
+def _get_state():
+    # type: () -> Tuple[BaseFeed, TTLCache]
+    global _state
+    state = _state
+    if state is None:
+        with _lock:
+            state = _state
+            if state is None:
+                conf = quotes_settings()
+                state = _state = (create_feed(conf['FEED'], conf['FEED_OPTIONS']), TTLCache(conf['TTL']))
+    return state
+
+
+def get_feed():
+    # type: () -> BaseFeed
+    return _get_state()[0]
+
+
+def reset():
+    """
+    丢弃当前行情源及缓存, 下次调用时按配置重新创建
+    """
+    global _state
+    with _lock:
+        _state = None
+
+
+def get_last_ticks(symbols):
+    # type: (List[str]) -> Dict[str, dict]
+    """
+    批量获取最新行情. symbols 为 SecModel.symbol 格式, 如 SZSE.000001
+    先查进程内缓存, 没有命中的代码合并成一次请求发给行情源.
+    返回 {symbol: tick}, 没有行情的代码不在结果中
+    """
+    feed, cache = _get_state()
+    symbols = list(set(s for s in symbols if s))
+    if not symbols:
+        return {}
+
+    hits, misses = cache.get_many(symbols)
+    if misses:
+        try:
+            fetched = feed.get_last_ticks(misses)
+        except Exception:
+            logger.exception('get_last_ticks from feed failed, symbols=%s', misses)
+            fetched = {}
+        # 没有行情的代码也缓存起来, 避免每次请求都去访问行情源
+        cache.set_many({s: fetched.get(s) for s in misses})
+        hits.update(fetched)
+    return {s: tick for s, tick in hits.items() if tick is not None}
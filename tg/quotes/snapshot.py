@@ -0,0 +1,316 @@
+# coding=utf-8
+"""
+行情快照共享内存表
+
+由单独的更新进程(manage.py run_quote_updater)写入, gunicorn 的各个 worker 通过 mmap 只读映射同一个文件,
+不用每个 worker 各自缓存和刷新行情.
+
+文件布局(小端):
+    头部 64 字节: magic(8s) version(I) capacity(I) row_size(I) reserved(I) generation(Q)
+    变化记录 CHANGELOG_SIZE 个 uint32: 第 generation % CHANGELOG_SIZE 个为这次变化的行号
+    之后为 capacity 行, 每行 96 字节, 第 n 行对应 SecModel.quote_slot == n:
+        seq(Q) symbol(40s) last_price(d) change(d) volume(q) trade_ts(d) 补齐到96字节
+    symbol 与 SecModel.symbol 同为最长 40 个字符, 更长的拒绝写入, 不截断
+
+每行用 seqlock 保证一致: 写入前 seq 加 1 变为奇数, 写完再加 1 变为偶数.
+读取时 seq 为奇数或者读前读后 seq 不一致则重读.
+generation 在某一行换了代码(或被清空)时加 1, 加 1 之前把行号记入变化记录.
+读取方据此只重新读取变化了的行, 落后超过 CHANGELOG_SIZE 次变化时才读取全部的行.
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+import arrow
+from django.db import models as djangomodels
+from typing import Dict, List, Tuple
+
+from .. import dbutils
+from .feeds import BaseFeed
+
+logger = logging.getLogger('wh')
+
+MAGIC = b'WHQSNAP1'
+VERSION = 3
+HEADER = struct.Struct(str('<8sIIIIQ'))
+HEADER_SIZE = 64
+GENERATION_OFFSET = 24
+CHANGELOG_SIZE = 1024
+CHANGELOG_ENTRY = struct.Struct(str('<I'))
+ROWS_OFFSET = HEADER_SIZE + CHANGELOG_SIZE * CHANGELOG_ENTRY.size
+SYMBOL_SIZE = 40
+ROW = struct.Struct(str('<Q{}sddqd'.format(SYMBOL_SIZE)))
+ROW_SIZE = 96
+SEQ = struct.Struct(str('<Q'))
+READ_RETRIES = 20
+
+
+class SnapshotTable(object):
+    """
+    行情快照表. 用 create 打开写入, 用 open 只读映射
+    """
+    def __init__(self, path, mm, capacity, writable):
+        self.path = path
+        self.capacity = capacity
+        self.writable = writable
+        self._mm = mm
+        self.inode = None
+        self._generation = None
+        self._slots = {}  # symbol -> 行号
+        self._symbols = {}  # 行号 -> symbol
+
+    @classmethod
+    def create(cls, path, capacity):
+        # type: (str, int) -> SnapshotTable
+        """
+        由更新进程调用. 文件不存在或者容量不一致时, 先写临时文件再改名替换,
+        这样已经映射旧文件的 worker 不会因为文件被截断而出错, 它们发现文件被替换后会重新映射
+        """
+        size = ROWS_OFFSET + capacity * ROW_SIZE
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        if not cls._is_compatible(path, capacity):
+            tmppath = path + '.tmp'
+            with open(tmppath, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, capacity, ROW_SIZE, 0, 0).ljust(HEADER_SIZE, b'\0'))
+                f.truncate(size)
+            os.rename(tmppath, path)
+        with open(path, 'r+b') as f:
+            mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_WRITE)
+        return cls(path, mm, capacity, writable=True)
+
+    @staticmethod
+    def _is_compatible(path, capacity):
+        if not os.path.exists(path) or os.path.getsize(path) != ROWS_OFFSET + capacity * ROW_SIZE:
+            return False
+        with open(path, 'rb') as f:
+            magic, version, cap, row_size, _reserved, _gen = HEADER.unpack(f.read(HEADER.size))
+        return magic == MAGIC and version == VERSION and cap == capacity and row_size == ROW_SIZE
+
+    @classmethod
+    def open(cls, path):
+        # type: (str) -> SnapshotTable
+        """
+        由 worker 调用, 只读映射
+        """
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            inode = os.fstat(f.fileno()).st_ino
+        magic, version, capacity, row_size, _reserved, _gen = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION or row_size != ROW_SIZE:
+            mm.close()
+            raise ValueError('bad quote snapshot file: {}'.format(path))
+        table = cls(path, mm, capacity, writable=False)
+        table.inode = inode
+        return table
+
+    def close(self):
+        self._mm.close()
+
+    @property
+    def generation(self):
+        return SEQ.unpack_from(self._mm, GENERATION_OFFSET)[0]
+
+    def _row_offset(self, slot):
+        if not 0 <= slot < self.capacity:
+            raise IndexError('slot {} out of capacity {}'.format(slot, self.capacity))
+        return ROWS_OFFSET + slot * ROW_SIZE
+
+    def _log_change(self, slot):
+        """
+        记录 slot 换了代码. 先写变化记录再增加 generation, 读取方看到新的 generation 时记录已经写好
+        """
+        generation = self.generation + 1
+        CHANGELOG_ENTRY.pack_into(self._mm, HEADER_SIZE + generation % CHANGELOG_SIZE * CHANGELOG_ENTRY.size, slot)
+        SEQ.pack_into(self._mm, GENERATION_OFFSET, generation)
+
+    def write(self, slot, symbol, last_price, change, volume, trade_ts):
+        # type: (int, str, float, float, int, float) -> None
+        offset = self._row_offset(slot)
+        mm = self._mm
+        seq = SEQ.unpack_from(mm, offset)[0]
+        symbol_bytes = symbol.encode('ascii')
+        if len(symbol_bytes) > SYMBOL_SIZE:
+            raise ValueError('symbol too long for quote snapshot: {}'.format(symbol))
+        new_symbol = ROW.unpack_from(mm, offset)[1].rstrip(b'\0') != symbol_bytes
+        SEQ.pack_into(mm, offset, seq + 1)
+        ROW.pack_into(mm, offset, seq + 1, symbol_bytes, last_price, change, volume, trade_ts)
+        SEQ.pack_into(mm, offset, seq + 2)
+        if new_symbol:
+            self._log_change(slot)
+
+    def clear(self, slot):
+        """
+        清空一行(代码已经无效或者换了行号), 读取方不再返回这一行的行情
+        """
+        offset = self._row_offset(slot)
+        mm = self._mm
+        seq = SEQ.unpack_from(mm, offset)[0]
+        if not ROW.unpack_from(mm, offset)[1].rstrip(b'\0'):
+            return
+        SEQ.pack_into(mm, offset, seq + 1)
+        ROW.pack_into(mm, offset, seq + 1, b'', 0.0, 0.0, 0, 0.0)
+        SEQ.pack_into(mm, offset, seq + 2)
+        self._log_change(slot)
+
+    def occupied(self):
+        # type: () -> Dict[int, str]
+        """
+        全部有代码的行 {行号: symbol}, 读取全部的行, 只在更新进程中使用
+        """
+        result = {}
+        for slot in range(self.capacity):
+            row = self.read(slot)
+            if row:
+                result[slot] = row[0]
+        return result
+
+    def read(self, slot):
+        # type: (int) -> Tuple[str, float, float, int, float]
+        """
+        返回 (symbol, last_price, change, volume, trade_ts), 该行还没有写过或者已经清空时返回 None
+        """
+        offset = self._row_offset(slot)
+        mm = self._mm
+        for _i in range(READ_RETRIES):
+            seq1 = SEQ.unpack_from(mm, offset)[0]
+            if seq1 & 1:
+                continue
+            row = ROW.unpack_from(mm, offset)
+            if SEQ.unpack_from(mm, offset)[0] == seq1:
+                symbol = row[1].rstrip(b'\0')
+                if seq1 == 0 or not symbol:
+                    return None
+                return (symbol.decode('ascii'),) + row[2:]
+        logger.warning('quote snapshot row %s kept changing, skip', slot)
+        return None
+
+    def slot_of(self, symbol):
+        # type: (str) -> int
+        generation = self.generation
+        if generation != self._generation:
+            self._rebuild_slots(generation)
+        return self._slots.get(symbol)
+
+    def _changed_slots(self, generation):
+        """
+        上次读取之后变化了的行号, 落后太多(变化记录已被覆盖)时返回 None
+        """
+        if self._generation is None or generation - self._generation > CHANGELOG_SIZE:
+            return None
+        changed = set()
+        for g in range(self._generation + 1, generation + 1):
+            offset = HEADER_SIZE + g % CHANGELOG_SIZE * CHANGELOG_ENTRY.size
+            changed.add(CHANGELOG_ENTRY.unpack_from(self._mm, offset)[0])
+        # 读取期间写入方又写了很多次, 读到的记录可能已经被覆盖
+        if self.generation - self._generation > CHANGELOG_SIZE:
+            return None
+        return changed
+
+    def _rebuild_slots(self, generation):
+        changed = self._changed_slots(generation)
+        if changed is None:
+            self._slots, self._symbols = {}, {}
+            changed = range(self.capacity)
+        for slot in changed:
+            old = self._symbols.pop(slot, None)
+            if old is not None and self._slots.get(old) == slot:
+                del self._slots[old]
+            row = self.read(slot) if slot < self.capacity else None
+            if row:
+                self._slots[row[0]] = slot
+                self._symbols[slot] = row[0]
+        self._generation = generation
+
+    def get_last_ticks(self, symbols):
+        # type: (List[str]) -> Dict[str, dict]
+        result = {}
+        for s in symbols:
+            slot = self.slot_of(s)
+            row = self.read(slot) if slot is not None else None
+            if row and row[0] == s:
+                result[s] = row2tick(row)
+        return result
+
+
+def row2tick(row):
+    symbol, last_price, change, volume, trade_ts = row
+    pre_close = last_price - change
+    return {
+        'symbol': symbol,
+        'last_price': last_price,
+        'pre_close': round(pre_close, 4),
+        'change': round(change, 4),
+        'change_ratio': round(change / pre_close * 100, 4) if pre_close else None,
+        'volume': volume,
+        'amount': 0.0,
+        'trade_time': arrow.get(trade_ts).format('YYYY-MM-DD HH:mm:ss') if trade_ts else '',
+    }
+
+
+class SnapshotFeed(BaseFeed):
+    """
+    从共享内存快照表读行情, 给 gunicorn worker 使用.
+    每隔 check_interval 秒检查一次文件: 还不存在(更新进程没有启动)时返回空, 被替换时重新映射
+    """
+    def __init__(self, path, check_interval=5, **options):
+        super(SnapshotFeed, self).__init__(**options)
+        self.path = path
+        self.check_interval = check_interval
+        self._table = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def _get_table(self):
+        now = time.time()
+        if now - self._checked_at < self.check_interval:
+            return self._table
+        self._checked_at = now
+        try:
+            inode = os.stat(self.path).st_ino
+            if self._table is None or self._table.inode != inode:
+                old, self._table = self._table, SnapshotTable.open(self.path)
+                if old is not None:
+                    old.close()
+        except (IOError, OSError, ValueError):
+            logger.warning('quote snapshot not ready: %s', self.path)
+        return self._table
+
+    def get_last_ticks(self, symbols):
+        with self._lock:
+            table = self._get_table()
+            return table.get_last_ticks(symbols) if table is not None else {}
+
+
+def assign_quote_slots():
+    # type: () -> int
+    """
+    给还没有行号的 SecModel 分配行号, 从当前最大行号往后顺序分配. 返回新分配的个数
+    """
+    from ..models import SecModel
+
+    maxslot = SecModel.objects.aggregate(m=djangomodels.Max('quote_slot'))['m']
+    nextslot = 0 if maxslot is None else maxslot + 1
+    objs = list(SecModel.objects.filter(quote_slot__isnull=True).order_by('id').only('id'))
+    for idx, obj in enumerate(objs):
+        obj.quote_slot = nextslot + idx
+    dbutils.bulk_update(SecModel, objs, ['quote_slot'])
+    return len(objs)
+
+
+def load_slot_map():
+    # type: () -> Dict[str, int]
+    """
+    读取 symbol -> 行号, 只包括有效的代码
+    """
+    from ..models import SecModel
+
+    return dict(
+        SecModel.objects.filter(is_active=True, quote_slot__isnull=False).values_list('symbol', 'quote_slot')
+    )
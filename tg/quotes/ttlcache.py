@@ -0,0 +1,58 @@
+# coding=utf-8
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import threading
+import time
+
+
+class TTLCache(object):
+    """
+    进程内带过期时间的缓存. 值为 None 也会被缓存(用于记录行情源中不存在的代码)
+    """
+    _MISSING = object()
+
+    def __init__(self, ttl, maxsize=20000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}  # key -> (expire_at, value)
+        self._lock = threading.Lock()
+
+    def get_many(self, keys, now=None):
+        # type: (list, float) -> (dict, list)
+        """
+        返回 (命中的 {key: value}, 没有命中的 keys)
+        """
+        now = time.time() if now is None else now
+        hits, misses = {}, []
+        with self._lock:
+            for key in keys:
+                item = self._data.get(key, self._MISSING)
+                if item is not self._MISSING and item[0] > now:
+                    hits[key] = item[1]
+                else:
+                    misses.append(key)
+        return hits, misses
+
+    def set_many(self, mapping, now=None):
+        # type: (dict, float) -> None
+        now = time.time() if now is None else now
+        expire_at = now + self.ttl
+        with self._lock:
+            if len(self._data) + len(mapping) > self.maxsize:
+                self._purge(now)
+            for key, value in mapping.items():
+                self._data[key] = (expire_at, value)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def _purge(self, now):
+        expired = [k for k, (expire_at, _v) in self._data.items() if expire_at <= now]
+        for k in expired:
+            del self._data[k]
+        if len(self._data) >= self.maxsize:  # 都还没有过期的话, 直接清空
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,210 @@
+# coding=utf-8
+"""
+批量计算收益率指标: 当日、周、月、累计收益率(百分比)
+
+InvestRecommendSecurity 按买入价、卖出价、最新行情及日线收盘价计算,
+PortfolioBaseInfo 按 navstore 中的组合累计收益率走势计算, 各组合一个月以来的走势拼成一个表, 与收盘价一样查询.
+全部行一次性读入 numpy 数组计算, 只把有变化的行分批写回
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import logging
+import time
+from calendar import timegm
+from collections import OrderedDict
+
+import arrow
+import numpy as np
+from typing import Dict, List, Tuple
+
+from . import dbutils, leaderboard, navstore, quotes
+from .models import InvestRecommendSecurity, PortfolioBaseInfo
+from .quotes import bars
+
+logger = logging.getLogger('wh')
+
+RATIO_FIELDS = ('curdate_ratio', 'week_ratio', 'month_ratio', 'accumulate_ratio')
+# 收盘价表的组合键 代码序号 * KEY_SPAN + 时间戳
+KEY_SPAN = 10 ** 10
+DECIMALS = 4
+
+
+def anchor_times(day):
+    # type: (arrow.Arrow) -> List[int]
+    """
+    当日、周、月收益率的起点时间. 起点价格为起点时间(含)之前最后一个交易日的收盘价
+    """
+    return [day.timestamp - 1, day.replace(days=-7).timestamp, day.replace(months=-1).timestamp]
+
+
+def to_ts(dt):
+    return timegm(dt.utctimetuple()) if dt else np.nan
+
+
+class CloseTable(object):
+    """
+    多个代码的日线收盘价合并成一个按 (代码序号, 时间) 排序的数组, 用于向量化地查询某一时间之前的收盘价
+    """
+    def __init__(self, symbols, closes):
+        # type: (List[str], Dict[str, Tuple[np.ndarray, np.ndarray]]) -> None
+        keys, prices = [np.empty(0, np.int64)], [np.empty(0, np.float64)]
+        for idx, symbol in enumerate(symbols):
+            if symbol in closes:
+                ts, close = closes[symbol]
+                keys.append(idx * KEY_SPAN + np.asarray(ts, np.int64))
+                prices.append(np.asarray(close, np.float64))
+        self.keys = np.concatenate(keys)
+        self.prices = np.concatenate(prices)
+
+    def close_at(self, sym_idx, ts):
+        # type: (np.ndarray, np.ndarray) -> np.ndarray
+        """
+        每个 (代码序号, 时间戳) 在该时间(含)之前最后一个收盘价, 没有的为 nan
+        """
+        keys = sym_idx.astype(np.int64) * KEY_SPAN + np.asarray(ts, np.int64)
+        result = np.full(len(keys), np.nan)
+        if not len(self.keys):  # 没有任何日线
+            return result
+        pos = np.searchsorted(self.keys, keys, side='right') - 1
+        valid = (pos >= 0) & (self.keys[np.maximum(pos, 0)] // KEY_SPAN == sym_idx)
+        result[valid] = self.prices[pos[valid]]
+        return result
+
+
+def ratio(start, end):
+    # type: (np.ndarray, np.ndarray) -> np.ndarray
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = (end / start - 1) * 100
+    r[~np.isfinite(r)] = np.nan
+    return r
+
+
+def _changed_rows(pks, new, old):
+    # type: (np.ndarray, np.ndarray, np.ndarray) -> List[Tuple[int, list]]
+    """
+    new/old 为 (行数, 4) 的数组. new 中为 nan 的保留原值, 返回有变化的 (主键, [4个收益率])
+    """
+    new = np.where(np.isnan(new), old, np.round(new, DECIMALS))
+    changed = np.any(np.abs(new - old) >= 0.5 * 10 ** -DECIMALS, axis=1)
+    return [(int(pk), row) for pk, row in zip(pks[changed].tolist(), new[changed].tolist())]
+
+
+def compute_recommend_ratios(day=None, batch_size=1000, dry_run=False):
+    # type: (arrow.Arrow, int, bool) -> Dict[str, object]
+    """
+    计算全部 InvestRecommendSecurity 的收益率. 已卖出的以卖出价为准, 否则以最新价为准
+    """
+    day = (day or arrow.utcnow()).floor('day')
+    stats = OrderedDict([('total', 0), ('updated', 0), ('no_price', 0)])
+    timings = OrderedDict()
+
+    t = time.time()
+    rows = list(InvestRecommendSecurity.objects.values_list(
+        'id', 'sec_idxid', 'buy_daytime', 'buy_price', 'sell_daytime', 'sell_price', *RATIO_FIELDS
+    ))
+    stats['total'] = len(rows)
+    timings['load'] = time.time() - t
+    if not rows:
+        stats['timings'] = timings
+        return stats
+
+    t = time.time()
+    cols = list(zip(*rows))
+    pks = np.array(cols[0], np.int64)
+    symbols, sym_idx = np.unique(np.array(cols[1], dtype=object).astype('U'), return_inverse=True)
+    symbols = symbols.tolist()
+    buy_ts = np.array([to_ts(v) for v in cols[2]])
+    buy_price = np.array(cols[3], np.float64)
+    sell_ts = np.array([to_ts(v) for v in cols[4]])
+    sell_price = np.array([np.nan if v is None else float(v) for v in cols[5]])
+    old = np.array(cols[6:], np.float64).T
+    timings['prepare'] = time.time() - t
+
+    t = time.time()
+    anchors = anchor_times(day)
+    closes = CloseTable(symbols, bars.get_source().get_daily_closes(
+        symbols, day.replace(months=-1, days=-15).timestamp, day.ceil('day').timestamp
+    ))
+    ticks = quotes.get_last_ticks(symbols)
+    last_price = np.array([(ticks.get(s) or {}).get('last_price') or np.nan for s in symbols], np.float64)
+    missing = np.isnan(last_price)
+    if missing.any():  # 没有实时行情的用最后一个收盘价
+        all_idx = np.arange(len(symbols))
+        last_price[missing] = closes.close_at(all_idx, np.full(len(symbols), day.ceil('day').timestamp))[missing]
+    timings['prices'] = time.time() - t
+
+    t = time.time()
+    closed = ~np.isnan(sell_price)
+    end_price = np.where(closed, sell_price, last_price[sym_idx])
+    end_ts = np.where(closed, sell_ts, np.inf)
+    new = np.empty((len(rows), len(RATIO_FIELDS)))
+    for col, anchor in enumerate(anchors):
+        start_price = np.where(buy_ts > anchor, buy_price, closes.close_at(sym_idx, np.full(len(rows), anchor)))
+        r = ratio(start_price, end_price)
+        r[closed & (end_ts <= anchor)] = 0  # 在起点之前就已经卖出
+        new[:, col] = r
+    new[:, 3] = ratio(buy_price, end_price)
+    stats['no_price'] = int(np.isnan(end_price).sum())
+    changed = _changed_rows(pks, new, old)
+    stats['updated'] = len(changed)
+    timings['compute'] = time.time() - t
+
+    if not dry_run:
+        t = time.time()
+        dbutils.bulk_update_rows(InvestRecommendSecurity, RATIO_FIELDS, changed, batch_size)
+        timings['write'] = time.time() - t
+
+    stats['timings'] = timings
+    return stats
+
+
+def compute_portfolio_ratios(day=None, batch_size=1000, dry_run=False):
+    # type: (arrow.Arrow, int, bool) -> Dict[str, object]
+    """
+    按 navstore 中的累计收益率走势计算全部组合的收益率. 没有走势数据的组合不变
+    """
+    day = (day or arrow.utcnow()).floor('day')
+    stats = OrderedDict([('total', 0), ('updated', 0), ('no_nav', 0)])
+    timings = OrderedDict()
+
+    t = time.time()
+    rows = list(PortfolioBaseInfo.objects.values_list('id', *RATIO_FIELDS))
+    stats['total'] = len(rows)
+    if not rows:
+        stats['timings'] = timings
+        return stats
+    cols = list(zip(*rows))
+    pks = np.array(cols[0], np.int64)
+    old = np.array(cols[1:], np.float64).T
+    timings['load'] = time.time() - t
+
+    t = time.time()
+    anchors = anchor_times(day)
+    day_end = day.ceil('day').timestamp
+    # 各组合最早的起点之后的走势拼成一个表(与收盘价表相同), 净值 = 1 + 累计收益率 / 100
+    tails = navstore.read_tails(pks.tolist(), min(anchors), day_end)
+    values = CloseTable(pks.tolist(), {pk: (series.ts, 1 + series.nav / 100) for pk, series in tails.items()})
+    timings['nav'] = time.time() - t
+
+    t = time.time()
+    idx = np.arange(len(rows))
+    end_value = values.close_at(idx, np.full(len(rows), day_end))
+    stats['no_nav'] = int(np.isnan(end_value).sum())
+    new = np.empty((len(rows), len(RATIO_FIELDS)))
+    for col, anchor in enumerate(anchors):
+        start_value = values.close_at(idx, np.full(len(rows), anchor))
+        start_value[np.isnan(start_value)] = 1.0  # 起点在成立之前的, 按初始净值1算
+        new[:, col] = (end_value / start_value - 1) * 100
+    new[:, 3] = (end_value - 1) * 100
+    changed = _changed_rows(pks, new, old)
+    stats['updated'] = len(changed)
+    timings['compute'] = time.time() - t
+
+    if not dry_run:
+        t = time.time()
+        dbutils.bulk_update_rows(PortfolioBaseInfo, RATIO_FIELDS, changed, batch_size)
+        leaderboard.update_rows(PortfolioBaseInfo, RATIO_FIELDS, changed)
+        timings['write'] = time.time() - t
+
+    stats['timings'] = timings
+    return stats
@@ -1,2 +1,46 @@
 # coding=utf-8
+"""
+直接使用 redis 的数据结构(有序集合, 哈希等)时的连接及键名
+
+连接来自 django-redis 的 CACHES['redis']. 没有配置或者 redis 连不上时 get_redis() 返回 None,
+调用方应退回到进程内的实现. 连接失败后 DOWN_SECS 秒内不再尝试, 避免每个请求都等连接超时
+"""
 from __future__ import (unicode_literals, absolute_import, print_function)
+
+import logging
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger('wh')
+
+REDIS_CACHE_ALIAS = 'redis'
+DOWN_SECS = 30
+
+_down_until = 0
+
+
+def get_redis():
+    """
+    返回 redis.StrictRedis, 不可用时返回 None
+    """
+    if REDIS_CACHE_ALIAS not in settings.CACHES or time.time() < _down_until:
+        return None
+    from django_redis import get_redis_connection
+    return get_redis_connection(REDIS_CACHE_ALIAS)
+
+
+def mark_down(exc=None):
+    """
+    调用方遇到 redis.RedisError 时调用, DOWN_SECS 秒内 get_redis() 返回 None
+    """
+    global _down_until
+    _down_until = time.time() + DOWN_SECS
+    logger.warning('redis unavailable for %ss: %s', DOWN_SECS, exc)
+
+
+def make_key(*parts):
+    # type: (*str) -> str
+    prefix = settings.CACHES.get(REDIS_CACHE_ALIAS, {}).get('KEY_PREFIX', '')
+    parts = [str(p) for p in parts]
+    return ':'.join([prefix] + parts if prefix else parts)
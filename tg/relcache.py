@@ -0,0 +1,79 @@
+# coding=utf-8
+"""
+用户关系集合的缓存: 关注的用户, 订阅的组合, 签约的投顾
+
+每个用户每种关系一个 id 集合, 以 uint32 数组的字节串存在缓存中, 同时记录版本号.
+关系有增删时(signals 中的回调, 或批量操作后手动调用 invalidate)更新版本号, 读取时版本不一致就重新查询.
+同一个请求中多个 serializer 共用一份, 只取一次:
+
+    from tg import relcache
+    obj.user_id in relcache.request_ids(request, 'followees')
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import time
+
+import numpy as np
+from django.core.cache import cache
+from typing import FrozenSet, Iterable
+
+from .models import SignContract, SnsFollow, SubscribePortfolio
+
+# 关系名: (模型, 用户字段, 关系另一方的字段)
+RELATIONS = {
+    'followees': (SnsFollow, 'user_id', 'followee_id'),
+    'subscriptions': (SubscribePortfolio, 'user_id', 'portfolio_id'),
+    'signed_advisers': (SignContract, 'user_id', 'adviser_id'),
+}
+TIMEOUT = 24 * 3600
+EMPTY = frozenset()
+
+
+def _data_key(name, user_id):
+    return 'relcache_{}_{}'.format(name, user_id)
+
+
+def _version_key(name, user_id):
+    return 'relcache_v_{}_{}'.format(name, user_id)
+
+
+def get_ids(name, user_id):
+    # type: (str, int) -> FrozenSet[int]
+    data_key, version_key = _data_key(name, user_id), _version_key(name, user_id)
+    cached = cache.get_many([data_key, version_key])
+    version = cached.get(version_key)
+    if version is None:
+        version = '{:.6f}'.format(time.time())
+        cache.set(version_key, version, None)
+    elif data_key in cached and cached[data_key][0] == version:
+        return frozenset(np.frombuffer(cached[data_key][1], np.uint32).tolist())
+
+    model, user_field, target_field = RELATIONS[name]
+    ids = sorted(model.objects.filter(**{user_field: user_id}).values_list(target_field, flat=True))
+    cache.set(data_key, (version, np.array(ids, np.uint32).tobytes()), TIMEOUT)
+    return frozenset(ids)
+
+
+def invalidate(name, user_ids):
+    # type: (str, Iterable[int]) -> None
+    """
+    这些用户的这种关系有变化时调用
+    """
+    version = '{:.6f}'.format(time.time())
+    cache.set_many({_version_key(name, uid): version for uid in set(user_ids)}, None)
+
+
+def request_ids(request, name):
+    # type: (object, str) -> FrozenSet[int]
+    """
+    当前请求用户的关系集合, 在 request 上缓存, 同一请求只取一次. 未登录返回空集合
+    """
+    user = request.user
+    if user.is_anonymous():
+        return EMPTY
+    memo = getattr(request, '_relcache', None)
+    if memo is None:
+        memo = request._relcache = {}
+    if name not in memo:
+        memo[name] = get_ids(name, user.pk)
+    return memo[name]
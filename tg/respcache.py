@@ -0,0 +1,118 @@
+# coding=utf-8
+"""
+匿名请求的响应缓存
+
+用于视图的 get 方法, 声明响应依赖哪些模型:
+
+    @respcache.cache_response(models.InvestAdviserInfo, models.UserInfo)
+    def get(self, request, *args, **kwargs):
+        ...
+
+未登录的请求按 host, 路径, 查询参数, 认证方式, 返回格式缓存渲染后的内容及 ETag, 命中时不再查询数据库和序列化.
+请求带有 If-None-Match 且与 ETag 相同时返回 304.
+声明的模型有数据保存/删除时(signals 中的回调)更新该模型的版本号, 旧的缓存就不会再被用到.
+批量 UPDATE 等不触发 signal 的修改, 在 timeout(默认 RESPONSE_CACHE['TTL'] 秒)后生效
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import functools
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.encoding import force_bytes
+from django.utils.http import quote_etag
+from typing import Type
+
+DEFAULT_RESPONSE_CACHE = {
+    'TTL': 60,
+}
+# 有视图依赖的模型的表名, 只有这些表的数据变化时才需要更新版本号
+TRACKED_TABLES = set()
+
+
+def response_cache_settings():
+    conf = dict(DEFAULT_RESPONSE_CACHE)
+    conf.update(getattr(settings, 'RESPONSE_CACHE', {}))
+    return conf
+
+
+def _version_key(table):
+    return 'respcache_v_{}'.format(table)
+
+
+def bump_model(model):
+    # type: (Type) -> None
+    """
+    模型的数据有变化时调用, 依赖这个模型的响应缓存全部失效
+    """
+    table = model._meta.db_table
+    if table in TRACKED_TABLES:
+        cache.set(_version_key(table), '{:.6f}'.format(time.time()), None)
+
+
+def _cache_key(request, tables):
+    versions = cache.get_many([_version_key(t) for t in tables])
+    authenticator = request.successful_authenticator
+    signature = '|'.join([
+        request.get_host(),
+        request.path,
+        '&'.join(sorted(request.GET.urlencode().split('&'))),
+        type(authenticator).__name__ if authenticator else '',
+        getattr(request, 'accepted_media_type', '') or '',
+        ','.join('{}={}'.format(t, versions.get(_version_key(t))) for t in tables),
+    ])
+    return 'respcache_{}'.format(hashlib.md5(force_bytes(signature)).hexdigest())
+
+
+def _not_modified(request, etag):
+    return etag in [e.strip() for e in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]
+
+
+def cache_response(*models, **options):
+    """
+    models 为响应依赖的模型, options 可以有 timeout(秒)
+    """
+    tables = sorted(m._meta.db_table for m in models)
+    TRACKED_TABLES.update(tables)
+    timeout = options.get('timeout')
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, request, *args, **kwargs):
+            if request.method != 'GET' or not request.user.is_anonymous():
+                return func(self, request, *args, **kwargs)
+
+            key = _cache_key(request, tables)
+            cached = cache.get(key)
+            if cached is not None:
+                etag, content_type, content = cached
+                if _not_modified(request, etag):
+                    response = HttpResponseNotModified()
+                else:
+                    response = HttpResponse(content, content_type=content_type)
+                response['ETag'] = etag
+                return response
+
+            response = func(self, request, *args, **kwargs)
+
+            def store(rendered):
+                if rendered.status_code != 200:
+                    return None
+                etag = quote_etag(hashlib.md5(rendered.content).hexdigest())
+                rendered['ETag'] = etag
+                cache.set(key, (etag, rendered['Content-Type'], rendered.content),
+                          timeout or response_cache_settings()['TTL'])
+                if _not_modified(request, etag):
+                    not_modified = HttpResponseNotModified()
+                    not_modified['ETag'] = etag
+                    return not_modified
+                return None
+
+            if hasattr(response, 'add_post_render_callback'):
+                response.add_post_render_callback(store)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,125 @@
+# coding=utf-8
+"""
+投资观点内容的清理
+
+InvestViewpoint 保存时用 bleach 清理一次 content, 结果存在 content_clean, 纯文本摘要存在 content_text,
+content_hash 为 content 的 sha1. 序列化时直接用 content_clean, 不再每次清理.
+还没有回填(manage.py backfill_viewpoint_content, 见 backfill())的行, 按 content 的 hash 在进程内 LRU 中缓存清理结果
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import bleach
+from django.apps import apps
+from django.utils.html import strip_tags
+from django.utils.six.moves.html_parser import HTMLParser
+from typing import Dict, Tuple
+
+from . import dbutils
+
+TEXT_MAX_LENGTH = 400
+MEMO_SIZE = 2048
+
+_spaces = re.compile(r'\s+', re.UNICODE)
+_html_parser = HTMLParser()
+
+
+class LRUCache(object):
+    """
+    线程安全的 LRU, 超过 maxsize 时丢弃最久没有用到的
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+_memo = LRUCache(MEMO_SIZE)
+
+
+def content_hash(content):
+    # type: (unicode) -> str
+    return hashlib.sha1((content or '').encode('utf-8')).hexdigest()
+
+
+def clean_html(content):
+    # type: (unicode) -> unicode
+    return bleach.clean(content or '', strip=True)
+
+
+def plain_text(html, max_length=TEXT_MAX_LENGTH):
+    # type: (unicode, int) -> unicode
+    """
+    去掉标签, 合并空白, 取前 max_length 个字符
+    """
+    text = _html_parser.unescape(strip_tags(html))
+    return _spaces.sub(' ', text).strip()[:max_length]
+
+
+def sanitize(content):
+    # type: (unicode) -> Tuple[unicode, unicode, str]
+    """
+    返回 (content_clean, content_text, content_hash)
+    """
+    clean = clean_html(content)
+    return clean, plain_text(clean), content_hash(content)
+
+
+def clean_memo(content):
+    # type: (unicode) -> unicode
+    """
+    按 content 的 hash 缓存的 clean_html, 用于还没有回填的行
+    """
+    key = content_hash(content)
+    clean = _memo.get(key)
+    if clean is None:
+        clean = clean_html(content)
+        _memo.set(key, clean)
+    return clean
+
+
+def backfill(chunk_size=1000, batch_size=200, recheck=False):
+    # type: (int, int, bool) -> Dict[str, object]
+    """
+    按主键分段为还没有 content_hash 的行生成清理后的内容, 批量写回.
+    recheck 为 True 时检查全部行, 重新生成 content 被直接 UPDATE 过(hash 不一致)的行
+    """
+    InvestViewpoint = apps.get_model('tg', 'InvestViewpoint')
+    fields = ['content_clean', 'content_text', 'content_hash']
+    stats = OrderedDict([('rows', 0), ('updated', 0)])
+    t = time.time()
+    qs = InvestViewpoint.objects.all() if recheck else InvestViewpoint.objects.filter(content_hash='')
+    for chunk in dbutils.iter_values_chunks(qs, ['content', 'content_hash'], chunk_size):
+        stats['rows'] += len(chunk)
+        rows = [
+            (pk, list(sanitize(content)))
+            for pk, content, stored_hash in chunk if content_hash(content) != stored_hash
+        ]
+        if rows:
+            stats['updated'] += dbutils.bulk_update_rows(InvestViewpoint, fields, rows, batch_size)
+    stats['seconds'] = time.time() - t
+    return stats
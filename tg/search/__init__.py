@@ -0,0 +1,22 @@
+# coding=utf-8
+"""
+资讯/投资观点的全文检索
+
+标题, 摘要, 主题, 内容按汉字单字/双字及英文数字词建立倒排索引, 用 BM25 排序, 见 index.py.
+索引存在 settings.SEARCH['DIR'] 下, 由 manage.py build_search_index 全量建立,
+manage.py update_search_index 持续处理保存/删除时记录在 SearchChange 中的修改
+
+    from tg import search
+    count, hits = search.search('平安银行', offset=0, limit=10)  # hits: [(类别, 文档 id, 得分)]
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+from .index import KINDS, build, search, update
+
+
+def record_change(kind, object_id):
+    """
+    文档有修改或删除时调用, 在当前事务中记录, 由 update() 写入索引
+    """
+    from ..models import SearchChange
+    SearchChange.objects.create(kind=kind, object_id=object_id)
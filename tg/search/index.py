@@ -0,0 +1,469 @@
+# coding=utf-8
+"""
+资讯/投资观点的倒排索引: 建立, 增量更新, 合并, BM25 查询
+
+每类文档(KINDS)一个目录, MANIFEST.json 记录当前的段(由旧到新).
+同一文档在较新的段中出现(或被删除)时, 较旧的段中的数据被屏蔽.
+资讯/投资观点保存或删除时(signals 中的回调)在 SearchChange 表中记一行, 与修改在同一个事务中.
+
+    build(kind)   从数据库全量建立, 每 SEGMENT_DOCS 个文档一个段, 段数超过 MAX_SEGMENTS 时边建立边合并
+    update()      处理 SearchChange 中的变化, 变化的文档写成一个新段, 段数超过 MAX_SEGMENTS 时合并
+    search(q)     查询, 按 BM25 得分排序, 返回总数及一页 [(类别, 文档 id, 得分)]
+
+合并时每次选文档数之和最少的 MERGE_FACTOR 个连续的段合为一个, 新的小段先合并, 大段很少被重写.
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import json
+import logging
+import math
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from typing import Dict, List, Tuple
+
+from .. import dbutils, sanitize
+from . import postings, segment, tokenizer
+
+logger = logging.getLogger('wh')
+
+# 类别: 模型及建索引的字段和权重(词频乘以权重). content 为 HTML, 先去掉标签
+KINDS = OrderedDict([
+    ('news', ('News', (('title', 3), ('digest', 2), ('topics', 2), ('content', 1)))),
+    ('viewpoint', ('InvestViewpoint', (('title', 3), ('digest', 2), ('content', 1)))),
+])
+HTML_FIELDS = ('content',)
+
+DEFAULT_SEARCH = {
+    'DIR': os.path.join(settings.BASE_DIR, 'var', 'search'),
+    # 全量建立时一个段的文档数, 建索引时内存占用与此成正比
+    'SEGMENT_DOCS': 200000,
+    # 每个段打开两个 mmap, 段数超过这个值就合并
+    'MAX_SEGMENTS': 16,
+    # 每次合并的连续段数
+    'MERGE_FACTOR': 4,
+    # 各进程检查 MANIFEST.json 是否变化的间隔(秒)
+    'RELOAD_SECS': 5,
+}
+BM25_K1 = 1.2
+BM25_B = 0.75
+LOCK_KEY = 'search_index_lock'
+LOCK_TIMEOUT = 3600
+# 打开索引时段已被删除(读到的 MANIFEST.json 过期了)的重试次数
+OPEN_RETRIES = 3
+
+
+def search_settings():
+    conf = dict(DEFAULT_SEARCH)
+    conf.update(getattr(settings, 'SEARCH', {}))
+    return conf
+
+
+def _kind_dir(kind):
+    return os.path.join(search_settings()['DIR'], kind)
+
+
+def _manifest_path(kind):
+    return os.path.join(_kind_dir(kind), 'MANIFEST.json')
+
+
+def read_manifest(kind):
+    try:
+        with open(_manifest_path(kind)) as f:
+            return json.load(f)
+    except IOError:
+        return {'segments': [], 'next_segment': 1}
+
+
+def _write_manifest(kind, manifest):
+    path = _manifest_path(kind)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.rename(tmp_path, path)
+
+
+def _remove_unused(kind, manifest):
+    """
+    删除 manifest 中没有的段. 已经打开的段不受影响(.npy 已读入内存, mmap 在删除后仍然有效),
+    读到旧的 MANIFEST.json 还没打开完的进程会重新读取, 见 open_index
+    """
+    used = set(manifest['segments'])
+    for name in os.listdir(_kind_dir(kind)):
+        if name.startswith('seg-') and name not in used:
+            shutil.rmtree(os.path.join(_kind_dir(kind), name), ignore_errors=True)
+
+
+# ---------- 建索引 ----------
+def _model(kind):
+    return apps.get_model('tg', KINDS[kind][0])
+
+
+def _field_names(kind):
+    return [name for name, _boost in KINDS[kind][1]]
+
+
+def _texts(kind, row):
+    """
+    row 为 (各字段的值), 返回 [(文本, 权重)]
+    """
+    texts = []
+    for (name, boost), value in zip(KINDS[kind][1], row):
+        value = value or ''
+        if name in HTML_FIELDS:
+            value = sanitize.plain_text(value, None)
+        texts.append((value, boost))
+    return texts
+
+
+class SegmentBuilder(object):
+    """
+    收集文档的词频, 写成一个段
+    """
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+        self.hashes, self.docs, self.tfs = [], [], []
+        self.doc_ids, self.doc_lens = [], []
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, doc_id, texts):
+        counts = self.vocabulary.count(texts)
+        self.hashes.extend(counts.keys())
+        self.tfs.extend(counts.values())
+        self.docs.extend([doc_id] * len(counts))
+        self.doc_ids.append(doc_id)
+        self.doc_lens.append(sum(counts.values()))
+
+    def write(self, path, deleted=()):
+        hashes = np.array(self.hashes, np.uint64)
+        docs = np.array(self.docs, np.int64)
+        order = np.lexsort((docs, hashes))
+        doc_order = np.argsort(self.doc_ids)
+        segment.write(
+            path, hashes[order], docs[order], np.array(self.tfs, np.int64)[order],
+            np.array(self.doc_ids, np.int64)[doc_order], np.array(self.doc_lens, np.int64)[doc_order],
+            np.unique(np.array(sorted(deleted), np.int64)),
+        )
+
+
+def _new_segment_path(kind, manifest):
+    name = 'seg-{:06d}'.format(manifest['next_segment'])
+    manifest['next_segment'] += 1
+    path = os.path.join(_kind_dir(kind), name)
+    if os.path.exists(path):
+        # 上次写完段之后, 写入 MANIFEST.json 之前退出, next_segment 没有增加. 没有被引用的可以删除
+        if name in read_manifest(kind)['segments']:
+            raise RuntimeError('搜索索引的段 {} 已被 MANIFEST.json 引用, next_segment 不正确'.format(path))
+        logger.warning('search index %s: removing unreferenced segment %s', kind, name)
+        shutil.rmtree(path)
+    return name, path
+
+
+def _acquire_lock():
+    if not cache.add(LOCK_KEY, os.getpid(), LOCK_TIMEOUT):
+        raise RuntimeError('另一个进程正在更新搜索索引')
+
+
+def build(kind, chunk_size=1000):
+    # type: (str, int) -> Dict[str, object]
+    """
+    全量建立一类文档的索引, 完成后替换原有的段
+    """
+    _acquire_lock()
+    try:
+        return _build(kind, chunk_size)
+    finally:
+        cache.delete(LOCK_KEY)
+
+
+def _build(kind, chunk_size):
+    t = time.time()
+    if not os.path.isdir(_kind_dir(kind)):
+        os.makedirs(_kind_dir(kind))
+    # 建立过程中的修改仍在 SearchChange 中, 由之后的 update() 处理
+    manifest = {'segments': [], 'next_segment': read_manifest(kind)['next_segment']}
+    vocabulary = tokenizer.Vocabulary()
+    builder = SegmentBuilder(vocabulary)
+    limit = search_settings()['SEGMENT_DOCS']
+    docs = 0
+    for chunk in dbutils.iter_values_chunks(_model(kind).objects.all(), _field_names(kind), chunk_size):
+        for row in chunk:
+            builder.add(row[0], _texts(kind, row[1:]))
+        docs += len(chunk)
+        if len(builder.doc_ids) >= limit:
+            _build_segment(kind, manifest, builder)
+            builder = SegmentBuilder(vocabulary)
+    if builder.doc_ids or not manifest['segments']:
+        _build_segment(kind, manifest, builder)
+    _write_manifest(kind, manifest)
+    _remove_unused(kind, manifest)
+    return OrderedDict([('kind', kind), ('docs', docs), ('segments', len(manifest['segments'])),
+                        ('seconds', time.time() - t)])
+
+
+def _build_segment(kind, manifest, builder):
+    """
+    全量建立时写一个段, 段数超过 MAX_SEGMENTS 时合并. 新的段还没有被引用, 合并掉的直接删除
+    """
+    name, path = _new_segment_path(kind, manifest)
+    builder.write(path)
+    manifest['segments'].append(name)
+    for name in _merge(kind, manifest):
+        shutil.rmtree(os.path.join(_kind_dir(kind), name), ignore_errors=True)
+
+
+# ---------- 增量更新 ----------
+def update(batch_size=5000):
+    # type: (int) -> Dict[str, object]
+    """
+    把 SearchChange 中记录的修改写入索引, 处理完的记录删除
+    """
+    _acquire_lock()
+    try:
+        return _update(batch_size)
+    finally:
+        cache.delete(LOCK_KEY)
+
+
+def _update(batch_size):
+    SearchChange = apps.get_model('tg', 'SearchChange')
+    t = time.time()
+    # 不按 id 记录处理到哪里: 事务提交的顺序与 id 的顺序不一定相同. 处理过的按 id 删除, 重复处理没有影响
+    changes = list(SearchChange.objects.order_by('id').values_list('id', 'kind', 'object_id')[:batch_size])
+    stats = OrderedDict([('changes', len(changes))] + [(kind, 0) for kind in KINDS])
+    if not changes:
+        return stats
+
+    for kind in KINDS:
+        ids = {object_id for _change_id, k, object_id in changes if k == kind}
+        if ids:
+            manifest = read_manifest(kind)
+            builder = SegmentBuilder(tokenizer.Vocabulary())
+            found = set()
+            for batch in dbutils.chunked(sorted(ids), 1000):
+                qs = _model(kind).objects.filter(pk__in=batch).values_list('pk', *_field_names(kind))
+                for row in qs:
+                    builder.add(row[0], _texts(kind, row[1:]))
+                    found.add(row[0])
+            if not os.path.isdir(_kind_dir(kind)):
+                os.makedirs(_kind_dir(kind))
+            name, path = _new_segment_path(kind, manifest)
+            builder.write(path, deleted=ids - found)
+            manifest['segments'].append(name)
+            _merge(kind, manifest)
+            _write_manifest(kind, manifest)
+            _remove_unused(kind, manifest)
+            stats[kind] = len(ids)
+
+    for batch in dbutils.chunked([change[0] for change in changes], 1000):
+        SearchChange.objects.filter(id__in=batch).delete()
+    stats['seconds'] = time.time() - t
+    return stats
+
+
+def _all_postings(seg):
+    """
+    段中全部的 (hash, 文档 id, 词频)
+    """
+    df = np.asarray(seg.df, np.int64)
+    deltas = postings.decode(seg.docs_bin)
+    tfs = postings.decode(seg.tfs_bin)
+    # 每个词的第一个值是原值, 其余为差值: 整体累加后减去前面各词的累计
+    total = np.cumsum(deltas)
+    starts = np.cumsum(df) - df
+    base = np.where(starts > 0, total[np.maximum(starts - 1, 0)], 0) if len(total) else starts
+    docs = total - np.repeat(base, df)
+    return np.repeat(np.asarray(seg.hashes), df), docs, tfs
+
+
+def _merge(kind, manifest):
+    # type: (str, dict) -> List[str]
+    """
+    段数超过 MAX_SEGMENTS 时, 每次把文档数之和最少的 MERGE_FACTOR 个连续的段合并为一个, 直到不超过.
+    只合并连续的段, 段之间的屏蔽关系不变. 返回被合并掉的段名
+    """
+    conf = search_settings()
+    factor = max(2, conf['MERGE_FACTOR'])
+    merged = []
+    while len(manifest['segments']) > conf['MAX_SEGMENTS']:
+        names = manifest['segments']
+        sizes = [segment.doc_count(os.path.join(_kind_dir(kind), name)) for name in names]
+        width = min(factor, len(names))
+        # 相同时选较新的
+        first = min(range(len(names) - width + 1), key=lambda i: (sum(sizes[i:i + width]), -i))
+        _merge_range(kind, manifest, first, first + width)
+        merged.extend(names[first:first + width])
+    return merged
+
+
+def _merge_range(kind, manifest, first, end):
+    """
+    把 manifest['segments'][first:end] 合并为一个段, 放在原来的位置
+    """
+    merging = [segment.Segment(os.path.join(_kind_dir(kind), name)) for name in manifest['segments'][first:end]]
+
+    parts, doc_ids, doc_lens, deleted = [], [], [], []
+    masked = np.zeros(0, np.int64)
+    for seg in reversed(merging):
+        hashes, docs, tfs = _all_postings(seg)
+        live = ~np.in1d(docs, masked)
+        parts.append((hashes[live], docs[live], tfs[live]))
+        live_docs = ~np.in1d(seg.doc_ids, masked)
+        doc_ids.append(np.asarray(seg.doc_ids, np.int64)[live_docs])
+        doc_lens.append(np.asarray(seg.doc_lens, np.int64)[live_docs])
+        deleted.append(np.setdiff1d(seg.deleted, masked))
+        masked = np.union1d(masked, np.union1d(seg.doc_ids, seg.deleted))
+
+    hashes = np.concatenate([p[0] for p in parts])
+    docs = np.concatenate([p[1] for p in parts])
+    tfs = np.concatenate([p[2] for p in parts])
+    order = np.lexsort((docs, hashes))
+    doc_ids, doc_lens = np.concatenate(doc_ids), np.concatenate(doc_lens)
+    doc_order = np.argsort(doc_ids)
+    # 合并的是最旧的段时, 已经没有更旧的数据需要屏蔽
+    deleted = np.concatenate(deleted) if first else segment.EMPTY
+    name, path = _new_segment_path(kind, manifest)
+    segment.write(path, hashes[order], docs[order], tfs[order], doc_ids[doc_order], doc_lens[doc_order], deleted)
+    manifest['segments'] = manifest['segments'][:first] + [name] + manifest['segments'][end:]
+    logger.info('search index %s: merged %s segments into %s', kind, len(merging), name)
+
+
+# ---------- 查询 ----------
+def _contains(sorted_ids, ids):
+    # type: (np.ndarray, np.ndarray) -> np.ndarray
+    """
+    ids 中的每个值是否在有序数组 sorted_ids 中
+    """
+    if not len(sorted_ids):
+        return np.zeros(len(ids), bool)
+    i = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    return sorted_ids[i] == ids
+
+
+class KindIndex(object):
+    """
+    一类文档当前的全部段. 每个段屏蔽掉在较新的段中出现或删除的文档:
+    打开时为每个段算出本段中被屏蔽的文档 id(有序, 不超过本段的文档数), 查询时在其中二分查找
+    """
+    def __init__(self, kind, manifest):
+        self.kind = kind
+        self.segments = [segment.Segment(os.path.join(_kind_dir(kind), name)) for name in manifest['segments']]
+        self.masks = []
+        masked = np.zeros(0, np.int64)
+        n, total_len = 0, 0
+        for seg in reversed(self.segments):
+            doc_ids = np.asarray(seg.doc_ids, np.int64)
+            mask = np.intersect1d(doc_ids, masked, assume_unique=True)
+            self.masks.insert(0, mask)
+            live = ~_contains(mask, doc_ids)
+            n += int(live.sum())
+            total_len += int(np.asarray(seg.doc_lens, np.int64)[live].sum())
+            masked = np.union1d(masked, np.union1d(doc_ids, seg.deleted))
+        self.doc_count = n
+        self.avg_len = float(total_len) / n if n else 1.0
+
+    def score(self, term_hashes):
+        # type: (List[int]) -> Tuple[np.ndarray, np.ndarray]
+        """
+        包含任一个词的文档 id 及其 BM25 得分
+        """
+        all_docs, all_scores = [], []
+        for h in term_hashes:
+            docs, tfs, lens = [], [], []
+            for seg, masked in zip(self.segments, self.masks):
+                d, tf = seg.postings(h)
+                if len(masked) and len(d):
+                    live = ~_contains(masked, d)
+                    d, tf = d[live], tf[live]
+                if len(d):
+                    docs.append(d)
+                    tfs.append(tf)
+                    lens.append(seg.doc_lengths(d))
+            if not docs:
+                continue
+            docs, tfs = np.concatenate(docs), np.concatenate(tfs).astype(np.float64)
+            lens = np.concatenate(lens).astype(np.float64)
+            df = len(docs)
+            idf = math.log(1 + (self.doc_count - df + 0.5) / (df + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lens / self.avg_len)
+            all_docs.append(docs)
+            all_scores.append(idf * tfs * (BM25_K1 + 1) / (tfs + norm))
+        if not all_docs:
+            return np.zeros(0, np.int64), np.zeros(0)
+        docs, inverse = np.unique(np.concatenate(all_docs), return_inverse=True)
+        return docs, np.bincount(inverse, weights=np.concatenate(all_scores))
+
+
+def open_index(kind):
+    # type: (str) -> KindIndex
+    """
+    按当前的 MANIFEST.json 打开索引. 读取之后段被合并删除时, 重新读取 MANIFEST.json 再打开
+    """
+    for attempt in range(OPEN_RETRIES):
+        manifest = read_manifest(kind)
+        try:
+            return KindIndex(kind, manifest)
+        except (IOError, OSError):
+            if attempt == OPEN_RETRIES - 1:
+                raise
+            logger.info('search index %s: segments of %s removed while opening, retrying', kind, manifest['segments'])
+
+
+_indexes = {}  # type: Dict[str, Tuple[float, float, KindIndex]]
+_indexes_lock = threading.Lock()
+
+
+def get_index(kind):
+    # type: (str) -> KindIndex
+    """
+    本进程中打开的索引, 每 RELOAD_SECS 秒检查一次 MANIFEST.json, 有变化时重新打开
+    """
+    now = time.time()
+    cached = _indexes.get(kind)
+    if cached and now - cached[0] < search_settings()['RELOAD_SECS']:
+        return cached[2]
+    with _indexes_lock:
+        try:
+            mtime = os.path.getmtime(_manifest_path(kind))
+        except OSError:
+            mtime = 0
+        if cached and cached[1] == mtime:
+            index = cached[2]
+        else:
+            index = open_index(kind)
+        _indexes[kind] = (now, mtime, index)
+    return index
+
+
+def search(q, kinds=None, offset=0, limit=10):
+    # type: (str, List[str], int, int) -> Tuple[int, List[Tuple[str, int, float]]]
+    """
+    返回 (匹配的文档数, 按得分从高到低的第 offset 起的 limit 个 [(类别, 文档 id, 得分)])
+    """
+    term_hashes = [tokenizer.term_hash(term) for term in tokenizer.query_terms(q)]
+    if not term_hashes:
+        return 0, []
+    kinds = kinds or list(KINDS)
+    all_kinds, all_docs, all_scores = [], [], []
+    for i, kind in enumerate(kinds):
+        docs, scores = get_index(kind).score(term_hashes)
+        all_kinds.append(np.full(len(docs), i, np.int64))
+        all_docs.append(docs)
+        all_scores.append(scores)
+    kind_idx, docs, scores = np.concatenate(all_kinds), np.concatenate(all_docs), np.concatenate(all_scores)
+    count, top = len(docs), offset + limit
+    if top < count:
+        # 只对得分最高的 top 个排序
+        selected = np.argpartition(-scores, top - 1)[:top]
+        kind_idx, docs, scores = kind_idx[selected], docs[selected], scores[selected]
+    order = np.lexsort((docs, kind_idx, -scores))[offset:top]
+    return count, [(kinds[kind_idx[i]], int(docs[i]), float(scores[i])) for i in order]
@@ -0,0 +1,75 @@
+# coding=utf-8
+"""
+倒排表的压缩: 有序的文档 id 先取差值, 再用 varint(每字节 7 位, 最高位表示后面还有字节)编码.
+编码/解码都用 numpy 整批处理, 不逐个数字循环
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import numpy as np
+
+MAX_BYTES = 5  # uint32 最多 5 个字节
+
+
+def varint_sizes(values):
+    # type: (np.ndarray) -> np.ndarray
+    """
+    每个数编码后的字节数
+    """
+    values = np.asarray(values, np.uint64)
+    sizes = np.ones(len(values), np.int64)
+    for k in range(1, MAX_BYTES):
+        sizes += values >= (1 << (7 * k))
+    return sizes
+
+
+def encode(values, sizes=None):
+    # type: (np.ndarray, np.ndarray) -> np.ndarray
+    """
+    values 为非负整数数组, 返回 uint8 数组
+    """
+    values = np.asarray(values, np.uint64)
+    if sizes is None:
+        sizes = varint_sizes(values)
+    starts = np.cumsum(sizes) - sizes
+    out = np.empty(int(sizes.sum()), np.uint8)
+    for k in range(MAX_BYTES):
+        mask = sizes > k
+        if not mask.any():
+            break
+        byte = (values[mask] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        byte |= np.where(sizes[mask] > k + 1, 0x80, 0).astype(np.uint64)
+        out[starts[mask] + k] = byte
+    return out
+
+
+def decode(buf):
+    # type: (np.ndarray) -> np.ndarray
+    """
+    encode 的逆过程, 返回 int64 数组
+    """
+    buf = np.asarray(buf, np.uint8)
+    if not len(buf):
+        return np.zeros(0, np.int64)
+    ends = np.flatnonzero(buf < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # 每个字节在所属数字中的位置
+    position = np.arange(len(buf)) - np.repeat(starts, ends - starts + 1)
+    parts = (buf & 0x7f).astype(np.int64) << (7 * position)
+    return np.add.reduceat(parts, starts)
+
+
+def delta(sorted_ids, group_starts=None):
+    # type: (np.ndarray, np.ndarray) -> np.ndarray
+    """
+    有序 id 的差值. group_starts 为各组(各个词)的起点, 每组第一个保留原值
+    """
+    sorted_ids = np.asarray(sorted_ids, np.int64)
+    result = np.empty_like(sorted_ids)
+    if len(sorted_ids):
+        result[0] = sorted_ids[0]
+        result[1:] = sorted_ids[1:] - sorted_ids[:-1]
+    if group_starts is not None and len(group_starts):
+        result[group_starts] = sorted_ids[group_starts]
+    return result
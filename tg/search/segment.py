@@ -0,0 +1,124 @@
+# coding=utf-8
+"""
+索引段: 一批文档的倒排索引, 写入后不再修改, 一个目录:
+
+    hashes.npy       词的 hash, 有序 uint64
+    df.npy           每个词的文档数
+    doc_offsets.npy  每个词的文档 id 在 docs.bin 中的起止字节, 长度为词数 + 1
+    tf_offsets.npy   每个词的词频在 tfs.bin 中的起止字节
+    docs.bin         各个词的文档 id, 差值后 varint 编码
+    tfs.bin          各个词在对应文档中的(加权)词频, varint 编码
+    doc_ids.npy      本段包含的文档 id, 有序
+    doc_lens.npy     文档长度(加权后的词数)
+    deleted.npy      本段写入时已经删除的文档 id, 用来屏蔽更早的段中的旧数据
+
+读取时 .npy 读入内存, docs.bin/tfs.bin 用 mmap 打开(每个段两个映射), 查询一个词只解码这个词的倒排表
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import os
+import shutil
+
+import numpy as np
+from typing import Tuple
+
+from . import postings
+
+ARRAYS = ('hashes', 'df', 'doc_offsets', 'tf_offsets', 'doc_ids', 'doc_lens', 'deleted')
+EMPTY = np.zeros(0, np.int64)
+
+
+def write(path, hashes, docs, tfs, doc_ids, doc_lens, deleted):
+    """
+    hashes/docs/tfs 为等长的扁平数组, 每个 (词, 文档) 一项, 按 (hash, 文档 id) 排序.
+    先写到临时目录再改名, 读取方不会看到写了一半的段. path 不能已经存在
+    """
+    hashes = np.asarray(hashes, np.uint64)
+    docs = np.asarray(docs, np.int64)
+    tfs = np.asarray(tfs, np.int64)
+    n = len(hashes)
+    if n:
+        starts = np.flatnonzero(np.concatenate([[True], hashes[1:] != hashes[:-1]]))
+    else:
+        starts = np.zeros(0, np.int64)
+    bounds = np.concatenate([starts, [n]]).astype(np.int64)
+
+    arrays = {
+        'hashes': hashes[starts],
+        'df': np.diff(bounds).astype(np.uint32),
+        'doc_ids': np.asarray(doc_ids, np.uint32),
+        'doc_lens': np.asarray(doc_lens, np.uint32),
+        'deleted': np.asarray(deleted, np.uint32),
+    }
+    streams = {}
+    for name, values in (('doc', postings.delta(docs, starts)), ('tf', tfs)):
+        sizes = postings.varint_sizes(values)
+        streams[name] = postings.encode(values, sizes)
+        arrays[name + '_offsets'] = np.concatenate([[0], np.cumsum(sizes)])[bounds].astype(np.uint64)
+
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name in ARRAYS:
+        np.save(os.path.join(tmp_path, name + '.npy'), arrays[name])
+    for name, stream in streams.items():
+        stream.tofile(os.path.join(tmp_path, name + 's.bin'))
+    os.rename(tmp_path, path)
+
+
+def doc_count(path):
+    # type: (str) -> int
+    """
+    段中的文档数, 只读取 doc_ids.npy 的头部
+    """
+    return len(np.load(os.path.join(path, 'doc_ids.npy'), mmap_mode='r'))
+
+
+def _map_bytes(path):
+    if not os.path.getsize(path):
+        return np.zeros(0, np.uint8)
+    return np.memmap(path, np.uint8, mode='r')
+
+
+class Segment(object):
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy')))
+        self.docs_bin = _map_bytes(os.path.join(path, 'docs.bin'))
+        self.tfs_bin = _map_bytes(os.path.join(path, 'tfs.bin'))
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def find(self, term_hash):
+        # type: (int) -> int
+        """
+        词的下标, 没有时返回 -1
+        """
+        i = int(np.searchsorted(self.hashes, np.uint64(term_hash)))
+        if i < len(self.hashes) and int(self.hashes[i]) == term_hash:
+            return i
+        return -1
+
+    def term_postings(self, i):
+        # type: (int) -> Tuple[np.ndarray, np.ndarray]
+        """
+        第 i 个词的 (文档 id 数组, 词频数组)
+        """
+        d0, d1 = int(self.doc_offsets[i]), int(self.doc_offsets[i + 1])
+        t0, t1 = int(self.tf_offsets[i]), int(self.tf_offsets[i + 1])
+        return np.cumsum(postings.decode(self.docs_bin[d0:d1])), postings.decode(self.tfs_bin[t0:t1])
+
+    def postings(self, term_hash):
+        # type: (int) -> Tuple[np.ndarray, np.ndarray]
+        i = self.find(term_hash)
+        if i < 0:
+            return EMPTY, EMPTY
+        return self.term_postings(i)
+
+    def doc_lengths(self, docs):
+        # type: (np.ndarray) -> np.ndarray
+        return np.asarray(self.doc_lens)[np.searchsorted(self.doc_ids, docs)]
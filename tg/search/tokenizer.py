@@ -0,0 +1,79 @@
+# coding=utf-8
+"""
+分词: 连续的字母数字为一个词(小写), 连续的汉字切成单字和相邻两字(bigram)
+
+    索引: 平安银行 -> 平 安 银 行 平安 安银 银行
+    查询: 平安银行 -> 平安 安银 银行, 只有一个汉字时用单字
+
+词用 md5 的前 8 字节(uint64)表示, 索引中不保存词本身
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import hashlib
+import re
+import struct
+from collections import Counter
+
+from typing import Dict, Iterable, List, Tuple
+
+# 汉字: 扩展A, 基本区, 兼容区
+_token_re = re.compile(r'[a-z0-9]+|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+', re.UNICODE)
+
+
+def _is_cjk(token):
+    return not ('a' <= token[0] <= 'z' or '0' <= token[0] <= '9')
+
+
+def index_terms(text):
+    # type: (unicode) -> Iterable[unicode]
+    for token in _token_re.findall(text.lower()):
+        if not _is_cjk(token):
+            yield token
+            continue
+        for i, ch in enumerate(token):
+            yield ch
+            if i + 1 < len(token):
+                yield token[i:i + 2]
+
+
+def query_terms(text):
+    # type: (unicode) -> List[unicode]
+    terms = []
+    for token in _token_re.findall(text.lower()):
+        if not _is_cjk(token) or len(token) == 1:
+            terms.append(token)
+        else:
+            terms.extend(token[i:i + 2] for i in range(len(token) - 1))
+    # 去重, 保持顺序
+    seen = set()
+    return [t for t in terms if not (t in seen or seen.add(t))]
+
+
+def term_hash(term):
+    # type: (unicode) -> int
+    return struct.unpack(b'<Q', hashlib.md5(term.encode('utf-8')).digest()[:8])[0]
+
+
+class Vocabulary(object):
+    """
+    建索引时缓存词的 hash, 同一个词只算一次
+    """
+    def __init__(self):
+        self._hashes = {}  # type: Dict[unicode, int]
+
+    def hash(self, term):
+        h = self._hashes.get(term)
+        if h is None:
+            h = self._hashes[term] = term_hash(term)
+        return h
+
+    def count(self, fields):
+        # type: (Iterable[Tuple[unicode, int]]) -> Counter
+        """
+        fields 为 [(文本, 权重)], 返回 {词的hash: 加权后的词频}
+        """
+        counts = Counter()
+        for text, boost in fields:
+            for term in index_terms(text or ''):
+                counts[self.hash(term)] += boost
+        return counts
@@ -0,0 +1,159 @@
+# coding=utf-8
+"""
+证券代码的进程内检索索引, 用于输入代码/名称/拼音首字母时的联想
+
+从 SecModel 一次性建立几个有序数组, 查询时二分查找前缀, 不访问数据库:
+    codes    代码及 symbol(小写), 如 600000, shse.600000
+    pinyins  名称拼音首字母, 如 平安银行 -> payh
+    names    名称的所有后缀, 这样 平安 也能匹配到 中国平安
+
+fetch_secs 同步代码表后会更新缓存中的版本号, 各进程发现版本变化后重建索引
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import bisect
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from typing import List, Tuple
+
+logger = logging.getLogger('wh')
+
+VERSION_KEY = 'secindex_version'
+
+# GB2312 一级汉字按拼音排序, 每个声母的第一个汉字的编码
+_GB2312_INITIALS = (
+    (0xB0A1, 'a'), (0xB0C5, 'b'), (0xB2C1, 'c'), (0xB4EE, 'd'), (0xB6EA, 'e'), (0xB7A2, 'f'),
+    (0xB8C1, 'g'), (0xB9FE, 'h'), (0xBBF7, 'j'), (0xBFA6, 'k'), (0xC0AC, 'l'), (0xC2E8, 'm'),
+    (0xC4C3, 'n'), (0xC5B6, 'o'), (0xC5BE, 'p'), (0xC6DA, 'q'), (0xC8BB, 'r'), (0xC8F6, 's'),
+    (0xCBFA, 't'), (0xCDDA, 'w'), (0xCEF4, 'x'), (0xD1B9, 'y'), (0xD4D1, 'z'),
+)
+_GB2312_CODES = [code for code, _letter in _GB2312_INITIALS]
+_GB2312_LEVEL1_END = 0xD7F9
+# 多音字在证券名称中的常用读音, 以及GB2312二级汉字中证券名称常用的字
+_INITIAL_OVERRIDES = {
+    '行': 'h', '藏': 'z', '重': 'c', '长': 'c', '乐': 'l', '厦': 'x', '区': 'q', '单': 'd',
+    '泸': 'l', '沱': 't', '鑫': 'x', '琪': 'q', '璐': 'l', '晟': 's', '昊': 'h', '铂': 'b',
+    '钴': 'g', '锂': 'l', '钛': 't', '钼': 'm', '邯': 'h', '郸': 'd', '亿': 'y', '芯': 'x',
+}
+
+
+def char_initial(ch):
+    # type: (str) -> str
+    """
+    单个字符的拼音首字母. 字母数字返回小写本身, 不认识的字返回空串
+    """
+    if ch in _INITIAL_OVERRIDES:
+        return _INITIAL_OVERRIDES[ch]
+    if ch.isalnum() and ord(ch) < 128:
+        return ch.lower()
+    try:
+        encoded = bytearray(ch.encode('gb2312'))
+    except UnicodeEncodeError:
+        return ''
+    if len(encoded) != 2:
+        return ''
+    code = (encoded[0] << 8) | encoded[1]
+    if code < _GB2312_CODES[0] or code > _GB2312_LEVEL1_END:
+        return ''
+    return _GB2312_INITIALS[bisect.bisect_right(_GB2312_CODES, code) - 1][1]
+
+
+def pinyin_initials(text):
+    # type: (str) -> str
+    return ''.join(char_initial(ch) for ch in text)
+
+
+class SecIndex(object):
+    """
+    有序数组实现的前缀索引. 每个数组为 (key, 记录下标) 按 key 排序
+    """
+    FIELDS = ('sec_id', 'sec_name', 'exchange', 'symbol', 'sec_type')
+
+    def __init__(self, rows):
+        # type: (List[Tuple]) -> None
+        self.records = [dict(zip(self.FIELDS, row)) for row in rows]
+        codes, pinyins, names = [], [], []
+        for idx, rec in enumerate(self.records):
+            codes.append((rec['sec_id'].lower(), idx))
+            codes.append((rec['symbol'].lower(), idx))
+            pinyins.append((pinyin_initials(rec['sec_name']), idx))
+            name = rec['sec_name'].replace(' ', '').lower()
+            for i in range(len(name)):
+                names.append((name[i:], idx))
+        self._arrays = []
+        for entries in (codes, pinyins, names):
+            entries.sort()
+            self._arrays.append(([k for k, _i in entries], [i for _k, i in entries]))
+
+    def __len__(self):
+        return len(self.records)
+
+    def search(self, q, limit=10):
+        # type: (str, int) -> List[dict]
+        """
+        依次按代码、拼音首字母、名称匹配前缀, 返回最多 limit 条不重复的记录
+        """
+        q = q.strip().lower()
+        if not q:
+            return []
+        found, seen = [], set()
+        for keys, idxs in self._arrays:
+            pos = bisect.bisect_left(keys, q)
+            while pos < len(keys) and keys[pos].startswith(q):
+                idx = idxs[pos]
+                if idx not in seen:
+                    seen.add(idx)
+                    found.append(self.records[idx])
+                    if len(found) >= limit:
+                        return found
+                pos += 1
+        return found
+
+
+def build_index():
+    # type: () -> SecIndex
+    from .models import SecModel
+
+    rows = SecModel.objects.filter(is_active=True).order_by('sec_id').values_list(*SecIndex.FIELDS)
+    return SecIndex(list(rows))
+
+
+_lock = threading.Lock()
+_index = None
+_version = None
+_checked_at = 0
+
+
+def get_index():
+    # type: () -> SecIndex
+    """
+    返回当前进程的索引. 每隔 SECINDEX_CHECK_INTERVAL 秒看一次缓存中的版本号, 有变化就重建
+    """
+    global _index, _version, _checked_at
+    now = time.time()
+    if _index is not None and now - _checked_at < getattr(settings, 'SECINDEX_CHECK_INTERVAL', 30):
+        return _index
+    with _lock:
+        _checked_at = now
+        version = cache.get(VERSION_KEY)
+        if _index is None or version != _version:
+            started = time.time()
+            _index, _version = build_index(), version
+            logger.info('secindex rebuilt, %s secs in %.3fs', len(_index), time.time() - started)
+    return _index
+
+
+def bump_version():
+    """
+    代码表有变化时调用, 通知所有进程重建索引
+    """
+    cache.set(VERSION_KEY, '{:.6f}'.format(time.time()), None)
+
+
+def search(q, limit=10):
+    # type: (str, int) -> List[dict]
+    return get_index().search(q, limit)
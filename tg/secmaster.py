@@ -0,0 +1,159 @@
+# coding=utf-8
+"""
+证券代码表(SecModel)同步
+
+从代码表数据源取全量代码, 按 symbol 与 SecModel 比较, 只把变化的部分分批写入:
+新代码 bulk_create, 有变化的批量 update, 数据源中已经没有的代码置为 is_active=False.
+有变化时通知各进程重建代码检索索引(secindex)
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import logging
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+from typing import Dict, List, Iterable
+
+from . import counting, dbutils, secindex, utils
+from .models import SecModel
+from .quotes.snapshot import assign_quote_slots
+
+logger = logging.getLogger('wh')
+
+SYNC_FIELDS = ('sec_type', 'sec_id', 'sec_name', 'exchange')
+
+
+class BaseSecSource(object):
+    """
+    代码表数据源. 子类实现 get_secmodels, 返回全量代码
+    """
+    def __init__(self, **options):
+        self.options = options
+
+    def get_secmodels(self):
+        # type: () -> Iterable[dict]
+        """
+        每条记录包括 sec_type, sec_id, sec_name, exchange. symbol 没有给出时为 exchange.sec_id
+        """
+        raise NotImplementedError
+
+
+class FileSecSource(BaseSecSource):
+    """
+    从本地文件(.csv/.jsonl/.json)读取代码表
+    """
+    def __init__(self, path, **options):
+        super(FileSecSource, self).__init__(**options)
+        self.path = path
+
+    def get_secmodels(self):
+        return utils.iter_records(self.path)
+
+
+def get_source(path=None, options=None):
+    # type: (str, dict) -> BaseSecSource
+    conf = getattr(settings, 'SECMASTER', {})
+    path = path or conf.get('SOURCE', 'tg.secmaster.FileSecSource')
+    options = conf.get('SOURCE_OPTIONS', {}) if options is None else options
+    return import_string(path)(**options)
+
+
+def normalize(record):
+    # type: (dict) -> dict
+    """
+    缺少字段或者格式不对时抛出 ValueError
+    """
+    try:
+        return _normalize(record)
+    except (KeyError, AttributeError, TypeError, ValueError) as e:
+        raise ValueError('代码表记录格式不对: {!r}, {}: {}'.format(record, type(e).__name__, e))
+
+
+def _normalize(record):
+    # type: (dict) -> dict
+    row = {
+        'sec_type': int(record['sec_type']),
+        'sec_id': record['sec_id'].strip(),
+        'sec_name': record['sec_name'].strip(),
+        'exchange': record['exchange'].strip(),
+    }
+    row['symbol'] = (record.get('symbol') or '').strip() or '{exchange}.{sec_id}'.format(**row)
+    return row
+
+
+def sync_secmodels(records, batch_size=500, deactivate=True, dry_run=False):
+    # type: (Iterable[dict], int, bool, bool) -> Dict[str, object]
+    """
+    把 records 同步到 SecModel, 返回各类变化的数量及各阶段耗时(秒).
+    记录格式不对时抛出 ValueError, 不写入任何数据; 写入在一个事务中, 中途出错时全部回滚
+    """
+    stats = OrderedDict([
+        ('total', 0), ('created', 0), ('updated', 0), ('deactivated', 0), ('unchanged', 0),
+    ])
+    timings = OrderedDict()
+
+    t = time.time()
+    incoming = OrderedDict()
+    for record in records:
+        row = normalize(record)
+        incoming[row['symbol']] = row
+    stats['total'] = len(incoming)
+    timings['load'] = time.time() - t
+
+    t = time.time()
+    existing = {}
+    for pk, symbol, sec_type, sec_id, sec_name, exchange, is_active in SecModel.objects.values_list(
+            'id', 'symbol', 'sec_type', 'sec_id', 'sec_name', 'exchange', 'is_active').order_by('id'):
+        if symbol in existing:
+            logger.warning('duplicated symbol in data_sec_model: %s, id=%s', symbol, pk)
+            continue
+        existing[symbol] = (pk, (sec_type, sec_id, sec_name, exchange), is_active)
+
+    to_create, to_update = [], []  # type: List[SecModel]
+    for symbol, row in incoming.items():
+        old = existing.get(symbol)
+        if old is None:
+            to_create.append(SecModel(symbol=symbol, is_active=True, **{f: row[f] for f in SYNC_FIELDS}))
+        elif old[1] != tuple(row[f] for f in SYNC_FIELDS) or not old[2]:
+            to_update.append(SecModel(pk=old[0], symbol=symbol, is_active=True, **{f: row[f] for f in SYNC_FIELDS}))
+        else:
+            stats['unchanged'] += 1
+    to_deactivate = [pk for symbol, (pk, _values, is_active) in existing.items()
+                     if is_active and symbol not in incoming] if deactivate else []
+    stats['created'], stats['updated'], stats['deactivated'] = len(to_create), len(to_update), len(to_deactivate)
+    timings['diff'] = time.time() - t
+
+    if not dry_run:
+        with transaction.atomic():
+            _write(to_create, to_update, to_deactivate, batch_size, timings)
+
+    stats['timings'] = timings
+    return stats
+
+
+def _write(to_create, to_update, to_deactivate, batch_size, timings):
+    # type: (List[SecModel], List[SecModel], List[int], int, Dict[str, float]) -> None
+    t = time.time()
+    SecModel.objects.bulk_create(to_create, batch_size=batch_size)
+    timings['create'] = time.time() - t
+
+    t = time.time()
+    dbutils.bulk_update(SecModel, to_update, SYNC_FIELDS + ('is_active',), batch_size=batch_size)
+    timings['update'] = time.time() - t
+
+    t = time.time()
+    for pks in dbutils.chunked(to_deactivate, batch_size):
+        SecModel.objects.filter(pk__in=pks).update(is_active=False)
+    timings['deactivate'] = time.time() - t
+
+    if to_create:
+        t = time.time()
+        assign_quote_slots()
+        timings['quote_slot'] = time.time() - t
+
+    if to_create or to_update or to_deactivate:
+        counting.bump_model(SecModel)
+        transaction.on_commit(secindex.bump_version)
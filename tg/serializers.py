@@ -1,12 +1,11 @@
 # coding=utf-8
 from __future__ import (unicode_literals, absolute_import, print_function)
 
-import bleach
 from rest_framework import serializers, status
 from rest_framework.reverse import reverse
 from rest_framework.exceptions import APIException
 
-from . import models
+from . import counters, models, relcache
 
 
 class CurUserInfoSerializer(serializers.ModelSerializer):
@@ -29,7 +28,7 @@ class InvestAdviserBaseInfoSerializer(serializers.ModelSerializer):
     name = serializers.CharField(source='user.nick_name')
     success_ratio = serializers.SerializerMethodField()
     accumulate_profit_ratio = serializers.SerializerMethodField()
-    fans = serializers.IntegerField(source='user.userstatistic.fans_count')
+    fans = serializers.SerializerMethodField()
     is_follow = serializers.SerializerMethodField()
     is_sign_contract = serializers.SerializerMethodField()
 
@@ -40,30 +39,29 @@ class InvestAdviserBaseInfoSerializer(serializers.ModelSerializer):
             'avatar', 'name', 'success_ratio', 'accumulate_profit_ratio',
             'fans', 'is_follow', 'is_sign_contract',
         )
+        select_related = ('user__userstatistic', 'user__investadviserkpi')
 
+    # 还没有计算 kpi 的投顾返回 None
     def get_success_ratio(self, obj):
-        return obj.user.investadviserkpi.success_ratio
+        kpi = getattr(obj.user, 'investadviserkpi', None)
+        return kpi.success_ratio if kpi else None
 
     def get_accumulate_profit_ratio(self, obj):
-        return obj.user.investadviserkpi.accumulate_profit_ratio
+        kpi = getattr(obj.user, 'investadviserkpi', None)
+        return kpi.accumulate_profit_ratio if kpi else None
+
+    def get_fans(self, obj):
+        # 加上还没有写入数据库的增量, 见 counters.py. 列表时整页一次取出
+        if getattr(self, 'pending_fans', None) is None:
+            objs = self.parent.instance if isinstance(self.parent, serializers.ListSerializer) else [obj]
+            self.pending_fans = counters.pending([o.user_id for o in objs], ['fans_count'])
+        return obj.user.userstatistic.fans_count + self.pending_fans.get((obj.user_id, 'fans_count'), 0)
 
     def get_is_follow(self, obj):
-        cur_user = self.context['request'].user   # type: models.UserInfo
-        if getattr(self, 'follows', None) is None:
-            if cur_user.is_anonymous():
-                self.followings = set()
-            else:
-                self.followings = set(cur_user.followings.values_list('followee_id', flat=True))
-        return obj.user_id in self.followings
+        return obj.user_id in relcache.request_ids(self.context['request'], 'followees')
 
     def get_is_sign_contract(self, obj):
-        cur_user = self.context['request'].user  # type: models.UserInfo
-        if getattr(self, 'sign_advisers', None) is None:
-            if cur_user.is_anonymous():
-                self.sign_advisers = set()
-            else:
-                self.sign_advisers = cur_user.sign_advisers.values_list('adviser_id', flat=True)
-        return obj.user_id in self.sign_advisers
+        return obj.user_id in relcache.request_ids(self.context['request'], 'signed_advisers')
 
 
 class InvestAdviserShortInfoSerializer(serializers.Serializer):
@@ -75,6 +73,9 @@ class InvestAdviserShortInfoSerializer(serializers.Serializer):
     name = serializers.CharField(source='nick_name')
     title = serializers.CharField(source='investadviserinfo.title')
 
+    class Meta:
+        select_related = ('investadviserinfo',)
+
 
 class PortfolioBaseinfoSerializer(serializers.ModelSerializer):
     accumulate_profit_ratio = serializers.SerializerMethodField()
@@ -98,13 +99,7 @@ class PortfolioBaseinfoSerializer(serializers.ModelSerializer):
         return 0
 
     def get_is_subscribe(self, obj):
-        cur_user = self.context['request'].user  # type: models.UserInfo
-        if getattr(self, 'subscribe_portfolios', None) is None:
-            if cur_user.is_anonymous():
-                self.subscribe_portfolios = set()
-            else:
-                self.subscribe_portfolios = cur_user.subscribe_portfolios.values_list('portfolio_id', flat=True)
-        return obj.id in self.subscribe_portfolios
+        return obj.id in relcache.request_ids(self.context['request'], 'subscriptions')
 
     def get_accumulate_profit_ratio(self, obj):
         return obj.accumulate_ratio
@@ -136,7 +131,7 @@ class InvestViewpointSerializer(serializers.ModelSerializer):
         return fields
 
     def get_content(self, obj):
-        return bleach.clean(obj.content, strip=True)
+        return obj.get_content_clean()  # 保存时已经清理, 见 sanitize.py
 
     def get_html5(self, obj):
         return reverse('UrlInvestViewpointInfo', kwargs={'pk': obj.id}, request=self.context['request'])
@@ -2,11 +2,11 @@
 from __future__ import (unicode_literals, absolute_import, print_function)
 
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_save, post_delete, pre_save
 from django.dispatch import receiver
 from django.db import transaction
 
-from . import models
+from . import models, authbackends, counting, feed, leaderboard, prerender, relcache, respcache, search, usercache
 
 print('-------------------------------*******************')
 
@@ -23,3 +23,152 @@ def post_save_userinfo(sender, instance, created, **kwargs):
     models.UserStatistic.objects.create(user=newuser)
 
 
+@receiver(post_save, sender=models.UserInfo)
+@receiver(post_delete, sender=models.UserInfo)
+def post_change_invalidate_usercache(sender, instance, **kwargs):
+    """
+    用户信息(包括密码, 是否有效)修改或删除后, 删除认证时用的用户缓存, 见 usercache.py
+    """
+    user_id = instance.pk
+    transaction.on_commit(lambda: usercache.invalidate([user_id]))
+
+
+@receiver(post_save, sender=models.UserInfo)
+def post_save_forget_auth_misses(sender, instance, **kwargs):
+    """
+    新的用户名/手机号/email 可能之前登录时被记为不存在, 见 authbackends.py
+    """
+    identifiers = [instance.username, instance.mobile, instance.email]
+    transaction.on_commit(lambda: authbackends.forget_misses(identifiers))
+
+
+@receiver(post_save, sender=models.PortfolioBaseInfo)
+@receiver(post_save, sender=models.InvestAdviserKpi)
+def post_save_update_leaderboard(sender, instance, **kwargs):
+    """
+    组合收益率/投顾kpi保存后更新排行榜
+    """
+    fields = [board.field for board in leaderboard.BOARDS.values() if board.model is sender]
+    row = (instance.pk, [getattr(instance, f) for f in fields])
+    transaction.on_commit(lambda: leaderboard.update_rows(sender, fields, [row]))
+
+
+@receiver(post_delete, sender=models.PortfolioBaseInfo)
+@receiver(post_delete, sender=models.InvestAdviserKpi)
+def post_delete_update_leaderboard(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: leaderboard.remove_rows(sender, [pk]))
+
+
+@receiver(post_save, sender=models.InvestAdviserInfo)
+def post_save_add_leaderboard_member(sender, instance, created, **kwargs):
+    """
+    新的投顾加入投顾榜单
+    """
+    if created:
+        pk = instance.pk
+        transaction.on_commit(lambda: leaderboard.add_members(sender, [pk]))
+
+
+@receiver(post_delete, sender=models.InvestAdviserInfo)
+def post_delete_remove_leaderboard_member(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: leaderboard.remove_members(sender, [pk]))
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def post_change_bump_count_version(sender, **kwargs):
+    """
+    数据有变化后, 让这个表相关的分页总数缓存失效. 修改也可能改变带过滤条件的查询的总数
+    """
+    if set(kwargs.get('update_fields') or ()) == {'last_login'}:  # 登录时只更新登录时间
+        return
+    counting.bump_model(sender)
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def post_change_bump_response_cache(sender, **kwargs):
+    """
+    数据有变化后, 让依赖这个模型的响应缓存失效, 见 respcache.py
+    """
+    if sender._meta.db_table not in respcache.TRACKED_TABLES:
+        return
+    if set(kwargs.get('update_fields') or ()) == {'last_login'}:  # 登录时只更新登录时间, 不影响返回的数据
+        return
+    transaction.on_commit(lambda: respcache.bump_model(sender))
+
+
+@receiver(post_save, sender=models.SnsFollow)
+@receiver(post_delete, sender=models.SnsFollow)
+@receiver(post_save, sender=models.SubscribePortfolio)
+@receiver(post_delete, sender=models.SubscribePortfolio)
+@receiver(post_save, sender=models.SignContract)
+@receiver(post_delete, sender=models.SignContract)
+def post_change_invalidate_relcache(sender, instance, **kwargs):
+    """
+    关注/订阅/签约有变化后, 让该用户的关系集合缓存失效
+    """
+    for name, (model, _user_field, _target_field) in relcache.RELATIONS.items():
+        if model is sender:
+            transaction.on_commit(lambda name=name, user_id=instance.user_id: relcache.invalidate(name, [user_id]))
+
+
+@receiver(pre_save, sender=models.InvestViewpoint)
+def pre_save_viewpoint_published(sender, instance, **kwargs):
+    """
+    记下保存前是否已发布(pub_daytime 不为空), 见 post_save_fanout_viewpoint
+    """
+    instance._was_published = instance.pk is not None and sender.objects.filter(
+        pk=instance.pk, pub_daytime__isnull=False).exists()
+
+
+@receiver(post_save, sender=models.InvestViewpoint)
+def post_save_fanout_viewpoint(sender, instance, created, **kwargs):
+    """
+    投资观点发布(pub_daytime 从空变为有值, 或创建时就有值)后在后台推送到粉丝的时间线, 见 feed.py.
+    删除的观点不逐个清理, 读取时过滤掉
+    """
+    if instance.pub_daytime is not None and not getattr(instance, '_was_published', False):
+        pk = instance.pk
+        transaction.on_commit(lambda: feed.schedule_fanout(pk))
+
+
+@receiver(post_save, sender=models.SnsFollow)
+def post_save_follow_feed(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(lambda: feed.on_follow(instance.user_id, [instance.followee_id]))
+
+
+@receiver(post_delete, sender=models.SnsFollow)
+def post_delete_follow_feed(sender, instance, **kwargs):
+    transaction.on_commit(lambda: feed.on_unfollow(instance.user_id, [instance.followee_id]))
+
+
+@receiver(post_save, sender=models.News)
+@receiver(post_save, sender=models.InvestViewpoint)
+def post_save_prerender(sender, instance, **kwargs):
+    """
+    资讯/投资观点保存后在后台重新渲染详情页, 见 prerender.py
+    """
+    kind, pk = prerender.kind_of(sender), instance.pk
+    transaction.on_commit(lambda: prerender.schedule(kind, pk))
+
+
+@receiver(post_delete, sender=models.News)
+@receiver(post_delete, sender=models.InvestViewpoint)
+def post_delete_prerender(sender, instance, **kwargs):
+    kind, pk = prerender.kind_of(sender), instance.pk
+    transaction.on_commit(lambda: prerender.discard(kind, pk))
+
+
+@receiver(post_save, sender=models.News)
+@receiver(post_delete, sender=models.News)
+@receiver(post_save, sender=models.InvestViewpoint)
+@receiver(post_delete, sender=models.InvestViewpoint)
+def post_change_record_search(sender, instance, **kwargs):
+    """
+    资讯/投资观点有修改或删除时记录下来, 由 manage.py update_search_index 更新搜索索引
+    """
+    search.record_change('news' if sender is models.News else 'viewpoint', instance.pk)
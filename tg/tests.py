@@ -1,3 +1,1105 @@
-from django.test import TestCase
+# coding=utf-8
+from __future__ import (unicode_literals, absolute_import, print_function)
 
-# Create your tests here.
+import io
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+
+import arrow
+import numpy as np
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.conf import settings
+from django.db import connection
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import six, timezone
+from rest_framework import permissions, serializers
+from rest_framework.exceptions import NotFound
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from . import (authbackends, counters, counting, dbutils, feed, homepage, kpi, leaderboard, mixins, models, navstore,
+               prerender, ratios, relcache, sanitize, search, secindex, throttling, usercache, utils, views,
+               serializers as tg_serializers)
+from .pagination import PageNumberPaginationWithPageSize
+from .search import index, postings
+from .quotes import feeds, service, snapshot
+from .quotes.ttlcache import TTLCache
+
+
+@override_settings(QUOTES={'FEED': 'tg.quotes.feeds.NullFeed', 'BAR_SOURCE': 'tg.quotes.bars.NullBarSource'})
+class RecommendRatiosTest(TestCase):
+    """
+    没有任何日线(NullBarSource, 或推荐的代码都没有日线)时的收益率计算
+    """
+    def setUp(self):
+        service.reset()
+
+    def tearDown(self):
+        service.reset()
+
+    def test_close_at_without_bars(self):
+        closes = ratios.CloseTable(['SHSE.600000', 'SZSE.000001'], {})
+        result = closes.close_at(np.array([0, 1]), np.array([1480000000, 1480000000]))
+        self.assertTrue(np.isnan(result).all())
+
+    def test_compute_without_bars(self):
+        owner = models.UserInfo.objects.create(username='ratio_owner', user_class=models.UserInfo.T_ADVISER)
+        models.InvestRecommendSecurity.objects.bulk_create([models.InvestRecommendSecurity(
+            owner=owner, sec_idxid='SHSE.600000', buy_daytime=arrow.get('2016-10-10').datetime,
+            buy_price=Decimal('10'), sell_daytime=arrow.get('2016-10-20').datetime, sell_price=Decimal('11'),
+        )])
+        stats = ratios.compute_recommend_ratios(day=arrow.get('2016-10-31'))
+        self.assertEqual(stats['total'], 1)
+        row = models.InvestRecommendSecurity.objects.get()
+        self.assertEqual(row.accumulate_ratio, Decimal('10'))
+
+
+class RatiosTest(TestCase):
+    """
+    有日线/收益走势时的收益率. 计算日为 2016-10-31, 当日/周/月的起点为 10-30, 10-24, 09-30
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        bars_path = os.path.join(self.dir, 'bars.jsonl')
+        with io.open(bars_path, 'w', encoding='utf-8') as f:
+            for day, close in (('2016-09-29', 9), ('2016-10-21', 10), ('2016-10-28', 11)):
+                f.write(json.dumps({'symbol': 'SHSE.600000', 'trade_date': day, 'close': close}) + '\n')
+        self.override = override_settings(NAVSTORE_ROOT=os.path.join(self.dir, 'nav'), QUOTES={
+            'FEED': 'tg.quotes.feeds.NullFeed',
+            'BAR_SOURCE': 'tg.quotes.bars.FileBarSource', 'BAR_SOURCE_OPTIONS': {'path': bars_path},
+        })
+        self.override.enable()
+        service.reset()
+        navstore._opened.clear()
+        self.owner = models.UserInfo.objects.create(username='ratio_owner', user_class=models.UserInfo.T_ADVISER)
+
+    def tearDown(self):
+        self.override.disable()
+        service.reset()
+        navstore._opened.clear()
+        shutil.rmtree(self.dir)
+
+    def ratios(self, obj):
+        obj.refresh_from_db()
+        return [round(float(getattr(obj, f)), 2) for f in ratios.RATIO_FIELDS]
+
+    def test_recommend_ratios(self):
+        held, sold = [models.InvestRecommendSecurity.objects.create(
+            owner=self.owner, sec_idxid='SHSE.600000', buy_daytime=arrow.get(buy).datetime,
+            buy_price=Decimal(buy_price),
+            sell_daytime=sell and arrow.get(sell).datetime, sell_price=sell_price and Decimal(sell_price),
+        ) for buy, buy_price, sell, sell_price in (
+            ('2016-09-01', '8', None, None),
+            ('2016-10-25', '10.5', '2016-10-27', '11.55'),
+        )]
+        ratios.compute_recommend_ratios(day=arrow.get('2016-10-31'))
+        # 没有实时行情, 以最后一个收盘价 11 为最新价
+        self.assertEqual(self.ratios(held), [0, 10, 22.22, 37.5])
+        # 当日起点之前已卖出为 0, 周/月起点在买入之前的按买入价
+        self.assertEqual(self.ratios(sold), [0, 10, 10, 10])
+
+    def test_portfolio_ratios(self):
+        old, new, empty = [models.PortfolioBaseInfo.objects.create(owner=self.owner, name=name, uuid=name)
+                           for name in ('old', 'new', 'empty')]
+        navstore.append(old.pk, [(arrow.get(day).timestamp, nav, 0) for day, nav in (
+            ('2016-09-20', 5), ('2016-10-21', 10), ('2016-10-28', 21), ('2016-11-01', 30),
+        )])
+        navstore.append(new.pk, [(arrow.get('2016-10-26').timestamp, 0, 0), (arrow.get('2016-10-28').timestamp, 10, 0)])
+        stats = ratios.compute_portfolio_ratios(day=arrow.get('2016-10-31'))
+        self.assertEqual(stats['no_nav'], 1)
+        # 计算日之后的点不算
+        self.assertEqual(self.ratios(old), [0, 10, 15.24, 21])
+        # 周/月起点在成立之前的按初始净值 1
+        self.assertEqual(self.ratios(new), [0, 10, 10, 10])
+        self.assertEqual(self.ratios(empty), [0, 0, 0, 0])
+
+
+class CachedCountTest(TransactionTestCase):
+    """
+    修改和批量写入后, 带过滤条件的分页总数缓存失效. 版本号在事务提交后更新, 所以不用 TestCase
+    """
+    def setUp(self):
+        cache.clear()
+
+    def test_update_moves_row_out_of_filter(self):
+        sec = models.SecModel.objects.create(sec_type=1, sec_id='600000', sec_name='浦发银行', exchange='SHSE',
+                                             symbol='SHSE.600000')
+        active = models.SecModel.objects.filter(is_active=True)
+        self.assertEqual(counting.cached_count(active), 1)
+        sec.is_active = False
+        sec.save()
+        self.assertEqual(counting.cached_count(active), 0)
+
+    def test_bulk_update_rows(self):
+        sec = models.SecModel.objects.create(sec_type=1, sec_id='600000', sec_name='浦发银行', exchange='SHSE',
+                                             symbol='SHSE.600000')
+        inactive = models.SecModel.objects.filter(is_active=False)
+        self.assertEqual(counting.cached_count(inactive), 0)
+        dbutils.bulk_update_rows(models.SecModel, ['is_active'], [(sec.pk, [False])])
+        self.assertEqual(counting.cached_count(inactive), 1)
+
+    def test_follow_many(self):
+        user = models.UserInfo.objects.create(username='count_fan')
+        adviser = models.UserInfo.objects.create(username='count_adviser', user_class=models.UserInfo.T_ADVISER)
+        follows = models.SnsFollow.objects.filter(followee=adviser)
+        self.assertEqual(counting.cached_count(follows), 0)
+        models.SnsFollow.objects.follow_many(user, [adviser.pk])
+        self.assertEqual(counting.cached_count(follows), 1)
+
+
+class AddCountsTest(TestCase):
+    """
+    计数减到负数时为 0
+    """
+    def setUp(self):
+        self.users = [models.UserInfo.objects.create(username='counts_{}'.format(i)) for i in range(2)]
+        models.UserStatistic.objects.filter(user__in=self.users).update(fans_count=1)
+
+    def fans(self):
+        return [models.UserStatistic.objects.get(user=user).fans_count for user in self.users]
+
+    def test_same_delta(self):
+        models.UserStatistic.objects.add_counts('fans_count', {user.pk: -2 for user in self.users})
+        self.assertEqual(self.fans(), [0, 0])
+
+    def test_mixed_deltas(self):
+        models.UserStatistic.objects.add_counts('fans_count', {self.users[0].pk: -3, self.users[1].pk: 2})
+        self.assertEqual(self.fans(), [0, 3])
+
+
+class ReconcileTest(TestCase):
+    def setUp(self):
+        cache.delete(counters.LOCK_KEY)
+        self.user = models.UserInfo.objects.create(username='reconcile_user')
+        models.UserStatistic.objects.filter(user=self.user).update(fans_count=5)
+
+    def test_reconcile(self):
+        stats = counters.reconcile()
+        self.assertGreaterEqual(stats['fans_count'], 1)
+        self.assertEqual(models.UserStatistic.objects.get(user=self.user).fans_count, 0)
+
+    def test_locked_by_flush(self):
+        cache.add(counters.LOCK_KEY, 1)
+        try:
+            self.assertRaises(RuntimeError, counters.reconcile)
+        finally:
+            cache.delete(counters.LOCK_KEY)
+
+
+class SearchIndexTest(TestCase):
+    """
+    倒排表编码, 段的合并, 上次写入中途退出后的恢复
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.override = override_settings(SEARCH={
+            'DIR': self.dir, 'SEGMENT_DOCS': 2, 'MAX_SEGMENTS': 3, 'MERGE_FACTOR': 2, 'RELOAD_SECS': 0,
+        })
+        self.override.enable()
+        cache.delete(index.LOCK_KEY)
+        index._indexes.clear()
+
+    def tearDown(self):
+        self.override.disable()
+        index._indexes.clear()
+        shutil.rmtree(self.dir)
+
+    def add_news(self, n):
+        return [models.News.objects.create(title='apple n{}'.format(i), topics='fruit') for i in range(n)]
+
+    def segments_on_disk(self):
+        return sorted(name for name in os.listdir(os.path.join(self.dir, 'news')) if name.startswith('seg-'))
+
+    def test_codec(self):
+        values = np.array([0, 1, 127, 128, 300, 16383, 16384, 2 ** 32 - 1], np.int64)
+        encoded = postings.encode(values)
+        self.assertEqual(len(encoded), int(postings.varint_sizes(values).sum()))
+        self.assertEqual(postings.decode(encoded).tolist(), values.tolist())
+        ids = np.array([3, 5, 9, 2, 4], np.int64)
+        self.assertEqual(postings.delta(ids, np.array([0, 3])).tolist(), [3, 2, 4, 2, 2])
+
+    def test_build_merges_to_max_segments(self):
+        news = self.add_news(9)
+        stats = search.build('news')
+        self.assertLessEqual(stats['segments'], 3)
+        self.assertEqual(self.segments_on_disk(), sorted(index.read_manifest('news')['segments']))
+        count, hits = search.search('apple', kinds=['news'], limit=20)
+        self.assertEqual(count, 9)
+        self.assertEqual(sorted(doc_id for _kind, doc_id, _score in hits), sorted(n.pk for n in news))
+
+    def test_update_merges_and_masks(self):
+        news = self.add_news(4)
+        search.build('news')
+        for n in news[:2]:
+            n.title = 'pear'
+            n.save()
+            search.update()
+        news[3].delete()
+        search.update()
+        self.assertLessEqual(len(index.read_manifest('news')['segments']), 3)
+        self.assertEqual(search.search('apple', kinds=['news'])[0], 1)
+        self.assertEqual(search.search('pear', kinds=['news'])[0], 2)
+
+    def test_masks_shadowed_docs(self):
+        news = self.add_news(4)
+        search.build('news')
+        # 全量建立已经包含了这些文档
+        models.SearchChange.objects.all().delete()
+        news[0].title = 'pear'
+        news[0].save()
+        search.update()
+        deleted_id = news[1].pk
+        news[1].delete()
+        search.update()
+        self.assertEqual(len(index.read_manifest('news')['segments']), 3)
+        kind_index = index.get_index('news')
+        self.assertEqual([mask.tolist() for mask in kind_index.masks], [[news[0].pk, deleted_id], [], []])
+        self.assertEqual(kind_index.doc_count, 3)
+        count, hits = search.search('apple', kinds=['news'])
+        self.assertEqual(sorted(doc_id for _kind, doc_id, _score in hits), [news[2].pk, news[3].pk])
+        self.assertEqual([doc_id for _kind, doc_id, _score in search.search('pear', kinds=['news'])[1]], [news[0].pk])
+
+    def test_open_after_rebuild(self):
+        self.add_news(2)
+        search.build('news')
+        stale = index.read_manifest('news')
+        models.News.objects.create(title='apple pear', topics='fruit')
+        search.build('news')
+        # 重建后删除了旧的段, 第一次读到的是重建前的 MANIFEST.json
+        self.assertFalse(set(stale['segments']) & set(self.segments_on_disk()))
+        manifests = [stale]
+        read_manifest = index.read_manifest
+        index.read_manifest = lambda kind: manifests.pop() if manifests else read_manifest(kind)
+        try:
+            response = self.client.get('/api/search/', {'q': 'apple', 'type': 'news'})
+        finally:
+            index.read_manifest = read_manifest
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['data']['docs']['count'], 3)
+
+    def test_recover_unreferenced_segment(self):
+        news = self.add_news(1)
+        search.build('news')
+        # 写完段之后, 写入 MANIFEST.json 之前退出时留下的段
+        leftover = os.path.join(self.dir, 'news', 'seg-{:06d}'.format(index.read_manifest('news')['next_segment']))
+        os.makedirs(leftover)
+        open(os.path.join(leftover, 'docs.bin'), 'w').close()
+        news[0].title = 'pear'
+        news[0].save()
+        search.update()
+        self.assertEqual(search.search('pear', kinds=['news'])[0], 1)
+        self.assertEqual(search.search('apple', kinds=['news'])[0], 0)
+
+
+class UserCacheTest(TestCase):
+    def setUp(self):
+        self.user = models.UserInfo.objects.create(username='cache_user', email='old@example.com')
+        usercache.invalidate([self.user.pk])
+
+    def test_invalidate_during_fill(self):
+        load = usercache._load_snapshot
+
+        def racing_load(user_id):
+            # 读取数据库之后, 写入缓存之前, 另一个请求修改了用户
+            snapshot = load(user_id)
+            models.UserInfo.objects.filter(pk=user_id).update(email='new@example.com')
+            usercache.invalidate([user_id])
+            return snapshot
+
+        usercache._load_snapshot = racing_load
+        try:
+            usercache.get_user(self.user.pk)
+        finally:
+            usercache._load_snapshot = load
+        usercache._local.set(self.user.pk, (0, None))  # 相当于其他进程
+        self.assertEqual(usercache.get_user(self.user.pk).email, 'new@example.com')
+
+
+class ThrottleIdentTest(TestCase):
+    def test_forwarded_for_is_not_trusted_beyond_proxies(self):
+        request = RequestFactory().post('/', HTTP_X_FORWARDED_FOR='10.0.0.1, 192.168.1.5', REMOTE_ADDR='127.0.0.1')
+        throttle = throttling.MymetaThrottle()
+        self.assertEqual(settings.REST_FRAMEWORK['NUM_PROXIES'], 1)
+        self.assertEqual(throttle.get_ident(request), '192.168.1.5')
+
+
+class ThrottleTest(TestCase):
+    """
+    没有 redis 时按 cache 计数的限流
+    """
+    class View(APIView):
+        permission_classes = (permissions.AllowAny,)
+        throttle_classes = (throttling.MymetaThrottle,)
+        mymeta = {'urlname': 'UrlThrottleTest', 'throttles': {'ip': '5/d', 'mobile': '1/d'}}
+
+        def post(self, request, *args, **kwargs):
+            return Response({})
+
+    def setUp(self):
+        cache.clear()
+        self.names = [('UrlThrottleTest', 'ip'), ('UrlThrottleTest', 'mobile')]
+
+    def post(self, **data):
+        return self.View.as_view()(RequestFactory().post('/', data, REMOTE_ADDR='10.0.0.1'))
+
+    def test_limit(self):
+        for i in range(5):
+            self.assertEqual(self.post().status_code, 200)
+        response = self.post()
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response['Retry-After']), 0)
+        self.assertEqual(throttling.shed_counts(self.names).values(), [1, 0])
+
+    def test_rejected_request_takes_no_tokens(self):
+        self.assertEqual(self.post(mobile='13800138000').status_code, 200)
+        # mobile 拒绝时 ip 的次数不扣
+        self.assertEqual(self.post(mobile='13800138000').status_code, 429)
+        self.assertEqual(self.post(mobile='13800138000').status_code, 429)
+        for i in range(4):
+            self.assertEqual(self.post(mobile='1390013900{}'.format(i)).status_code, 200)
+        self.assertEqual(self.post(mobile='13700137000').status_code, 429)
+        self.assertEqual(throttling.shed_counts(self.names).values(), [1, 2])
+
+
+class QuoteServiceTest(TestCase):
+    """
+    行情源, 进程内 TTL 缓存, 数据文件的读取
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'ticks.jsonl')
+        self.write_ticks([{'symbol': 'SHSE.600000', 'last_price': 11, 'pre_close': 10}])
+        service.reset()
+
+    def tearDown(self):
+        service.reset()
+        shutil.rmtree(self.dir)
+
+    def write_ticks(self, records):
+        with io.open(self.path, 'w', encoding='utf-8') as f:
+            for rec in records:
+                f.write(json.dumps(rec) + '\n')
+
+    def test_ttl_cache(self):
+        c = TTLCache(3)
+        c.set_many({'a': 1, 'b': None}, now=100)
+        self.assertEqual(c.get_many(['a', 'b', 'c'], now=102), ({'a': 1, 'b': None}, ['c']))
+        self.assertEqual(c.get_many(['a'], now=103), ({}, ['a']))
+
+    def test_make_tick(self):
+        tick = feeds.make_tick({'symbol': 'SHSE.600000', 'price': '11', 'pre_close': '10'})
+        self.assertEqual((tick['change'], tick['change_ratio']), (1.0, 10.0))
+
+    def test_get_last_ticks(self):
+        with override_settings(QUOTES={'FEED': 'tg.quotes.feeds.FileFeed', 'FEED_OPTIONS': {'path': self.path}}):
+            ticks = service.get_last_ticks(['SHSE.600000', 'SZSE.000001', ''])
+            self.assertEqual(list(ticks), ['SHSE.600000'])
+            self.assertEqual(ticks['SHSE.600000']['last_price'], 11.0)
+            service.reset()
+            self.assertEqual(service.get_last_ticks(['SZSE.000001']), {})
+
+    def test_replay_feed(self):
+        self.write_ticks([
+            {'symbol': 'SHSE.600000', 'last_price': 10, 'trade_time': '2016-10-10T09:30:00+08:00'},
+            {'symbol': 'SHSE.600000', 'last_price': 12, 'trade_time': '2016-10-10T09:30:10+08:00'},
+        ])
+        feed = feeds.ReplayFeed(self.path, loop=False)
+        ticks = feed.get_last_ticks(['SHSE.600000'])
+        self.assertEqual(ticks['SHSE.600000']['last_price'], 10.0)
+
+    def test_csv_extra_fields(self):
+        path = os.path.join(self.dir, 'secs.csv')
+        with open(path, 'wb') as f:
+            f.write(b'symbol,sec_name\nSHSE.600000,a\nSHSE.600001,b,extra\n')
+        records = utils.iter_records(path)
+        self.assertEqual(next(records), {'symbol': 'SHSE.600000', 'sec_name': 'a'})
+        self.assertRaises(ValueError, next, records)
+
+
+class SnapshotTableTest(TestCase):
+    """
+    行情快照表的写入/读取, 换代码和清空后读取方的索引
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'quotes.snap')
+        self.writer = snapshot.SnapshotTable.create(self.path, 8)
+        self.reader = snapshot.SnapshotTable.open(self.path)
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        self.writer.write(3, 'SHSE.600000', 11.0, 1.0, 100, 1476063000.0)
+        self.assertEqual(self.reader.read(3), ('SHSE.600000', 11.0, 1.0, 100, 1476063000.0))
+        self.assertEqual(self.reader.read(4), None)
+        tick = self.reader.get_last_ticks(['SHSE.600000'])['SHSE.600000']
+        self.assertEqual((tick['pre_close'], tick['change_ratio']), (10.0, 10.0))
+        self.assertRaises(ValueError, self.writer.write, 0, 'X' * (snapshot.SYMBOL_SIZE + 1), 1.0, 0.0, 0, 0.0)
+
+    def test_row_being_written(self):
+        self.writer.write(0, 'SHSE.600000', 11.0, 1.0, 100, 0.0)
+        offset = snapshot.ROWS_OFFSET
+        seq = snapshot.SEQ.unpack_from(self.writer._mm, offset)[0]
+        snapshot.SEQ.pack_into(self.writer._mm, offset, seq + 1)
+        self.assertEqual(self.reader.read(0), None)
+        snapshot.SEQ.pack_into(self.writer._mm, offset, seq + 2)
+        self.assertEqual(self.reader.read(0)[0], 'SHSE.600000')
+
+    def test_moved_and_cleared_slots(self):
+        self.writer.write(0, 'SHSE.600000', 11.0, 1.0, 100, 0.0)
+        self.writer.write(1, 'SZSE.000001', 9.0, 0.0, 100, 0.0)
+        self.assertEqual(self.reader.slot_of('SZSE.000001'), 1)
+        # 换到另一行, 旧的行清空
+        self.writer.write(2, 'SZSE.000001', 9.5, 0.5, 100, 0.0)
+        self.writer.clear(1)
+        self.writer.clear(0)
+        self.assertEqual(self.reader.slot_of('SZSE.000001'), 2)
+        self.assertEqual(self.reader.get_last_ticks(['SHSE.600000']), {})
+        self.assertEqual(self.writer.occupied(), {2: 'SZSE.000001'})
+
+    def test_changelog_overrun(self):
+        self.reader.slot_of('SHSE.600000')
+        for i in range(snapshot.CHANGELOG_SIZE + 1):
+            self.writer.write(i % 2, 'SHSE.60000{}'.format(i % 3), 1.0, 0.0, 0, 0.0)
+        self.assertEqual(self.reader.slot_of('SHSE.60000{}'.format(snapshot.CHANGELOG_SIZE % 3)),
+                         snapshot.CHANGELOG_SIZE % 2)
+
+
+class LeaderboardTest(TestCase):
+    """
+    没有 redis 时的进程内榜单
+    """
+    def setUp(self):
+        cache.clear()
+        self.owner = models.UserInfo.objects.create(username='board_owner', user_class=models.UserInfo.T_ADVISER)
+
+    def adviser(self, name, success=None):
+        user = models.UserInfo.objects.create(username=name, user_class=models.UserInfo.T_ADVISER)
+        models.InvestAdviserInfo.objects.create(user=user)
+        if success is not None:
+            models.InvestAdviserKpi.objects.create(user=user, success_ratio=success, accumulate_profit_ratio=0)
+        return user.pk
+
+    def test_adviser_success_order(self):
+        low, high, tie = self.adviser('a1', 10), self.adviser('a2', 80), self.adviser('a3', 10)
+        no_kpi = self.adviser('a4')
+        # 只有 kpi 没有投顾信息的不在榜单中
+        models.InvestAdviserKpi.objects.create(user=self.owner, success_ratio=99, accumulate_profit_ratio=0)
+        board = leaderboard.Board('test_success', models.InvestAdviserKpi, 'success_ratio',
+                                  members=models.InvestAdviserInfo, score_path='user__investadviserkpi__success_ratio')
+        board.rebuild()
+        self.assertEqual(board.ids(0, 10), [high, low, tie, no_kpi])
+
+    def test_changes_applied_without_database(self):
+        portfolios = [models.PortfolioBaseInfo.objects.create(owner=self.owner, name=str(i), uuid=str(i),
+                                                              week_ratio=i) for i in range(3)]
+        pks = [p.pk for p in portfolios]
+        reader = leaderboard.Board('test_week', models.PortfolioBaseInfo, 'week_ratio')
+        writer = leaderboard.Board('test_week', models.PortfolioBaseInfo, 'week_ratio')  # 另一个进程
+        self.assertEqual(reader.local().ids(0, 10), pks[::-1])
+
+        writer.update({pks[0]: 5.0})
+        writer.remove([pks[2]])
+        reader._checked_at = 0
+        with self.assertNumQueries(0):
+            self.assertEqual(reader.local().ids(0, 10), [pks[0], pks[1]])
+
+        # 全量重建后从数据库重新加载
+        writer.rebuild()
+        reader._checked_at = 0
+        self.assertEqual(reader.local().ids(0, 10), pks[::-1])
+
+
+class CursorPaginationTest(TestCase):
+    class View(object):
+        cursor_ordering = ('-pub_daytime',)
+
+    def page(self, cursor):
+        request = Request(RequestFactory().get('/', {'cursor': cursor, 'page_size': 2}))
+        paginator = PageNumberPaginationWithPageSize()
+        results = paginator.paginate_queryset(models.News.objects.all(), request, self.View())
+        return [obj.pk for obj in results], paginator.next_cursor
+
+    def test_round_trip(self):
+        days = ['2016-10-10', '2016-10-12', '2016-10-12', None, '2016-10-11', '2016-10-12', None]
+        news = [models.News.objects.create(title='n', topics='t', pub_daytime=day and arrow.get(day).datetime)
+                for day in days]
+        # 时间相同的按 id 从大到小, null 排在最后
+        by_day = {day: [n.pk for n, d in zip(news, days) if d == day][::-1] for day in days}
+        expected = by_day['2016-10-12'] + by_day['2016-10-11'] + by_day['2016-10-10'] + by_day[None]
+        ids, cursor = self.page('')
+        while cursor:
+            more, cursor = self.page(cursor)
+            ids += more
+        self.assertEqual(ids, expected)
+
+    def test_forged_cursor(self):
+        encode = PageNumberPaginationWithPageSize.encode_cursor
+        for cursor in ('not base64!', encode({'a': 1}), encode([[1], '5']), encode(['2016-10-10']),
+                       encode(['not a date', '5'])):
+            self.assertRaises(NotFound, self.page, cursor)
+
+
+class FeedTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.adviser = models.UserInfo.objects.create(username='feed_adviser', user_class=models.UserInfo.T_ADVISER)
+        self.fan = models.UserInfo.objects.create(username='feed_fan')
+        models.SnsFollow.objects.create(user=self.fan, followee=self.adviser)
+
+    def viewpoint(self, day):
+        return models.InvestViewpoint.objects.create(owner=self.adviser, title='vp',
+                                                     pub_daytime=day and arrow.get(day).datetime)
+
+    def test_fanout(self):
+        first, second = self.viewpoint('2016-10-10'), self.viewpoint('2016-10-11')
+        self.assertEqual(feed.fanout(first), 1)
+        self.assertEqual(feed.fanout(second), 1)
+        self.assertEqual(feed.fanout(self.viewpoint(None)), 0)
+        self.assertEqual([vid for _ts, vid in feed.read(self.fan.pk)], [second.pk, first.pk])
+        self.assertEqual([vid for _ts, vid in feed.read(self.fan.pk, feed.read(self.fan.pk, count=1)[0])],
+                         [first.pk])
+        self.assertEqual(feed.read(self.adviser.pk), [])
+
+    def test_follow_skips_unpublished(self):
+        published, _draft = self.viewpoint('2016-10-10'), self.viewpoint(None)
+        user = models.UserInfo.objects.create(username='feed_late_fan')
+        feed.on_follow(user.pk, [self.adviser.pk])
+        self.assertEqual([vid for _ts, vid in feed.read(user.pk)], [published.pk])
+        feed.on_unfollow(user.pk, [self.adviser.pk])
+        self.assertEqual(feed.read(user.pk), [])
+
+
+class FeedSignalTest(TransactionTestCase):
+    def setUp(self):
+        self.scheduled = []
+        self.schedule_fanout, feed.schedule_fanout = feed.schedule_fanout, self.scheduled.append
+
+    def tearDown(self):
+        feed.schedule_fanout = self.schedule_fanout
+
+    def test_fanout_on_publish(self):
+        adviser = models.UserInfo.objects.create(username='feed_adviser', user_class=models.UserInfo.T_ADVISER)
+        draft = models.InvestViewpoint.objects.create(owner=adviser, title='draft')
+        published = models.InvestViewpoint.objects.create(owner=adviser, title='vp',
+                                                          pub_daytime=arrow.utcnow().datetime)
+        self.assertEqual(self.scheduled, [published.pk])
+        draft.title = 'still draft'
+        draft.save()
+        published.title = 'edited'
+        published.save()
+        self.assertEqual(self.scheduled, [published.pk])
+        draft.pub_daytime = arrow.utcnow().datetime
+        draft.save()
+        self.assertEqual(self.scheduled, [published.pk, draft.pk])
+
+
+class HomepageTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        homepage._shared.clear()
+        self.calls = []
+        self.sections = []
+        self.get_sections, views.Index.get_sections = views.Index.get_sections, lambda view: self.sections
+
+    def tearDown(self):
+        views.Index.get_sections = self.get_sections
+        homepage._shared.clear()
+
+    def section(self, name, data):
+        def func(request):
+            self.calls.append(name)
+            if data is None:
+                raise ValueError(name)
+            return {name: data}
+        return name, func
+
+    def get(self):
+        response = self.client.get('/api/index/')
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf-8'))['data']
+
+    def test_endpoint(self):
+        adviser = models.UserInfo.objects.create(username='index_adviser', user_class=models.UserInfo.T_ADVISER)
+        fan = models.UserInfo.objects.create(username='index_fan')
+        models.SnsFollow.objects.create(user=fan, followee=adviser)
+        advisers = [{'id': adviser.pk}, {'id': fan.pk}]
+        self.sections = [self.section('invest_advisers', advisers), self.section('news', [{'id': 1}])]
+        data = self.get()
+        self.assertEqual([item['is_follow'] for item in data['invest_advisers']], [False, False])
+        self.assertEqual(data['news'], [{'id': 1}])
+        self.client.force_login(fan)
+        data = self.get()
+        self.assertEqual([item['is_follow'] for item in data['invest_advisers']], [True, False])
+        # 与用户无关的部分只生成一次, 改写 is_follow 不影响共用的数据
+        self.assertEqual(sorted(self.calls), ['invest_advisers', 'news'])
+        self.assertEqual(homepage._shared.values()[0][1]['invest_advisers'], advisers)
+
+    def test_partial_failure(self):
+        self.sections = [self.section('news', [{'id': 1}]), self.section('ads', None)]
+        self.assertEqual(self.get(), {'news': [{'id': 1}]})
+        self.assertEqual(self.get(), {'news': [{'id': 1}]})
+        # 不完整的结果不缓存
+        self.assertEqual(sorted(self.calls), ['ads', 'ads', 'news', 'news'])
+        self.assertEqual(homepage._shared, {})
+
+
+class AuthLookupTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def user(self, username, password, **kwargs):
+        user = models.UserInfo(username=username, **kwargs)
+        user.set_password(password)
+        user.save()
+        return user
+
+    def test_identifier_kind(self):
+        for identifier, kind in (('13800138000', authbackends.ID_MOBILE), ('+8613800138000', authbackends.ID_MOBILE),
+                                 ('alice@example.com', authbackends.ID_EMAIL), ('alice@', authbackends.ID_USERNAME),
+                                 ('alice', authbackends.ID_USERNAME), ('138', authbackends.ID_USERNAME)):
+            self.assertEqual(authbackends.identifier_kind(identifier), kind, identifier)
+
+    def test_username_before_mobile(self):
+        named = self.user('13800138000', 'named-pass')
+        owner = self.user('mobile_owner', 'owner-pass', mobile='13800138000')
+        self.assertEqual(authbackends.find_users('13800138000'), [named, owner])
+        backend = authbackends.IdentifierBackend()
+        self.assertEqual(backend.authenticate('13800138000', 'named-pass'), named)
+        self.assertEqual(backend.authenticate('13800138000', 'owner-pass'), owner)
+        self.assertIsNone(backend.authenticate('13800138000', 'wrong'))
+
+    def test_miss_cached_per_kinds(self):
+        user = self.user('carol@example.com', 'pass')
+        # 只按 email/手机号查找时没有找到, 不影响按用户名登录
+        self.assertEqual(models.UserInfo.find_by_email_or_mobile('carol@example.com'), None)
+        self.assertEqual(authbackends.IdentifierBackend().authenticate('carol@example.com', 'pass'), user)
+
+    def test_miss_cached_until_user_saved(self):
+        self.assertEqual(authbackends.find_users('dave'), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(authbackends.find_users('dave'), [])
+        self.assertEqual(authbackends.find_users('dave@example.com', kinds=(authbackends.ID_EMAIL,)), [])
+        user = self.user('dave', 'pass')
+        self.assertEqual(authbackends.find_users('dave'), [user])
+        user.email = 'dave@example.com'
+        user.save()
+        self.assertEqual(authbackends.find_users('dave@example.com', kinds=(authbackends.ID_EMAIL,)), [user])
+
+
+class FetchSecsTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'secmodels.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def fetch(self, rows):
+        with io.open(self.path, 'w', encoding='utf-8') as f:
+            f.write('sec_type,sec_id,sec_name,exchange\n')
+            for row in rows:
+                f.write(','.join(row) + '\n')
+        out = six.StringIO()
+        call_command('fetch_secs', path=self.path, stdout=out)
+        return out.getvalue().splitlines()[0]
+
+    def secs(self):
+        return sorted(models.SecModel.objects.values_list('symbol', 'sec_name', 'is_active'))
+
+    def test_incremental_sync(self):
+        self.assertEqual(self.fetch([('1', '600000', '浦发银行', 'SHSE'), ('1', '000001', '平安银行', 'SZSE')]),
+                         'total=2 created=2 updated=0 deactivated=0 unchanged=0')
+        self.assertEqual(self.fetch([('1', '600000', '浦发', 'SHSE'), ('1', '600036', '招商银行', 'SHSE')]),
+                         'total=2 created=1 updated=1 deactivated=1 unchanged=0')
+        self.assertEqual(self.secs(), [('SHSE.600000', '浦发', True), ('SHSE.600036', '招商银行', True),
+                                       ('SZSE.000001', '平安银行', False)])
+        self.assertEqual(self.fetch([('1', '600000', '浦发', 'SHSE'), ('1', '000001', '平安银行', 'SZSE')]),
+                         'total=2 created=0 updated=1 deactivated=1 unchanged=1')
+        self.assertEqual(models.SecModel.objects.filter(quote_slot__isnull=True).count(), 0)
+
+    def test_malformed_record_writes_nothing(self):
+        self.fetch([('1', '600000', '浦发银行', 'SHSE')])
+        with self.assertRaises(CommandError):
+            self.fetch([('1', '600000', '浦发', 'SHSE'), ('x', '600036', '招商银行', 'SHSE')])
+        self.assertEqual(self.secs(), [('SHSE.600000', '浦发银行', True)])
+
+
+@override_settings(SECINDEX_CHECK_INTERVAL=0)
+class SecIndexTest(TestCase):
+    def setUp(self):
+        secindex._index = None
+        for sec_id, name, exchange in (('600000', '浦发银行', 'SHSE'), ('000001', '平安银行', 'SZSE'),
+                                       ('601318', '中国平安', 'SHSE'), ('600036', '招商银行', 'SHSE')):
+            models.SecModel.objects.create(sec_type=1, sec_id=sec_id, sec_name=name, exchange=exchange,
+                                           symbol='{}.{}'.format(exchange, sec_id))
+
+    def tearDown(self):
+        secindex._index = None
+
+    def symbols(self, q, limit=10):
+        return [rec['symbol'] for rec in secindex.search(q, limit)]
+
+    def test_pinyin_initials(self):
+        self.assertEqual(secindex.pinyin_initials('平安银行'), 'payh')
+        self.assertEqual(secindex.pinyin_initials('重庆啤酒A'), 'cqpja')
+
+    def test_search(self):
+        self.assertEqual(self.symbols('6000'), ['SHSE.600000', 'SHSE.600036'])
+        self.assertEqual(self.symbols('szse.'), ['SZSE.000001'])
+        self.assertEqual(self.symbols('PAYH'), ['SZSE.000001'])
+        # 名称中间的字也能匹配
+        self.assertEqual(sorted(self.symbols('平安')), ['SHSE.601318', 'SZSE.000001'])
+        self.assertEqual(self.symbols('银行', limit=2), ['SZSE.000001', 'SHSE.600000'])
+        self.assertEqual(self.symbols(' '), [])
+
+    def test_rebuild_after_bump(self):
+        self.assertEqual(self.symbols('zs'), ['SHSE.600036'])
+        models.SecModel.objects.filter(sec_id='600036').update(is_active=False)
+        self.assertEqual(self.symbols('zs'), ['SHSE.600036'])
+        secindex.bump_version()
+        self.assertEqual(self.symbols('zs'), [])
+
+    def test_endpoint(self):
+        response = self.client.get('/api/security/suggest/', {'q': 'zgpa'})
+        self.assertEqual(response.status_code, 200)
+        secs = json.loads(response.content.decode('utf-8'))['data']['secs']
+        self.assertEqual([(sec['sec_id'], sec['sec_name']) for sec in secs], [('601318', '中国平安')])
+
+
+class NavStoreTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.override = override_settings(NAVSTORE_ROOT=self.dir)
+        self.override.enable()
+        navstore._opened.clear()
+
+    def tearDown(self):
+        self.override.disable()
+        navstore._opened.clear()
+        shutil.rmtree(self.dir)
+
+    def test_append_and_read(self):
+        self.assertEqual(navstore.append(1, [(300, 3, 0.3), (100, 1, 0.1), (200, 2, 0.2)]), 3)
+        # 不晚于已有数据的忽略
+        self.assertEqual(navstore.append(1, [(200, 9, 9), (400, 4, 0.4)]), 1)
+        series = navstore.read(1, 150, 300)
+        self.assertEqual((series.ts.tolist(), series.nav.tolist(), series.bench.tolist()),
+                         ([200, 300], [2, 3], [0.2, 0.3]))
+        self.assertEqual(navstore.load(1).last(), (400, 4, 0.4))
+        self.assertEqual(len(navstore.read(2)), 0)
+        tails = navstore.read_tails([1, 2], 250)
+        self.assertEqual(tails.keys(), [1])
+        self.assertEqual(tails[1].ts.tolist(), [200, 300, 400])
+
+    def test_partial_append(self):
+        navstore.append(1, [(100, 1, 0.1)])
+        # nav/bench 写完, ts 还没写时退出
+        for column in ('nav', 'bench'):
+            with open(os.path.join(self.dir, '1.{}'.format(column)), 'ab') as f:
+                f.write(np.array([9], np.float64).tobytes())
+        self.assertEqual(navstore.load(1).last(), (100, 1, 0.1))
+        navstore.append(1, [(200, 2, 0.2)])
+        self.assertEqual(navstore.read(1).nav.tolist(), [1, 2])
+        self.assertEqual(os.path.getsize(os.path.join(self.dir, '1.nav')), 2 * navstore.ITEM_SIZE)
+
+    def test_opened_limit(self):
+        max_opened, navstore.MAX_OPENED = navstore.MAX_OPENED, 2
+        try:
+            for pk in (1, 2, 3):
+                navstore.append(pk, [(100, pk, 0)])
+                navstore.load(pk)
+            self.assertEqual(list(navstore._opened), [2, 3])
+            navstore.load(2)
+            navstore.load(1)
+            self.assertEqual(list(navstore._opened), [2, 1])
+        finally:
+            navstore.MAX_OPENED = max_opened
+
+    def test_profit_endpoint(self):
+        owner = models.UserInfo.objects.create(username='nav_owner', user_class=models.UserInfo.T_ADVISER)
+        portfolio = models.PortfolioBaseInfo.objects.create(owner=owner, name='nav', uuid='nav')
+        navstore.append(portfolio.pk, [(arrow.get(day).timestamp, nav, bench) for day, nav, bench in (
+            ('2016-10-10', 0, 0), ('2016-10-11', 1.5, 0.5), ('2016-10-12', 2.5, 1))])
+        response = self.client.get('/api/portfolio/{}/profit/'.format(portfolio.pk),
+                                   {'start': '2016-10-11', 'end': '2016-10-11'})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))['data']
+        self.assertEqual(data['holds']['result'], [{'id': 0, 'trade_time': '2016-10-11 00:00:00', 'profit_ratio': 1.5}])
+        self.assertEqual([item['profit_ratio'] for item in data['baselines']['result']], [0.5])
+        self.assertEqual(self.client.get('/api/portfolio/abc/profit/').status_code, 404)
+
+
+class AdviserKpiTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.now = timezone.now()
+        self.good, self.idle = [models.UserInfo.objects.create(username=name, user_class=models.UserInfo.T_ADVISER)
+                                for name in ('kpi_good', 'kpi_idle')]
+
+    def recommend(self, owner, buy, sell=None, days_ago=0):
+        return models.InvestRecommendSecurity.objects.create(
+            owner=owner, sec_idxid='SHSE.600000', buy_daytime=self.now, buy_price=buy, sell_price=sell,
+            sell_daytime=self.now if sell is not None else None, ctime=self.now - timedelta(days=days_ago))
+
+    def kpis(self):
+        return {user_id: (float(success), float(profit)) for user_id, success, profit
+                in models.InvestAdviserKpi.objects.values_list('user_id', *kpi.KPI_FIELDS)}
+
+    def test_reduce_by_owner(self):
+        result = kpi.reduce_by_owner(np.array([1, 1, 1, 2]), np.array([10, 10, 10, 5.]),
+                                     np.array([12, 8, np.nan, 5.]))
+        self.assertEqual(result, {1: [50.0, -4.0], 2: [0.0, 0.0]})
+        self.assertEqual(kpi.percentile_rank(np.array([3, 1, 2, 2.])).tolist(), [1, 0, 0.5, 0.5])
+
+    def test_full_then_incremental(self):
+        self.recommend(self.good, 10, 12)
+        self.recommend(self.good, 10, 8)
+        held = self.recommend(self.good, 10)
+        stats = kpi.compute_adviser_kpi()
+        self.assertEqual((stats['mode'], stats['created'], stats['updated']), ('full', 2, 0))
+        self.assertEqual(self.kpis(), {self.good.pk: (50, -4), self.idle.pk: (0, 0)})
+
+        held.sell_price, held.sell_daytime = 15, timezone.now()
+        held.save()
+        stats = kpi.compute_adviser_kpi(incremental=True)
+        self.assertEqual((stats['mode'], stats['advisers'], stats['updated']), ('incremental', 1, 1))
+        self.assertEqual(self.kpis()[self.good.pk], (66.667, 44))
+
+    def test_composite_score(self):
+        self.recommend(self.good, 10, 12, days_ago=30)
+        self.recommend(self.idle, 10, 11, days_ago=30)
+        kpi.compute_adviser_kpi()
+        self.assertEqual(kpi.compute_composite_scores(now=self.now), 0)
+        # 成功率相同各 0.5, 收益率 1/0, 粉丝数相同各 0.5, 30 天前推荐过活跃度为 0.5
+        self.assertEqual(dict(models.InvestAdviserKpi.objects.values_list('user_id', 'composite_score')),
+                         {self.good.pk: Decimal('67.5'), self.idle.pk: Decimal('32.5')})
+
+
+class RelatedFieldsTest(TestCase):
+    class AdviserSerializer(serializers.Serializer):
+        portfolios = tg_serializers.PortfolioBaseinfoSerializer(source='portfolio_base_infos', many=True)
+        statistic = serializers.IntegerField(source='userstatistic.fans_count')
+
+        class Meta:
+            select_related = ('userstatistic',)
+
+    def test_serializer_relations(self):
+        self.assertEqual(mixins.serializer_relations(tg_serializers.PortfolioBaseinfoSerializer()),
+                         (['owner', 'owner__investadviserinfo'], []))
+        self.assertEqual(mixins.serializer_relations(self.AdviserSerializer()), (['userstatistic'], [
+            'portfolio_base_infos', 'portfolio_base_infos__owner', 'portfolio_base_infos__owner__investadviserinfo',
+        ]))
+
+    def add_recommends(self, n):
+        for i in range(n):
+            owner = models.UserInfo.objects.create(username='related_{}_{}'.format(n, i),
+                                                   user_class=models.UserInfo.T_ADVISER)
+            models.InvestAdviserInfo.objects.create(user=owner, title='title {}'.format(i))
+            models.InvestRecommendSecurity.objects.create(owner=owner, sec_idxid='SHSE.600000',
+                                                          buy_daytime=timezone.now(), buy_price=10)
+
+    def get_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/recommend_security/')
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content.decode('utf-8'))['data']['recommend_secs']['results']
+        return len(queries), results
+
+    def test_queries_do_not_grow_with_rows(self):
+        self.add_recommends(1)
+        few, results = self.get_queries()
+        self.assertEqual(results[0]['invest_adviser']['title'], 'title 0')
+        self.add_recommends(5)
+        many, results = self.get_queries()
+        self.assertEqual(len(results), 6)
+        self.assertEqual(many, few)
+
+
+class RelCacheTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = models.UserInfo.objects.create(username='rel_user')
+        self.advisers = [models.UserInfo.objects.create(username='rel_adviser_{}'.format(i),
+                                                        user_class=models.UserInfo.T_ADVISER) for i in range(3)]
+
+    def test_cached_until_changed(self):
+        models.SnsFollow.objects.create(user=self.user, followee=self.advisers[0])
+        self.assertEqual(relcache.get_ids('followees', self.user.pk), {self.advisers[0].pk})
+        with self.assertNumQueries(0):
+            self.assertEqual(relcache.get_ids('followees', self.user.pk), {self.advisers[0].pk})
+        models.SnsFollow.objects.follow_many(self.user, [a.pk for a in self.advisers[1:]])
+        self.assertEqual(relcache.get_ids('followees', self.user.pk), {a.pk for a in self.advisers})
+        models.SnsFollow.objects.unfollow_many(self.user, [self.advisers[0].pk])
+        self.assertEqual(relcache.get_ids('followees', self.user.pk), {a.pk for a in self.advisers[1:]})
+        models.SignContract.objects.create(user=self.user, adviser=self.advisers[2])
+        self.assertEqual(relcache.get_ids('signed_advisers', self.user.pk), {self.advisers[2].pk})
+
+    def test_request_ids(self):
+        models.SnsFollow.objects.create(user=self.user, followee=self.advisers[0])
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        self.assertEqual(relcache.request_ids(request, 'followees'), frozenset())
+        request = RequestFactory().get('/')
+        request.user = self.user
+        cache.clear()
+        with self.assertNumQueries(1):
+            for i in range(3):
+                self.assertEqual(relcache.request_ids(request, 'followees'), {self.advisers[0].pk})
+
+
+class ResponseCacheTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = models.UserInfo.objects.create(username='resp_owner', user_class=models.UserInfo.T_ADVISER)
+        self.add_portfolio('first')
+        self.url = '/api/invest_adviser/{}/portfolio/'.format(self.owner.pk)
+
+    def add_portfolio(self, name):
+        models.PortfolioBaseInfo.objects.create(owner=self.owner, name=name, uuid=name)
+
+    def names(self, response):
+        data = json.loads(response.content.decode('utf-8'))['data']
+        return [item['name'] for item in data['portfolios']['results']]
+
+    def test_etag_and_invalidation(self):
+        response = self.client.get(self.url)
+        self.assertEqual(self.names(response), ['first'])
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            cached = self.client.get(self.url)
+        self.assertEqual((cached.content, cached['ETag']), (response.content, etag))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # 查询参数不同的分开缓存
+        self.assertEqual(self.client.get(self.url, {'page_size': 1}).status_code, 200)
+
+        self.add_portfolio('second')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(self.names(response)), ['first', 'second'])
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_authenticated_not_cached(self):
+        self.client.force_login(self.owner)
+        response = self.client.get(self.url)
+        self.assertEqual(self.names(response), ['first'])
+        self.assertFalse(response.has_header('ETag'))
+        models.PortfolioBaseInfo.objects.update(name='renamed')
+        # 批量 UPDATE 不触发 signal, 匿名请求用旧的缓存直到超时, 登录用户不受影响
+        self.client.logout()
+        self.client.get(self.url)
+        models.PortfolioBaseInfo.objects.update(name='bulk')
+        self.assertEqual(self.names(self.client.get(self.url)), ['renamed'])
+        self.client.force_login(self.owner)
+        self.assertEqual(self.names(self.client.get(self.url)), ['bulk'])
+
+
+class PrerenderTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.override = override_settings(PRERENDER={'DIR': self.dir})
+        self.override.enable()
+        self.scheduled = []
+        self.schedule, prerender.schedule = prerender.schedule, lambda kind, pk: self.scheduled.append((kind, pk))
+        self.news = models.News.objects.create(title='prerender title', topics='t')
+        self.url = '/api/newsinfo/{}/'.format(self.news.pk)
+        cache.delete(prerender._cache_key('news', self.news.pk))
+
+    def tearDown(self):
+        prerender.schedule = self.schedule
+        self.override.disable()
+        shutil.rmtree(self.dir)
+
+    def test_gzip_and_etag(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual((response.status_code, response['Content-Encoding']), (200, 'gzip'))
+        self.assertIn('prerender title', prerender.decompress(response.content).decode('utf-8'))
+        self.assertTrue(os.path.exists(prerender._file_path('news', self.news.pk)))
+        # 已经渲染好的直接返回, 不查询数据库
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'],
+                                             HTTP_ACCEPT_ENCODING='gzip').status_code, 304)
+        plain = self.client.get(self.url)
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        self.assertEqual(plain.content, prerender.decompress(response.content))
+        self.assertNotEqual(plain['ETag'], response['ETag'])
+        self.assertEqual(self.scheduled, [])
+
+    def test_file_and_rerender(self):
+        prerender.render('news', self.news.pk)
+        cache.delete(prerender._cache_key('news', self.news.pk))
+        with self.assertNumQueries(0):
+            self.assertIn(b'prerender title', self.client.get(self.url).content)
+        self.news.title = 'changed title'
+        self.news.save()
+        prerender.render('news', self.news.pk)
+        self.assertIn(b'changed title', self.client.get(self.url).content)
+
+    def test_stale_template_and_discard(self):
+        prerender.render('news', self.news.pk)
+        rendered_at, content = cache.get(prerender._cache_key('news', self.news.pk))
+        cache.set(prerender._cache_key('news', self.news.pk), (0, content))
+        # 模板比渲染结果新时, 先返回旧的内容, 同时排队重新渲染
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertEqual(self.scheduled, [('news', self.news.pk)])
+        pk = self.news.pk
+        self.news.delete()
+        prerender.render('news', pk)
+        self.assertFalse(os.path.exists(prerender._file_path('news', pk)))
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+
+class SanitizeTest(TestCase):
+    html = '<p onclick="x()">Hello&nbsp;<b>world</b></p>\n\n<script>alert(1)</script>'
+
+    def setUp(self):
+        self.owner = models.UserInfo.objects.create(username='clean_owner', user_class=models.UserInfo.T_ADVISER)
+
+    def test_sanitize(self):
+        clean, text, content_hash = sanitize.sanitize(self.html)
+        self.assertNotIn('<script', clean)
+        self.assertNotIn('onclick', clean)
+        # 标签去掉, &nbsp; 还原后与其他空白合并
+        self.assertEqual(text, 'Hello world alert(1)')
+        self.assertEqual(content_hash, sanitize.content_hash(self.html))
+        self.assertEqual(sanitize.plain_text('a  b\n c', 3), 'a b')
+
+    def test_save_and_backfill(self):
+        vp = models.InvestViewpoint.objects.create(owner=self.owner, title='vp', content=self.html)
+        self.assertEqual((vp.content_clean, vp.content_hash), sanitize.sanitize(self.html)[::2])
+        vp.content = '<i>new</i>'
+        vp.save(update_fields=['content'])
+        vp.refresh_from_db()
+        self.assertEqual((vp.content_clean, vp.content_text), ('<i>new</i>', 'new'))
+
+        # 直接 UPDATE 的行: 没有 hash 的由 backfill 生成, content 变了的由 recheck 发现
+        models.InvestViewpoint.objects.filter(pk=vp.pk).update(content=self.html, content_hash='')
+        other = models.InvestViewpoint.objects.create(owner=self.owner, title='other', content='old')
+        models.InvestViewpoint.objects.filter(pk=other.pk).update(content='<b>edited</b>')
+        self.assertEqual(models.InvestViewpoint.objects.get(pk=vp.pk).get_content_clean(),
+                         sanitize.clean_html(self.html))
+        stats = sanitize.backfill()
+        self.assertEqual((stats['rows'], stats['updated']), (1, 1))
+        stats = sanitize.backfill(recheck=True)
+        self.assertEqual((stats['rows'], stats['updated']), (2, 1))
+        self.assertEqual(models.InvestViewpoint.objects.get(pk=other.pk).content_text, 'edited')
+
+    def test_lru(self):
+        lru = sanitize.LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual((lru.get('a'), lru.get('b'), lru.get('c'), len(lru)), (1, None, 3, 2))
@@ -0,0 +1,257 @@
+# coding=utf-8
+"""
+发送验证码, 登录, 注册等接口的限流
+
+在视图的 mymeta 中配置, 键为限流的范围, 值为 '次数/时间', 时间为 s/m/h/d 或前面带数字如 10m:
+
+    SendSecurityCode.mymeta = {
+        ...
+        'throttles': {'ip': '10/10m', 'mobile': '3/10m', 'global': '20/s'},
+    }
+
+范围 ip 按客户端 ip, global 为这个接口的全部请求, 其他的按请求参数中同名字段的值(没有这个参数时不限制).
+客户端 ip 由 DRF 的 get_ident 取得, 必须设置 REST_FRAMEWORK['NUM_PROXIES'] 为前面反向代理的层数:
+没有设置时直接用请求中的 X-Forwarded-For, 客户端可以每次换一个 ip 绕过限流;
+设置后只用代理追加的地址(没有 X-Forwarded-For 时为 REMOTE_ADDR). 不经过代理直接访问时应设为 0.
+settings.THROTTLE['RATES'] 中可以按 urlname 覆盖. 每个范围一个令牌桶, 容量为次数, 按 次数/时间 的速度补充.
+
+作为 DRF 的 throttle class(REST_FRAMEWORK['DEFAULT_THROTTLE_CLASSES']), 在认证/权限检查之后,
+解析参数和计算密码 hash 之前检查. 有 redis 时用 lua 脚本原子地检查并扣除全部桶, 任一个桶不够时都不扣;
+没有 redis 时退回到 cache 中按时间窗口计数(cache.incr).
+被拒绝的请求按 (urlname, 范围) 计数, manage.py throttle_stats 查看
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import hashlib
+import math
+import re
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from redis import RedisError
+from rest_framework.throttling import BaseThrottle
+from typing import Dict, List, Optional, Tuple
+
+from . import redis_utils
+
+DEFAULT_THROTTLE = {
+    'ENABLED': True,
+    # {urlname: {范围: '次数/时间'}}, 覆盖视图 mymeta 中的配置
+    'RATES': {},
+}
+SHED_KEY = redis_utils.make_key('throttle', 'shed')
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+Bucket = namedtuple('Bucket', ['scope', 'capacity', 'period'])
+
+_rate_re = re.compile(r'^(\d+)/(\d*)([smhd])$')
+_configs = {}  # type: Dict[type, Tuple[str, List[Bucket]]]
+
+# KEYS: 各个桶, 最后一个为拒绝计数的 hash. ARGV: 当前时间, 之后每个桶的 容量, 每秒补充数, 拒绝时计数的字段.
+# 返回 {0, ''} 表示通过, 否则为 {被拒绝的桶的序号(从1开始), 需要等待的秒数}
+TOKEN_BUCKET_LUA = """
+local now = tonumber(ARGV[1])
+local n = #KEYS - 1
+local tokens = {}
+for i = 1, n do
+    local capacity = tonumber(ARGV[3 * i - 1])
+    local rate = tonumber(ARGV[3 * i])
+    local bucket = redis.call('HMGET', KEYS[i], 't', 'ts')
+    local t = tonumber(bucket[1])
+    if t == nil then
+        t = capacity
+    else
+        t = math.min(capacity, t + math.max(0, now - tonumber(bucket[2])) * rate)
+    end
+    if t < 1 then
+        redis.call('HINCRBY', KEYS[n + 1], ARGV[3 * i + 1], 1)
+        return {i, tostring((1 - t) / rate)}
+    end
+    tokens[i] = t
+end
+for i = 1, n do
+    local capacity = tonumber(ARGV[3 * i - 1])
+    local rate = tonumber(ARGV[3 * i])
+    redis.call('HMSET', KEYS[i], 't', tostring(tokens[i] - 1), 'ts', ARGV[1])
+    redis.call('EXPIRE', KEYS[i], math.ceil(capacity / rate) + 1)
+end
+return {0, ''}
+"""
+_script = None
+
+
+def throttle_settings():
+    conf = dict(DEFAULT_THROTTLE)
+    conf.update(getattr(settings, 'THROTTLE', {}))
+    return conf
+
+
+def parse_rate(scope, rate):
+    # type: (str, str) -> Bucket
+    m = _rate_re.match(rate)
+    if not m:
+        raise ValueError('限流配置不正确: {}={}'.format(scope, rate))
+    return Bucket(scope, int(m.group(1)), int(m.group(2) or 1) * UNITS[m.group(3)])
+
+
+def view_buckets(view_class):
+    # type: (type) -> Tuple[str, List[Bucket]]
+    """
+    视图的 (urlname, [令牌桶]), 没有配置时桶为空
+    """
+    config = _configs.get(view_class)
+    if config is None:
+        mymeta = getattr(view_class, 'mymeta', {})
+        urlname = mymeta.get('urlname', view_class.__name__)
+        rates = throttle_settings()['RATES'].get(urlname, mymeta.get('throttles', {}))
+        # global 放在最后检查, 单个 ip/手机号的突发请求记在各自的范围上
+        scopes = sorted(rates, key=lambda scope: (scope == 'global', scope))
+        config = _configs[view_class] = (urlname, [parse_rate(scope, rates[scope]) for scope in scopes])
+    return config
+
+
+def _shed_field(urlname, scope):
+    return '{}:{}'.format(urlname, scope)
+
+
+def _consume_redis(r, urlname, buckets, idents):
+    # type: (object, str, List[Bucket], List[str]) -> Tuple[Optional[Bucket], float]
+    global _script
+    if _script is None:
+        _script = r.register_script(TOKEN_BUCKET_LUA)
+    keys = [redis_utils.make_key('throttle', urlname, b.scope, ident) for b, ident in zip(buckets, idents)]
+    args = [repr(time.time())]
+    for b in buckets:
+        args += [b.capacity, repr(float(b.capacity) / b.period), _shed_field(urlname, b.scope)]
+    rejected, wait = _script(keys=keys + [SHED_KEY], args=args)
+    if not int(rejected):
+        return None, 0
+    return buckets[int(rejected) - 1], float(wait)
+
+
+def _consume_cache(urlname, buckets, idents):
+    # type: (str, List[Bucket], List[str]) -> Tuple[Optional[Bucket], float]
+    """
+    没有 redis 时按固定时间窗口计数, 窗口内最多 capacity 次. 任一个桶拒绝时, 退回已经计入的次数
+    """
+    now = time.time()
+    taken = []
+    for b, ident in zip(buckets, idents):
+        window = int(now // b.period)
+        key = 'throttle_{}_{}_{}_{}'.format(urlname, b.scope, ident, window)
+        if cache.add(key, 1, b.period + 1):
+            taken.append(key)
+            continue
+        try:
+            count = cache.incr(key)
+        except ValueError:  # 刚好过期
+            cache.add(key, 1, b.period + 1)
+            taken.append(key)
+            continue
+        if count > b.capacity:
+            for key in taken + [key]:
+                try:
+                    cache.decr(key)
+                except ValueError:
+                    pass
+            _incr_cache_shed(urlname, b.scope)
+            return b, (window + 1) * b.period - now
+        taken.append(key)
+    return None, 0
+
+
+def _shed_cache_key(urlname, scope):
+    return 'throttle_shed_{}_{}'.format(urlname, scope)
+
+
+def _incr_cache_shed(urlname, scope):
+    key = _shed_cache_key(urlname, scope)
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, 1, None)
+
+
+def consume(urlname, buckets, idents):
+    # type: (str, List[Bucket], List[str]) -> Tuple[Optional[Bucket], float]
+    """
+    从各个桶中各取一个令牌. 返回 (None, 0) 表示通过, 否则为 (拒绝的桶, 需要等待的秒数)
+    """
+    r = redis_utils.get_redis()
+    if r is not None:
+        try:
+            return _consume_redis(r, urlname, buckets, idents)
+        except RedisError as e:
+            redis_utils.mark_down(e)
+    return _consume_cache(urlname, buckets, idents)
+
+
+def shed_counts(names):
+    # type: (List[Tuple[str, str]]) -> Dict[Tuple[str, str], int]
+    """
+    [(urlname, 范围)] 被拒绝的请求数
+    """
+    counts = OrderedDict((name, 0) for name in names)
+    r = redis_utils.get_redis()
+    if r is not None:
+        try:
+            values = r.hmget(SHED_KEY, [_shed_field(*name) for name in names]) if names else []
+            for name, value in zip(names, values):
+                counts[name] += int(value or 0)
+        except RedisError as e:
+            redis_utils.mark_down(e)
+    values = cache.get_many([_shed_cache_key(*name) for name in names])
+    for name in names:
+        counts[name] += int(values.get(_shed_cache_key(*name)) or 0)
+    return counts
+
+
+def reset_shed_counts(names):
+    # type: (List[Tuple[str, str]]) -> None
+    r = redis_utils.get_redis()
+    if r is not None:
+        try:
+            r.delete(SHED_KEY)
+        except RedisError as e:
+            redis_utils.mark_down(e)
+    cache.delete_many([_shed_cache_key(*name) for name in names])
+
+
+class MymetaThrottle(BaseThrottle):
+    """
+    按视图 mymeta['throttles'] 限流, 没有配置的视图直接通过
+    """
+    def __init__(self):
+        self._wait = None
+
+    def allow_request(self, request, view):
+        urlname, buckets = view_buckets(type(view))
+        if not buckets or not throttle_settings()['ENABLED']:
+            return True
+
+        active, idents = [], []
+        for bucket in buckets:
+            if bucket.scope == 'ip':
+                ident = self.get_ident(request)
+            elif bucket.scope == 'global':
+                ident = 'all'
+            else:
+                value = request.data.get(bucket.scope, '') if hasattr(request.data, 'get') else ''
+                value = '{}'.format(value).strip()
+                if not value:
+                    continue
+                ident = hashlib.md5(value.encode('utf-8')).hexdigest()
+            active.append(bucket)
+            idents.append(ident)
+
+        rejected, wait = consume(urlname, active, idents)
+        if rejected is None:
+            return True
+        self._wait = int(math.ceil(wait))
+        return False
+
+    def wait(self):
+        return self._wait
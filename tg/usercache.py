@@ -0,0 +1,134 @@
+# coding=utf-8
+"""
+jwt 认证时的用户缓存
+
+每个请求认证时不再按用户名查询 data_user_info, 改为按 payload 中的 user_id 读取缓存的用户快照:
+进程内 LRU(有效期很短, 见 USER_CACHE['LOCAL_TTL']) -> memcached -> 数据库.
+快照只保存除 password 外的字段值, 读取时用 UserInfo.from_db 生成新的实例(password 为延迟加载),
+各个请求之间不共用实例.
+UserInfo 保存/删除(包括修改密码)时 signals 中调用 invalidate 删除缓存,
+其他进程的进程内缓存最多在 LOCAL_TTL 秒后失效. 用 queryset.update() 批量修改后需要手动调用 invalidate.
+memcached 中的快照带有读取数据库之前的用户版本号, invalidate 时更换版本号, 版本号不同的快照不再使用:
+读取数据库之后, 写入缓存之前被 invalidate 的, 写入的旧快照不会被读到.
+
+签名验证过的 token 同样在进程内缓存, 过期前不再重复验证签名
+"""
+from __future__ import (unicode_literals, absolute_import, print_function)
+
+import numbers
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from typing import Iterable, Optional
+
+from .sanitize import LRUCache
+
+DEFAULT_USER_CACHE = {
+    # 进程内缓存的有效期(秒)及最多的用户数
+    'LOCAL_TTL': 5,
+    'LOCAL_SIZE': 10000,
+    # memcached 中的有效期(秒)
+    'TTL': 600,
+    # 进程内缓存的已验证 token 数
+    'TOKEN_SIZE': 10000,
+}
+EXCLUDE_FIELDS = ('password',)
+
+
+def user_cache_settings():
+    conf = dict(DEFAULT_USER_CACHE)
+    conf.update(getattr(settings, 'USER_CACHE', {}))
+    return conf
+
+
+_conf = user_cache_settings()
+_local = LRUCache(_conf['LOCAL_SIZE'])
+_tokens = LRUCache(_conf['TOKEN_SIZE'])
+
+
+def _key(user_id):
+    return 'authuser_{}'.format(user_id)
+
+
+def _version_key(user_id):
+    return 'authuser_version_{}'.format(user_id)
+
+
+def _new_version():
+    return uuid.uuid4().hex
+
+
+def _field_names():
+    return [f.attname for f in get_user_model()._meta.concrete_fields if f.attname not in EXCLUDE_FIELDS]
+
+
+def _load_snapshot(user_id):
+    # type: (int) -> Optional[tuple]
+    """
+    从数据库读取, 返回各字段值的 tuple, 用户不存在时返回 None
+    """
+    rows = list(get_user_model().objects.filter(pk=user_id).values_list(*_field_names())[:1])
+    return rows[0] if rows else None
+
+
+def _snapshot(user_id):
+    # type: (int) -> Optional[tuple]
+    now = time.time()
+    local = _local.get(user_id)
+    if local is not None and local[0] > now:
+        return local[1]
+    key, version_key = _key(user_id), _version_key(user_id)
+    values = cache.get_many([key, version_key])
+    cached, version = values.get(key), values.get(version_key)
+    if cached is not None and version is not None and cached[0] == version:
+        snapshot = cached[1]
+    else:
+        if version is None:
+            cache.add(version_key, _new_version(), None)
+            version = cache.get(version_key)
+        snapshot = _load_snapshot(user_id)
+        if snapshot is None:
+            return None
+        cache.set(key, (version, snapshot), _conf['TTL'])
+    _local.set(user_id, (now + _conf['LOCAL_TTL'], snapshot))
+    return snapshot
+
+
+def get_user(user_id):
+    """
+    按 id 取用户, 不存在时返回 None. 每次返回新的实例, password 字段在用到时才查询
+    """
+    snapshot = _snapshot(user_id)
+    if snapshot is None:
+        return None
+    return get_user_model().from_db(DEFAULT_DB_ALIAS, _field_names(), snapshot)
+
+
+def invalidate(user_ids):
+    # type: (Iterable[int]) -> None
+    user_ids = list(user_ids)
+    for user_id in user_ids:
+        _local.set(user_id, (0, None))
+    cache.set_many({_version_key(user_id): _new_version() for user_id in user_ids}, None)
+    cache.delete_many([_key(user_id) for user_id in user_ids])
+
+
+def get_token_payload(token):
+    # type: (str) -> Optional[dict]
+    """
+    验证过签名且还没有过期的 token 的 payload, 没有时返回 None
+    """
+    memo = _tokens.get(token)
+    if memo is None or memo['exp'] <= time.time():
+        return None
+    return memo
+
+
+def remember_token(token, payload):
+    # type: (str, dict) -> None
+    if isinstance(payload.get('exp'), numbers.Real):
+        _tokens.set(token, payload)
@@ -1,6 +1,9 @@
 # coding=utf-8
 from __future__ import (unicode_literals, absolute_import, print_function)
 
+import csv
+import io
+import json
 import logging
 from calendar import timegm
 from datetime import datetime
@@ -93,6 +96,31 @@ def dictfetchone(cursor):
     return dict(zip([col[0] for col in desc], row)) if row else {}
 
 
+def iter_records(path):
+    # type: (str) -> Iterable[dict]
+    """
+    逐行读取数据文件, 每行返回一个 dict. 按扩展名区分格式:
+    .csv 第一行为表头, 字段数多于表头的行抛出 ValueError; .jsonl 每行一个json对象; .json 为json数组
+    """
+    if path.endswith('.csv'):
+        with open(path, 'rb') as f:
+            reader = csv.DictReader(f)
+            for row in reader:
+                if None in row:  # DictReader 把多出的字段放在键 None 下
+                    raise ValueError('{} 第 {} 行的字段数多于表头'.format(path, reader.line_num))
+                yield {k.decode('utf-8-sig').strip(): (v or b'').decode('utf-8').strip() for k, v in row.items()}
+    elif path.endswith('.json'):
+        with io.open(path, encoding='utf-8') as f:
+            for row in json.load(f):
+                yield row
+    else:
+        with io.open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
 def get_random_string(length=6, allowed_chars='abcdefghijklmnopqrstuvwxyz23456789'):
     return crypto.get_random_string(length, allowed_chars)
 
@@ -3,13 +3,10 @@ from __future__ import (unicode_literals, absolute_import, print_function)
 
 import arrow
 import jwt
-import random
 from datetime import timedelta, datetime
 from django.utils import timezone
 from django.contrib.auth import authenticate, update_session_auth_hash
 from django.core.cache import cache
-from django.db import transaction
-from django.db import models as djangomodels
 from django.conf import settings
 
 from rest_framework.compat import set_rollback
@@ -25,11 +22,16 @@ from rest_framework.generics import (GenericAPIView, CreateAPIView, ListAPIView,
 from rest_framework import (status, exceptions, serializers, permissions, renderers)
 from rest_framework_jwt.settings import api_settings as jwt_api_settings
 
-from . import utils, serializers as tg_serializers, models
+from . import (utils, serializers as tg_serializers, models, feed, homepage, leaderboard, navstore, prerender, quotes,
+               relcache, respcache, search, secindex)
+from .mixins import RelatedFieldsMixin
 from .utils import ok_data, fail_data, fail_response_withseria, securitycode_key
 
 apiseq = 1
 
+# 投顾信息(InvestAdviserBaseInfoSerializer)依赖的模型, 用于响应缓存, 见 respcache.py
+ADVISER_MODELS = (models.InvestAdviserInfo, models.UserInfo, models.UserStatistic, models.InvestAdviserKpi)
+
 
 def my_exception_handler(exc, context):
     """
@@ -126,6 +128,7 @@ LoginView.mymeta = {
     'urlname': 'UrlLoginView',
     'urlkwargs': {},
     'seq': apiseq,
+    'throttles': {'ip': '20/m', 'username': '10/10m', 'global': '20/s'},
 }
 apiseq += 1
 
@@ -200,7 +203,7 @@ CheckJwtToken.mymeta = {
 apiseq += 1
 
 
-class InvestAdviser4Index(GenericAPIView):
+class InvestAdviser4Index(RelatedFieldsMixin, GenericAPIView):
     """
     首页推荐牛投
     """
@@ -212,15 +215,17 @@ class InvestAdviser4Index(GenericAPIView):
         ids = range(1, 10)  # 投顾ids
         qs = models.InvestAdviserInfo.objects.filter(
             user_id__in=ids
-        ).prefetch_related(
-            'user', 'user__investadviserkpi'
-        )[:3]
+        )
         return qs
 
-    def get(self, request, *args, **kwargs):
-        qs = self.get_queryset()
+    def section(self, request):
+        qs = self.filter_queryset(self.get_queryset())[:3]
         serializer = self.get_serializer(qs, many=True)
-        return Response(serializer.data)
+        return {'invest_advisers': serializer.data}
+
+    @respcache.cache_response(*ADVISER_MODELS)
+    def get(self, request, *args, **kwargs):
+        return Response(self.section(request)['invest_advisers'])
 InvestAdviser4Index.mymeta = {
     'myurl': r'^invest_adviser/4index/$',
     'urlname': 'UrlInvestAdviser4Index',
@@ -230,26 +235,24 @@ InvestAdviser4Index.mymeta = {
 apiseq += 1
 
 
-class InvestAdviserSearch(GenericAPIView):
+class InvestAdviserSearch(RelatedFieldsMixin, GenericAPIView):
     """
     按分类获取牛投顾列表
     type	str	搜索类别:1:综合排名; 2:荐股成功率; 4:累计收益率
     """
     permission_classes = (permissions.AllowAny,)
     serializer_class = tg_serializers.InvestAdviserBaseInfoSerializer
+    # 按排行榜分页的类别, 见 leaderboard.py. 综合得分由 manage.py compute_adviser_kpi 预先计算, 见 kpi.py
+    boards = {'1': 'adviser_composite', '2': 'adviser_success', '4': 'adviser_profit'}
 
     def get_queryset(self):
         typev = self.request.query_params.get('type', None)
         qs = models.InvestAdviserInfo.objects.all()
-        if typev == '1':
-            pass
-            # qs = qs.order_by('-user__investadviserkpi__success_ratio')
-        elif typev == '2':
-            qs = qs.order_by('user__investadviserkpi__success_ratio')
-        elif typev == '4':
-            qs = qs.order_by('-user__investadviserkpi__accumulate_profit_ratio')
+        if typev in self.boards:
+            return leaderboard.BoardList(leaderboard.get_board(self.boards[typev]), qs)
         return qs
 
+    @respcache.cache_response(*ADVISER_MODELS)
     def get(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
         page = self.paginate_queryset(queryset)
@@ -269,7 +272,7 @@ InvestAdviserSearch.mymeta = {
 apiseq += 1
 
 
-class InvestAdviserBaseInfo(GenericAPIView):
+class InvestAdviserBaseInfo(RelatedFieldsMixin, GenericAPIView):
     """
     投顾基本信息
     """
@@ -279,6 +282,7 @@ class InvestAdviserBaseInfo(GenericAPIView):
     serializer_class = tg_serializers.InvestAdviserBaseInfoSerializer
     queryset = models.InvestAdviserInfo.objects.all()
 
+    @respcache.cache_response(*ADVISER_MODELS)
     def get(self, request, *args, **kwargs):
         instance = self.get_object()
         serializer = self.get_serializer(instance)
@@ -298,6 +302,7 @@ class InvestAdviserResume(APIView):
     """
     permission_classes = (permissions.AllowAny,)
 
+    @respcache.cache_response(models.InvestAdviserInfo)
     def get(self, request, *args, **kwargs):
         pk = int(self.kwargs.get('pk'))
         obj = get_object_or_404(models.InvestAdviserInfo.objects.filter(user_id=pk))
@@ -317,12 +322,13 @@ InvestAdviserResume.mymeta = {
 apiseq += 1
 
 
-class InvestAdviserInvestViewpoint(GenericAPIView):
+class InvestAdviserInvestViewpoint(RelatedFieldsMixin, GenericAPIView):
     """
     投顾投资观点(分页)
     """
     permission_classes = (permissions.AllowAny,)
     serializer_class = tg_serializers.InvestViewpointSerializer
+    cursor_ordering = ('-pub_daytime',)  # 支持 ?cursor= 游标分页, 见 pagination.py
 
     def get_serializer_context(self):
         context = super(InvestAdviserInvestViewpoint, self).get_serializer_context()
@@ -336,6 +342,7 @@ class InvestAdviserInvestViewpoint(GenericAPIView):
             '-pub_daytime'
         )
 
+    @respcache.cache_response(models.InvestViewpoint)
     def get(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
         page = self.paginate_queryset(queryset)
@@ -359,8 +366,8 @@ class InvestViewpointInfo(GenericAPIView):
     renderer_classes = (renderers.TemplateHTMLRenderer,)
 
     def get(self, request, *args, **kwargs):
-        viewpoint = get_object_or_404(models.InvestViewpoint.objects.all(), pk=kwargs['pk'])
-        return Response({'vp': viewpoint}, template_name='tg/investviewpointinfo.html')
+        # 保存后预先渲染好的页面, 见 prerender.py
+        return prerender.page_response(request, 'viewpoint', kwargs['pk'])
 
 InvestViewpointInfo.mymeta = {
     'myurl': r'^invest_viewpoint_info/(?P<pk>[\w-]+)/$',
@@ -371,12 +378,13 @@ InvestViewpointInfo.mymeta = {
 apiseq += 1
 
 
-class InvestAdviserRecommendSecurity(GenericAPIView):
+class InvestAdviserRecommendSecurity(RelatedFieldsMixin, GenericAPIView):
     """
     投顾推荐股票 (分页)
     """
     permission_classes = (permissions.AllowAny,)
     serializer_class = tg_serializers.RecommendSecuritySerializer
+    cursor_ordering = ('-ctime',)  # 支持 ?cursor= 游标分页, 见 pagination.py
 
     def get_serializer_context(self):
         context = super(InvestAdviserRecommendSecurity, self).get_serializer_context()
@@ -397,8 +405,7 @@ class InvestAdviserRecommendSecurity(GenericAPIView):
         pagedata = self.get_paginated_response(serializer.data).data
         resultdata = pagedata['results']
         secids = [item['sec_idxid'] for item in resultdata]  # SZSE.000001 这样的格式
-        # sechqmap = md.get_last_ticks(secids)
-        sechqmap = [{}]
+        sechqmap = quotes.get_last_ticks(secids)
         for item in resultdata:
             item.update(**sechqmap.get(item['sec_idxid'], {}))
         return Response(ok_data(data={'recommend_secs':pagedata}))
@@ -410,12 +417,13 @@ InvestAdviserRecommendSecurity.mymeta = {
 }
 
 
-class InvestAdviserPortfolio(GenericAPIView):
+class InvestAdviserPortfolio(RelatedFieldsMixin, GenericAPIView):
     """
     投顾投资组合 (分页)
     """
     permission_classes = (permissions.AllowAny,)
     serializer_class = tg_serializers.PortfolioBaseinfoSerializer
+    cursor_ordering = ('-ctime',)  # 支持 ?cursor= 游标分页, 见 pagination.py
 
     def get_serializer_context(self):
         context = super(InvestAdviserPortfolio, self).get_serializer_context()
@@ -429,6 +437,7 @@ class InvestAdviserPortfolio(GenericAPIView):
             '-ctime'
         )
 
+    @respcache.cache_response(models.PortfolioBaseInfo)
     def get(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
         page = self.paginate_queryset(queryset)
@@ -450,10 +459,13 @@ class Security4Indexprice(GenericAPIView):
     """
     permission_classes = (permissions.AllowAny,)
 
-    def get(self, request, *args, **kwargs):
+    def section(self, request):
         secids = ['SHSE.000001', 'SZSE.399001', 'SZSE.399005', 'SZSE.399006']  # 要查询行情的代码
-        sechqmap = [{}]
-        return Response(ok_data(data={'secs': sechqmap.values()}))
+        sechqmap = quotes.get_last_ticks(secids)
+        return {'secs': [sechqmap[s] for s in secids if s in sechqmap]}
+
+    def get(self, request, *args, **kwargs):
+        return Response(ok_data(data=self.section(request)))
 Security4Indexprice.mymeta = {
     'myurl': r'^security/4indexprice/$',
     'urlname': 'UrlSecurity4Indexprice',
@@ -463,28 +475,108 @@ Security4Indexprice.mymeta = {
 apiseq += 1
 
 
+class SecuritySuggest(GenericAPIView):
+    """
+    股票代码联想. 按代码、名称或拼音首字母前缀查找
+    q	str	输入的内容. 如 600, 平安, payh
+    limit	int	最多返回的条数, 默认10, 最大50
+    """
+    permission_classes = (permissions.AllowAny,)
+
+    def get(self, request, *args, **kwargs):
+        q = request.query_params.get('q', '')
+        try:
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), 50)
+        except ValueError:
+            limit = 10
+        return Response(ok_data(data={'secs': secindex.search(q, limit)}))
+SecuritySuggest.mymeta = {
+    'myurl': r'^security/suggest/$',
+    'urlname': 'UrlSecuritySuggest',
+    'urlkwargs': {},
+    'queryparam': 'q=600',
+    'seq': apiseq
+}
+apiseq += 1
+
+
+class Search(GenericAPIView):
+    """
+    资讯及投资观点全文检索, 按标题、摘要、内容的相关度排序
+    q	str	搜索内容
+    type	str	news: 资讯, viewpoint: 投资观点, 默认全部
+    page	int	页码, 从1开始
+    page_size	int	每页条数, 默认10, 最大50
+    """
+    permission_classes = (permissions.AllowAny,)
+    detail_urlnames = {'news': 'UrlNewsInfo', 'viewpoint': 'UrlInvestViewpointInfo'}
+
+    def get(self, request, *args, **kwargs):
+        q = request.query_params.get('q', '').strip()
+        kind = request.query_params.get('type', '')
+        kinds = [kind] if kind in search.KINDS else None
+        try:
+            page = max(int(request.query_params.get('page', 1)), 1)
+            page_size = min(max(int(request.query_params.get('page_size', 10)), 1), 50)
+        except ValueError:
+            page, page_size = 1, 10
+        count, hits = search.search(q, kinds, (page - 1) * page_size, page_size)
+
+        objs = {}
+        for k, model in (('news', models.News), ('viewpoint', models.InvestViewpoint)):
+            ids = [pk for hit_kind, pk, score in hits if hit_kind == k]
+            if ids:
+                objs[k] = model.objects.only('id', 'title', 'digest', 'pub_daytime').in_bulk(ids)
+        results = []
+        for hit_kind, pk, score in hits:
+            obj = objs.get(hit_kind, {}).get(pk)
+            if obj is None:  # 已删除, 索引还没有更新
+                continue
+            results.append({
+                'type': hit_kind,
+                'id': obj.id,
+                'title': obj.title,
+                'digest': obj.digest,
+                'pub_daytime': obj.pub_daytime,
+                'html5': reverse(self.detail_urlnames[hit_kind], kwargs={'pk': obj.id}, request=request),
+                'score': round(score, 4),
+            })
+        return Response(ok_data(data={'docs': {'count': count, 'results': results}}))
+Search.mymeta = {
+    'myurl': r'^search/$',
+    'urlname': 'UrlSearch',
+    'urlkwargs': {},
+    'queryparam': 'q=平安',
+    'seq': apiseq
+}
+apiseq += 1
+
+
 class News4index(GenericAPIView):
     """
     首页推荐资讯
     """
     permission_classes = (permissions.AllowAny,)
 
+    def section(self, request):
+        return {
+            "news": [
+                {
+                    "id": 12,
+                    "title": "标题",
+                    "digest": "fsdafasdfsdfasd",
+                    "pub_daytime": "2016-03-10 10:10:10",
+                    "sub_picture": "http://mypic.com/1.png",
+                    "topics": "今日头条",
+                }
+            ]
+        }
+
     def get(self, request, *args, **kwargs):
         data = {
             "success": True,
             "msg": "说明信息",
-            "data": {
-                "news": [
-                    {
-                        "id": 12,
-                        "title": "标题",
-                        "digest": "fsdafasdfsdfasd",
-                        "pub_daytime": "2016-03-10 10:10:10",
-                        "sub_picture": "http://mypic.com/1.png",
-                        "topics": "今日头条",
-                    }
-                ]
-            }
+            "data": self.section(request)
         }
         return Response(data)
 News4index.mymeta = {
@@ -496,7 +588,7 @@ News4index.mymeta = {
 apiseq += 1
 
 
-class NewsType(GenericAPIView):
+class NewsType(RelatedFieldsMixin, GenericAPIView):
     """
     按分类获取资讯列表(分页)
     type	str	类别:1:市场要闻; 2:市场评论
@@ -513,6 +605,7 @@ class NewsType(GenericAPIView):
 
     permission_classes = (permissions.AllowAny,)
     serializer_class = NewsSerializer
+    cursor_ordering = ('-pub_daytime',)  # 支持 ?cursor= 游标分页, 见 pagination.py
 
     def get_queryset(self):
         t = self.request.query_params.get('type', '0')
@@ -524,6 +617,7 @@ class NewsType(GenericAPIView):
 
         return queryset
 
+    @respcache.cache_response(models.News)
     def get(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
         page = self.paginate_queryset(queryset)
@@ -548,8 +642,8 @@ class NewsInfo(GenericAPIView):
     renderer_classes = (renderers.TemplateHTMLRenderer,)
 
     def get(self, request, *args, **kwargs):
-        news = get_object_or_404(models.News.objects.all(), pk=kwargs['pk'])
-        return Response({'news': news}, template_name='tg/newsinfo.html')
+        # 保存后预先渲染好的页面, 见 prerender.py
+        return prerender.page_response(request, 'news', kwargs['pk'])
 NewsInfo.mymeta = {
     'myurl': r'^newsinfo/(?P<pk>[\d]+)/$',
     'urlname': 'UrlNewsInfo',
@@ -559,7 +653,7 @@ NewsInfo.mymeta = {
 apiseq += 1
 
 
-class RecommendSecurity4index(GenericAPIView):
+class RecommendSecurity4index(RelatedFieldsMixin, GenericAPIView):
     """
     首页推荐牛股
     """
@@ -569,18 +663,20 @@ class RecommendSecurity4index(GenericAPIView):
     def get_queryset(self):
         return models.InvestRecommendSecurity.objects \
             .filter(ctime__gte=timezone.now() - timedelta(days=60))\
-            .prefetch_related('owner')\
-            .order_by('-accumulate_ratio')[:3]
+            .order_by('-accumulate_ratio')
 
-    def get(self, request, *args, **kwargs):
-        queryset = self.filter_queryset(self.get_queryset())
+    def section(self, request):
+        queryset = self.filter_queryset(self.get_queryset())[:3]
         serializer = self.get_serializer(queryset, many=True)
         resultdata = serializer.data
         secids = [item['sec_idxid'] for item in resultdata]  # SZSE.000001 这样的格式
-        sechqmap = [{}]
+        sechqmap = quotes.get_last_ticks(secids)
         for item in resultdata:
             item.update(**sechqmap.get(item['sec_idxid'], {}))
-        return Response(ok_data(data={'recommend_secs': resultdata}))
+        return {'recommend_secs': resultdata}
+
+    def get(self, request, *args, **kwargs):
+        return Response(ok_data(data=self.section(request)))
 RecommendSecurity4index.mymeta = {
     'myurl': r'^recommend_security/4index/$',
     'urlname': 'UrlRecommendSecurity4index',
@@ -590,17 +686,17 @@ RecommendSecurity4index.mymeta = {
 apiseq += 1
 
 
-class RecommendSecurity(GenericAPIView):
+class RecommendSecurity(RelatedFieldsMixin, GenericAPIView):
     """
     牛股列表 (分页)
     """
     permission_classes = (permissions.AllowAny,)
     serializer_class = tg_serializers.RecommendSecuritySerializer
+    cursor_ordering = ('-accumulate_ratio',)  # 支持 ?cursor= 游标分页, 见 pagination.py
 
     def get_queryset(self):
         return models.InvestRecommendSecurity.objects \
             .filter(ctime__gte=timezone.now() - timedelta(days=60))\
-            .prefetch_related('owner')\
             .order_by('-accumulate_ratio')
 
     def get(self, request, *args, **kwargs):
@@ -610,7 +706,7 @@ class RecommendSecurity(GenericAPIView):
         pagedata = self.get_paginated_response(serializer.data).data
         resultdata = pagedata['results']
         secids = [item['sec_idxid'] for item in resultdata]  # SZSE.000001 这样的格式
-        sechqmap = [{}]
+        sechqmap = quotes.get_last_ticks(secids)
         for item in resultdata:
             item.update(**sechqmap.get(item['sec_idxid'], {}))
         return Response(ok_data(data={'recommend_secs': pagedata}))
@@ -623,28 +719,29 @@ RecommendSecurity.mymeta = {
 apiseq += 1
 
 
-class PortfolioSearch(GenericAPIView):
+class PortfolioSearch(RelatedFieldsMixin, GenericAPIView):
     """
     按分类获取牛组合列表(分页)
     type	str	搜索类别:1:当日收益; 2:周收益; 3:月收益; 4:累计收益
     """
     permission_classes = (permissions.AllowAny,)
     serializer_class = tg_serializers.PortfolioBaseinfoSerializer
+    # 按排行榜分页, 见 leaderboard.py
+    boards = {
+        '1': 'portfolio_curdate',
+        '2': 'portfolio_week',
+        '3': 'portfolio_month',
+        '4': 'portfolio_accumulate',
+    }
 
     def get_queryset(self):
         typev = self.request.query_params.get('type', None)
-        qs = models.PortfolioBaseInfo.objects.all().prefetch_related('owner')
-        if typev == '1':
-            qs = qs.order_by('-curdate_ratio')
-        elif typev == '2':
-            qs = qs.order_by('-week_ratio')
-        elif typev == '3':
-            qs = qs.order_by('-month_ratio')
-        elif typev == '4':
-            qs = qs.order_by('-accumulate_ratio')
-
+        qs = models.PortfolioBaseInfo.objects.all()
+        if typev in self.boards:
+            return leaderboard.BoardList(leaderboard.get_board(self.boards[typev]), qs)
         return qs
 
+    @respcache.cache_response(models.PortfolioBaseInfo, models.UserInfo, models.InvestAdviserInfo)
     def get(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
         page = self.paginate_queryset(queryset)
@@ -664,7 +761,7 @@ PortfolioSearch.mymeta = {
 apiseq += 1
 
 
-class PortfolioBaseinfo(GenericAPIView):
+class PortfolioBaseinfo(RelatedFieldsMixin, GenericAPIView):
     """
     牛组合基本信息
     """
@@ -672,6 +769,7 @@ class PortfolioBaseinfo(GenericAPIView):
     serializer_class = tg_serializers.PortfolioBaseinfoSerializer
     queryset = models.PortfolioBaseInfo.objects.all()
 
+    @respcache.cache_response(models.PortfolioBaseInfo, models.UserInfo, models.InvestAdviserInfo)
     def get(self, request, *args, **kwargs):
         instance = self.get_object()
         serializer = self.get_serializer(instance)
@@ -726,47 +824,53 @@ apiseq += 1
 class PortfolioProfit(GenericAPIView):
     """
     牛组合收益走势
+    start	str	开始日期, 如 2016-09-05. 默认为最早
+    end	str	结束日期, 如 2016-10-31. 默认为最新
     """
     permission_classes = (permissions.AllowAny,)
 
-    def get(self, request, *args, **kwargs):
-        result = []
-        baseline_result = []
-        start = datetime(2016, 9, 5, 9, 30)
-        end = datetime(2016, 10, 31, 15, 00)
-        for idx, item in enumerate(arrow.Arrow.range('day', start, end)):
-            v = random.randrange(10, 50, 2)
-            result.append({
-                'id': idx + 10,
-                'trade_time': item.format('YYYY-MM-DD HH:mm:ss'),
-                'profit_ratio': v,
-            })
-            baseline_result.append({
-                'id': idx + 20,
-                'trade_time': item.format('YYYY-MM-DD HH:mm:ss'),
-                'profit_ratio': v + 5
-            })
-
+    @staticmethod
+    def parse_day(value, end_of_day=False):
+        if not value:
+            return None
+        try:
+            day = arrow.get(value, 'YYYY-MM-DD')
+        except (arrow.parser.ParserError, ValueError):
+            raise exceptions.ValidationError('日期格式不对: {}'.format(value))
+        return (day.ceil('day') if end_of_day else day).timestamp
 
+    def get(self, request, *args, **kwargs):
+        portfolio = get_object_or_404(models.PortfolioBaseInfo.objects.only('id', 'name'), pk=kwargs['id'])
+        series = navstore.read(
+            portfolio.id,
+            self.parse_day(request.query_params.get('start')),
+            self.parse_day(request.query_params.get('end'), end_of_day=True),
+        )
+        trade_times = [datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S') for ts in series.ts.tolist()]
+        result = [
+            {'id': idx, 'trade_time': t, 'profit_ratio': v}
+            for idx, (t, v) in enumerate(zip(trade_times, series.nav.tolist()))
+        ]
+        baseline_result = [
+            {'id': idx, 'trade_time': t, 'profit_ratio': v}
+            for idx, (t, v) in enumerate(zip(trade_times, series.bench.tolist()))
+        ]
+        bench_sec_id, bench_sec_name = settings.NAVSTORE_BENCHMARK
         data = {
-            "success": True,
-            "msg": "说明信息",
-            "data": {
-                "holds": {
-                    "count": 300,
-                    'sec_name': '牛投寒风组合2',
-                    "result": result,
-                },
-                "baselines": {
-                    'sec_id': 'szsz.000001',
-                    'sec_name': '沪深300',
-                    'result': baseline_result
-                }
+            "holds": {
+                "count": len(result),
+                'sec_name': portfolio.name,
+                "result": result,
+            },
+            "baselines": {
+                'sec_id': bench_sec_id,
+                'sec_name': bench_sec_name,
+                'result': baseline_result
             }
         }
-        return Response(data)
+        return Response(ok_data(data=data))
 PortfolioProfit.mymeta = {
-    'myurl': r'^portfolio/(?P<id>[\w-]+)/profit/$',
+    'myurl': r'^portfolio/(?P<id>[\d]+)/profit/$',
     'urlname': 'UrlPortfolioProfit',
     'urlkwargs': {'id': '1234'},
     'seq': apiseq
@@ -823,10 +927,14 @@ class Ad4index(GenericAPIView):
     serializer_class = AdSerializer
     queryset = models.Ad.objects.filter(isvalid=True).order_by('-ctime', '-id')[0:4]
 
-    def get(self, request, *args, **kwargs):
+    def section(self, request):
         qs = self.filter_queryset(self.get_queryset())
         seria = self.get_serializer(qs, many=True)
-        return Response(ok_data(data={'ads': seria.data}))
+        return {'ads': seria.data}
+
+    @respcache.cache_response(models.Ad)
+    def get(self, request, *args, **kwargs):
+        return Response(ok_data(data=self.section(request)))
 
 
 Ad4index.mymeta = {
@@ -838,6 +946,38 @@ Ad4index.mymeta = {
 apiseq += 1
 
 
+class Index(APIView):
+    """
+    首页聚合数据: 广告, 推荐牛投, 指数行情, 推荐牛股, 推荐资讯. 一次请求取得首页的全部数据, 见 homepage.py
+    """
+    permission_classes = (permissions.AllowAny,)
+    # 各部分取数据的视图, 与单独的接口返回相同的数据
+    section_views = (
+        ('ads', Ad4index),
+        ('invest_advisers', InvestAdviser4Index),
+        ('secs', Security4Indexprice),
+        ('recommend_secs', RecommendSecurity4index),
+        ('news', News4index),
+    )
+
+    def get_sections(self):
+        return [
+            (name, view_class(request=self.request, args=(), kwargs={}, format_kwarg=None).section)
+            for name, view_class in self.section_views
+        ]
+
+    def get(self, request, *args, **kwargs):
+        data = homepage.shared_data(request, self.get_sections())
+        return Response(ok_data(data=homepage.overlay_user(request, data)))
+Index.mymeta = {
+    'myurl': r'^index/$',
+    'urlname': 'UrlIndex',
+    'urlkwargs': {},
+    'seq': apiseq
+}
+apiseq += 1
+
+
 class OtherApplyJobGet(GenericAPIView):
     """
     投顾招聘(申请投顾)(展示页面)
@@ -911,8 +1051,9 @@ class OtherHangqing(GenericAPIView):
 
     def get(self, request, *args, **kwargs):
         sec_ids = self.request.query_params.get('sec_ids', 'SHSE.600000')
-        sechqmap = [{}]
-        return Response(ok_data(data={'secs': sechqmap.values()}))
+        secids = [item.strip() for item in sec_ids.split(',') if item.strip()]
+        sechqmap = quotes.get_last_ticks(secids)
+        return Response(ok_data(data={'secs': [sechqmap[s] for s in secids if s in sechqmap]}))
 OtherHangqing.mymeta = {
     'myurl': r'^other/hangqing/$',
     'urlname': 'UrlOtherHangqing',
@@ -1099,7 +1240,8 @@ RebindMobile.mymeta = {
     'myurl': r'^user/rebindmobile/$',
     'urlname': 'urlRebindMobile',
     'urlkwargs': {},
-    'seq': apiseq
+    'seq': apiseq,
+    'throttles': {'ip': '5/m', 'new_mobile': '5/10m', 'global': '10/s'},
 }
 apiseq += 1
 
@@ -1119,37 +1261,12 @@ class FollowInvestAdviser(GenericAPIView):
         if seria.is_valid():
             ids = set(item for item in seria.data['ids'].split(',') if item and item.isdigit())
             if request.query_params.get('action', None) == 'cancel':
-                cancel_followeeids = []
-                with transaction.atomic():
-                    for avid in ids:
-                        deleted, _rows_count = models.SnsFollow.objects.filter(
-                            user=request.user,
-                            followee_id=avid
-                        ).delete()
-                        if deleted > 0:
-                            models.UserStatistic.objects.filter(user=request.user).update(
-                                followings_count=djangomodels.F('followings_count') - 1
-                            )
-                            models.UserStatistic.objects.filter(user_id=avid).update(
-                                fans_count=djangomodels.F('fans_count') - 1
-                            )
-                            cancel_followeeids.append(avid)
-                return Response(ok_data('取消关注投顾成功', data={'cancel_followeeids': cancel_followeeids}))
+                cancel_followeeids = models.SnsFollow.objects.unfollow_many(request.user, ids)
+                return Response(ok_data('取消关注投顾成功', data={'cancel_followeeids': [str(i) for i in cancel_followeeids]}))
             else:
-                followeeids = []
-                with transaction.atomic():
-                    for avid in ids:
-                        # 投顾要存在且用户还没有关注
-                        if models.UserInfo.objects.filter(
-                            pk=avid
-                        ).exists() and not models.SnsFollow.objects.filter(
-                            user=request.user,
-                            followee_id=avid
-                        ).exists():
-
-                            models.SnsFollow.objects.create(user=request.user, followee_id=avid)
-                            followeeids.append(avid)
-                return Response(ok_data('关注投顾成功', data={'followeeids': followeeids}))
+                # 投顾要存在且用户还没有关注
+                followeeids = models.SnsFollow.objects.follow_many(request.user, ids)
+                return Response(ok_data('关注投顾成功', data={'followeeids': [str(i) for i in followeeids]}))
         else:
             return fail_response_withseria(seria)
 FollowInvestAdviser.mymeta = {
@@ -1176,36 +1293,12 @@ class SubscribePortfolio(GenericAPIView):
         if seria.is_valid():
             ids = set(item for item in seria.data['ids'].split(',') if item and item.isdigit())
             if request.query_params.get('action', None) == 'cancel':
-                cancelids = []
-                with transaction.atomic():
-                    for pid in ids:
-                        deleted, _rows_count = models.SubscribePortfolio.objects.filter(
-                            user=request.user,
-                            portfolio_id=pid
-                        ).delete()
-                        if deleted > 0:
-                            models.UserStatistic.objects.filter(
-                                user_id=models.PortfolioBaseInfo.objects.only('owner_id').get(pk=pid).owner_id
-                            ).update(
-                                portfolios_bysubscribe_count=djangomodels.F('portfolios_bysubscribe_count') - 1
-                            )
-                            cancelids.append(pid)
-                return Response(ok_data('取消订阅成功', data={"cancelids": cancelids}))
+                cancelids = models.SubscribePortfolio.objects.unsubscribe_many(request.user, ids)
+                return Response(ok_data('取消订阅成功', data={"cancelids": [str(i) for i in cancelids]}))
             else:
-                subscribeids = []
-                with transaction.atomic():
-                    for pid in ids:
-                        # 投顾要存在且用户还没有关注
-                        if models.PortfolioBaseInfo.objects.filter(
-                            pk=pid
-                        ).exists() and not models.SubscribePortfolio.objects.filter(
-                            user=request.user,
-                            portfolio_id=pid
-                        ).exists():
-
-                            models.SubscribePortfolio.objects.create(user=request.user, portfolio_id=pid)
-                            subscribeids.append(pid)
-                return Response(ok_data('订阅牛组合成功', data={'subscribeids': subscribeids}))
+                # 组合要存在且用户还没有订阅
+                subscribeids = models.SubscribePortfolio.objects.subscribe_many(request.user, ids)
+                return Response(ok_data('订阅牛组合成功', data={'subscribeids': [str(i) for i in subscribeids]}))
         else:
             return fail_response_withseria(seria)
 SubscribePortfolio.mymeta = {
@@ -1217,6 +1310,47 @@ SubscribePortfolio.mymeta = {
 apiseq += 1
 
 
+class UserFeedViewpoint(RelatedFieldsMixin, GenericAPIView):
+    """
+    关注的投顾的投资观点, 按发布时间倒序(需要jwttoken). 见 feed.py
+    第一页不带 cursor, 之后的页带上一页返回的 next. page_size 默认10, 最大50
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    serializer_class = tg_serializers.InvestViewpointSerializer
+    max_page_size = 50
+
+    def get_queryset(self):
+        return models.InvestViewpoint.objects.all()
+
+    def get(self, request, *args, **kwargs):
+        paginator = self.paginator
+        page_size = min(paginator.get_page_size(request), self.max_page_size)
+        before = None
+        cursor = request.query_params.get(paginator.cursor_query_param)
+        if cursor:
+            before = paginator.decode_cursor(cursor)
+            if len(before) != 2 or not all(isinstance(v, int) for v in before):
+                raise exceptions.NotFound('无效的cursor')
+            before = tuple(before)
+
+        items = feed.read(request.user.pk, before, page_size)
+        objs = self.filter_queryset(self.get_queryset()).in_bulk([vid for _ts, vid in items])
+        # 已删除的观点, 以及取消关注后还没有从时间线中移除的不返回
+        followees = relcache.request_ids(request, 'followees')
+        page = [objs[vid] for _ts, vid in items if vid in objs and objs[vid].owner_id in followees]
+        next_cursor = paginator.encode_cursor(list(items[-1])) if len(items) == page_size else None
+
+        serializer = self.get_serializer(page, many=True)
+        return Response(ok_data(data={'viewpoints': {'next': next_cursor, 'results': serializer.data}}))
+UserFeedViewpoint.mymeta = {
+    'myurl': r'^user/feed/viewpoint/$',
+    'urlname': 'urlUserFeedViewpoint',
+    'urlkwargs': {},
+    'seq': apiseq
+}
+apiseq += 1
+
+
 class SendSecurityCode(GenericAPIView):
     """
     给手机号发送验证码
@@ -1240,7 +1374,8 @@ SendSecurityCode.mymeta = {
     'myurl': r'^send_securitycode/$',
     'urlname': 'urlSendSecurityCode',
     'urlkwargs': {},
-    'seq': apiseq
+    'seq': apiseq,
+    'throttles': {'ip': '10/10m', 'mobile': '3/10m', 'global': '20/s'},
 }
 apiseq += 1
 
@@ -1317,7 +1452,8 @@ UserRegister.mymeta = {
     'myurl': r'^user_register/$',
     'urlname': 'urlUserRegister',
     'urlkwargs': {},
-    'seq': apiseq
+    'seq': apiseq,
+    'throttles': {'ip': '5/m', 'mobile': '5/10m', 'global': '10/s'},
 }
 apiseq += 1
 
@@ -1365,7 +1501,8 @@ ForgetPasswd.mymeta = {
     'myurl': r'^forget_passwd/$',
     'urlname': 'urlForgetPasswd',
     'urlkwargs': {},
-    'seq': apiseq
+    'seq': apiseq,
+    'throttles': {'ip': '5/m', 'mobile': '5/10m', 'global': '10/s'},
 }
 apiseq += 1
 
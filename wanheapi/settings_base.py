@@ -192,6 +192,11 @@ REST_FRAMEWORK = {
 
     'TIME_FORMAT': '%H:%M:%S',
     'TIME_INPUT_FORMATS': ('iso-8601', '%H:%M:%S',),
+    # 按视图 mymeta['throttles'] 限流, 见 tg/throttling.py
+    'DEFAULT_THROTTLE_CLASSES': ('tg.throttling.MymetaThrottle',),
+    # 前面的反向代理(nginx)的层数, 限流按 X-Forwarded-For 中倒数第 NUM_PROXIES 个地址取客户端 ip.
+    # 与实际部署不一致时客户端可以伪造 ip, 见 tg/throttling.py
+    'NUM_PROXIES': 1,
     # Exception handling
     'EXCEPTION_HANDLER': 'tg.views.my_exception_handler',
 }
@@ -217,4 +222,107 @@ JWT_AUTH = {
 # 关于用户认证, 也就是django.contrib.auth.authenticate 会调用的背后的认证
 # 就用django默认的用户体系, 这个值不要改
 AUTH_USER_MODEL = 'tg.UserInfo'
-AUTHENTICATION_BACKENDS = ('django.contrib.auth.backends.ModelBackend', 'tg.authbackends.MobileBackend',)
+# 按用户名, 手机号或 email 登录, 只查询一次数据库; 不存在的账号在缓存中记录 MISS_TTL 秒, 见 tg/authbackends.py
+AUTHENTICATION_BACKENDS = ('tg.authbackends.IdentifierBackend',)
+AUTH_LOOKUP = {
+    'MISS_TTL': 300,
+}
+
+# 验证码, 登录, 注册等接口的限流开关, 及按 urlname 覆盖视图 mymeta 中的限流配置, 见 tg/throttling.py
+THROTTLE = {
+    'ENABLED': True,
+    'RATES': {},
+}
+
+# 行情服务, 见 tg/quotes
+# FEED 为 web 进程使用的行情源. tg.quotes.snapshot.SnapshotFeed 读取共享内存行情快照表,
+# 快照表由 manage.py run_quote_updater 单独一个进程从 UPDATER_FEED 定时刷新, 所有 gunicorn worker 共用.
+# tg.quotes.feeds.FileFeed 读取本地快照文件, tg.quotes.feeds.ReplayFeed 回放历史tick文件
+# TTL 为进程内行情缓存的有效秒数
+QUOTES_DIR = os.path.join(BASE_DIR, 'var', 'quotes')
+QUOTES = {
+    'FEED': 'tg.quotes.snapshot.SnapshotFeed',
+    'FEED_OPTIONS': {
+        'path': os.path.join(QUOTES_DIR, 'snapshot.bin'),
+    },
+    'TTL': 1,
+    'SNAPSHOT_PATH': os.path.join(QUOTES_DIR, 'snapshot.bin'),
+    'SNAPSHOT_CAPACITY': 16384,
+    'UPDATER_FEED': 'tg.quotes.feeds.FileFeed',
+    'UPDATER_FEED_OPTIONS': {
+        'path': os.path.join(QUOTES_DIR, 'last_ticks.jsonl'),
+    },
+    'UPDATER_INTERVAL': 3,
+    # 日线收盘价, 用于 manage.py compute_ratios 计算收益率
+    'BAR_SOURCE': 'tg.quotes.bars.FileBarSource',
+    'BAR_SOURCE_OPTIONS': {
+        'path': os.path.join(QUOTES_DIR, 'daily_closes.csv'),
+    },
+}
+
+# 证券代码表数据源, 用于 manage.py fetch_secs, 见 tg/secmaster.py
+SECMASTER = {
+    'SOURCE': 'tg.secmaster.FileSecSource',
+    'SOURCE_OPTIONS': {
+        'path': os.path.join(BASE_DIR, 'var', 'secmaster', 'secmodels.csv'),
+    },
+}
+
+# 组合收益走势存储目录及基准, 见 tg/navstore.py
+NAVSTORE_ROOT = os.path.join(BASE_DIR, 'var', 'navstore')
+NAVSTORE_BENCHMARK = ('SHSE.000300', u'沪深300')
+
+# 分页总数的缓存时间(秒), 及不带过滤条件时改用估计行数的阈值, 见 tg/counting.py
+COUNTING = {
+    'TTL': 60,
+    'ESTIMATE_THRESHOLD': 100000,
+}
+
+# 关注的投顾的观点时间线: 每个用户保留的条数, 粉丝数超过多少的投顾改为读取时拉取, 见 tg/feed.py
+FEED = {
+    'TIMELINE_SIZE': 500,
+    'PULL_FANS_THRESHOLD': 10000,
+    'PULL_ADVISERS_TTL': 300,
+}
+
+# 投顾综合排名得分的各项权重及活跃度衰减的半衰期(天), 见 tg/kpi.py
+ADVISER_COMPOSITE_SCORE = {
+    'WEIGHTS': {
+        'success_ratio': 0.35,
+        'accumulate_profit_ratio': 0.35,
+        'fans': 0.2,
+        'recency': 0.1,
+    },
+    'RECENCY_HALF_LIFE_DAYS': 30,
+}
+
+# 首页聚合接口: 与用户无关部分的缓存时间(秒), 并行组装各部分的线程数, 见 tg/homepage.py
+INDEX = {
+    'TTL': 15,
+    'THREADS': 5,
+}
+
+# 未登录请求的响应缓存时间(秒), 不触发 signal 的批量修改最多在这个时间后生效, 见 tg/respcache.py
+RESPONSE_CACHE = {
+    'TTL': 60,
+}
+
+# 资讯/投资观点详情页预渲染结果的存放目录, 缓存时间(秒)及返回给客户端的 max-age, 见 tg/prerender.py
+PRERENDER = {
+    'DIR': os.path.join(BASE_DIR, 'var', 'prerender'),
+    'CACHE_TIMEOUT': 24 * 3600,
+    'MAX_AGE': 300,
+}
+
+# 资讯/投资观点全文检索索引的存放目录, 段的大小及最多的段数, 见 tg/search/index.py
+SEARCH = {
+    'DIR': os.path.join(BASE_DIR, 'var', 'search'),
+    'SEGMENT_DOCS': 200000,
+    'MAX_SEGMENTS': 16,
+}
+
+# jwt 认证时用户缓存的有效期(秒): 进程内缓存及 memcached, 见 tg/usercache.py
+USER_CACHE = {
+    'LOCAL_TTL': 5,
+    'TTL': 600,
+}
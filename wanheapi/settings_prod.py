@@ -28,7 +28,18 @@ CACHES = {
         'TIMEOUT': 400,
         'KEY_PREFIX': 'wanheapi',
         'KEY_FUNCTION': memcached_hash_key
-    }
+    },
+    # 排行榜等直接使用 redis 数据结构的功能, 见 tg/redis_utils.py
+    'redis': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+        'KEY_PREFIX': 'wanheapi',
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'SOCKET_CONNECT_TIMEOUT': 1,
+            'SOCKET_TIMEOUT': 1,
+        },
+    },
 }
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'